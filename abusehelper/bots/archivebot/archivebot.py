@@ -1,18 +1,21 @@
 import os
 import re
+import sys
 import gzip
 import json
+import zlib
 import time
 import errno
 import random
 import urllib
+import threading
 import contextlib
-
-from datetime import datetime
+from cStringIO import StringIO
 
 import idiokit
 from idiokit.xmpp.jid import JID
-from abusehelper.core import bot, events, taskfarm, utils
+from abusehelper.core import bot, bloom, events, taskfarm, utils
+from abusehelper.core.rules import iprange
 
 
 def _create_compress_path(path):
@@ -125,11 +128,234 @@ def _archive_path(ts, room_name):
     )
 
 
-def _open_archive(archive_dir, ts, room_name):
+def _next_utc_day(ts):
+    r"""
+    Return the timestamp for the start of the UTC day following the
+    timestamp ts.
+
+    >>> _next_utc_day(0)
+    86400
+    >>> _next_utc_day(86399.5)
+    86400
+    >>> _next_utc_day(86400)
+    172800
+    """
+
+    return (int(ts) // 86400 + 1) * 86400
+
+
+def _open_archive(archive_dir, ts, room_name, buffering=1):
     path = os.path.join(archive_dir, _archive_path(ts, room_name))
     dirname = os.path.dirname(path)
     _ensure_dir(dirname)
-    return open(path, "ab", buffering=1)
+    return open(path, "ab", buffering=buffering)
+
+
+def _encode_event(event):
+    json_dict = dict((key, event.values(key)) for key in event.keys())
+    return json.dumps(json_dict) + os.linesep
+
+
+def index_path(path):
+    return path + ".idx"
+
+
+def index_item(key, value):
+    r"""
+    Return the string used for the key-value pair in the Bloom filters of
+    archive index blocks.
+
+    >>> index_item(u"ip", u"192.0.2.1")
+    u'ip\x00192.0.2.1'
+    """
+
+    return key + u"\x00" + value
+
+
+def canonical_ip(value):
+    r"""
+    Return the canonical form of a value that is a single IP address
+    (written in any form a rule's IP atom accepts), or None. The index
+    blocks contain the canonical forms too, as the IP atoms of queries
+    are looked up with them.
+
+    >>> canonical_ip(u"2001:DB8:0:0::1")
+    u'2001:db8::1'
+    >>> canonical_ip(u"192.0.2.1/32")
+    u'192.0.2.1'
+    >>> canonical_ip(u"192.0.2.0/24") is None
+    True
+    """
+
+    ip_range = iprange.parse_range(value)
+    if ip_range is None:
+        return None
+
+    address = unicode(ip_range)
+    if "/" in address or "-" in address:
+        return None
+    return address
+
+
+def _index_block(offset, size, times, batch, index_keys, error_rate):
+    items = set()
+    for event in batch:
+        for key in index_keys:
+            for value in event.values(key):
+                items.add(index_item(key, value))
+
+                address = canonical_ip(value)
+                if address is not None and address != value:
+                    items.add(index_item(key, address))
+
+    bloom_filter = bloom.BloomFilter(len(items), error_rate)
+    for item in items:
+        bloom_filter.add(item)
+
+    return json.dumps({
+        "offset": offset,
+        "size": size,
+        "start": min(times),
+        "end": max(times),
+        "events": len(batch),
+        "bloom": bloom_filter.to_string()
+    }) + os.linesep
+
+
+def _gzip_member(data, compresslevel=6):
+    r"""
+    Return the data compressed as a single gzip member. Concatenated gzip
+    members form a valid gzip file.
+
+    >>> data = _gzip_member("a\n") + _gzip_member("b\n")
+    >>> gzip.GzipFile(fileobj=StringIO(data)).read()
+    'a\nb\n'
+    """
+
+    output = StringIO()
+    compressed = gzip.GzipFile(fileobj=output, mode="wb", compresslevel=compresslevel)
+    try:
+        compressed.write(data)
+    finally:
+        compressed.close()
+    return output.getvalue()
+
+
+def _indexed_end(path):
+    r"""
+    Return the end offset of the last block listed in the index of the
+    archive file, or 0 when there is no index.
+    """
+
+    end = 0
+    try:
+        with open(index_path(path), "rb") as index:
+            for line in index:
+                try:
+                    block = json.loads(line)
+                    end = max(end, block["offset"] + block["size"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+    except IOError as error:
+        if error.errno != errno.ENOENT:
+            raise
+    return end
+
+
+def _gzip_members_end(fileobj, offset, chunk_size=2 ** 16):
+    r"""
+    Return the end offset of the last complete gzip member of the file,
+    reading the members from the given offset.
+
+    >>> data = _gzip_member("a\n") + _gzip_member("b\n")
+    >>> _gzip_members_end(StringIO(data), 0) == len(data)
+    True
+    >>> _gzip_members_end(StringIO(data + data[:10]), 0) == len(data)
+    True
+    >>> _gzip_members_end(StringIO(data[:-1]), 0) == len(_gzip_member("a\n"))
+    True
+    """
+
+    fileobj.seek(offset)
+
+    end = offset
+    consumed = offset
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pending = ""
+    while True:
+        if not pending:
+            pending = fileobj.read(chunk_size)
+            if not pending:
+                break
+
+        try:
+            decompressor.decompress(pending)
+        except zlib.error:
+            return end
+
+        # A finished member leaves the data after it unused, so a member
+        # ending at a chunk boundary is noticed when the next chunk is fed.
+        unused = decompressor.unused_data
+        consumed += len(pending) - len(unused)
+        pending = unused
+        if unused:
+            end = consumed
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    # The last member is complete only when it leaves a byte unused.
+    try:
+        decompressor.decompress("\x00")
+    except zlib.error:
+        return end
+    if decompressor.unused_data:
+        end = consumed
+    return end
+
+
+def _truncate_partial_members(path):
+    r"""
+    Truncate a stream compressed archive file after its last complete
+    gzip member. Return the number of dropped bytes.
+    """
+
+    with open(path, "r+b") as fileobj:
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell()
+
+        # The indexed blocks have been fully written.
+        start = _indexed_end(path)
+        if start > size:
+            start = 0
+
+        end = _gzip_members_end(fileobj, start)
+        if end < size:
+            fileobj.truncate(end)
+    return size - end
+
+
+def _truncate_partial_line(path, chunk_size=2 ** 16):
+    r"""
+    Truncate a file after its last complete line. Return the number of
+    dropped bytes.
+    """
+
+    with open(path, "r+b") as fileobj:
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell()
+
+        end = size
+        while end > 0:
+            start = max(end - chunk_size, 0)
+            fileobj.seek(start)
+            newline = fileobj.read(end - start).rfind("\n")
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+
+        if end < size:
+            fileobj.truncate(end)
+    return size - end
 
 
 def _encode_room_jid(jid):
@@ -202,8 +428,310 @@ def _compress(path):
     return gz_path
 
 
+FSYNC_POLICIES = ("never", "close", "flush")
+
+
+class _FsyncParam(bot.Param):
+    def parse(self, value):
+        value = value.strip().lower()
+        if value not in FSYNC_POLICIES:
+            raise bot.ParamError("expected one of {0}, got {1!r}".format(", ".join(FSYNC_POLICIES), value))
+        return value
+
+
+class _GroupWriter(object):
+    r"""
+    Append events to archive files from a separate writer thread.
+
+    The events are buffered per archive file and written as one group
+    when the file has flush_size events buffered, when its oldest buffered
+    event has waited for flush_interval seconds or when the file is
+    closed. The JSON encoding is also done in the writer thread.
+
+    The fsync_policy decides when the written data is synced to the disk:
+    "never", on "close" or after every "flush".
+
+    Failed writes don't stop the writer. Their messages are collected for
+    pop_errors(), as the bot's log may only be used from the main thread.
+    Any other error stops the writer, and is re-raised by check(), write()
+    and close_all(). The files pending a close are marked closed then, so
+    that nothing waits for them forever.
+
+    With compress=True each group is appended to the file as a separate
+    gzip member. Data left partially written by a crash or a failed write
+    (an incomplete gzip member, or an incomplete line of an uncompressed
+    archive or an index) is truncated away when the file is opened again,
+    so that the data appended after it stays readable. Thus a crash or a
+    failed write can only lose the group being written.
+
+    When index_keys is given, a line describing each written group is
+    appended to a sidecar index file (see index_path): the group's byte
+    offset and size in the archive file, the time range in which its
+    events were written and a Bloom filter over the group's values for
+    the index keys (see index_item).
+    """
+
+    def __init__(self, flush_size, flush_interval, fsync_policy="never",
+                 compress=False, index_keys=None, index_error_rate=0.01):
+        self._flush_size = max(flush_size, 1)
+        self._flush_interval = max(flush_interval, 0.0)
+        self._fsync_policy = fsync_policy
+        self._compress = compress
+        self._index_keys = index_keys
+        self._index_error_rate = index_error_rate
+
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._deadlines = {}
+        self._full = set()
+        self._closing = {}
+        self._files = {}
+        self._index_files = {}
+        self._errors = []
+        self._failure = None
+
+        thread = threading.Thread(target=self._run, name="archive writer")
+        thread.daemon = True
+        thread.start()
+
+    def write(self, path, event):
+        self.check()
+
+        with self._cond:
+            pending = self._pending.get(path, None)
+            if pending is None:
+                pending = []
+                self._pending[path] = pending
+                self._deadlines[path] = time.time() + self._flush_interval
+                self._cond.notify()
+            pending.append((time.time(), event))
+
+            if len(pending) >= self._flush_size and path not in self._full:
+                self._full.add(path)
+                self._cond.notify()
+
+    def close(self, path):
+        r"""
+        Write all buffered events for the path and close the archive file.
+        Return a threading.Event that gets set when the file is closed.
+        """
+
+        done = threading.Event()
+        with self._cond:
+            if self._failure is not None:
+                done.set()
+            else:
+                self._closing.setdefault(path, []).append(done)
+                self._cond.notify()
+        return done
+
+    def close_all(self, timeout=None):
+        r"""
+        Close all archive files, waiting at most timeout seconds in total.
+        Return False when some of the files did not get closed in time.
+        """
+
+        with self._cond:
+            paths = set(self._pending) | set(self._files) | set(self._closing)
+        waiters = [self.close(path) for path in paths]
+
+        deadline = None if timeout is None else time.time() + timeout
+        for done in waiters:
+            done.wait(None if deadline is None else max(deadline - time.time(), 0.0))
+
+        self.check()
+        return all(done.is_set() for done in waiters)
+
+    def pop_errors(self):
+        r"""
+        Return the messages of the failed writes since the previous call.
+        """
+
+        with self._cond:
+            errors, self._errors = self._errors, []
+        return errors
+
+    def check(self):
+        r"""
+        Re-raise the error that stopped the writer thread, if any.
+        """
+
+        failure = self._failure
+        if failure is not None:
+            raise failure[0], failure[1], failure[2]
+
+    def _error(self, message):
+        with self._cond:
+            self._errors.append(message)
+
+    def _due(self, now):
+        due = set(self._full)
+        due.update(self._closing)
+        for path, deadline in self._deadlines.iteritems():
+            if deadline <= now:
+                due.add(path)
+        return due
+
+    def _run(self):
+        closing = {}
+        try:
+            while True:
+                with self._cond:
+                    while True:
+                        now = time.time()
+                        due = self._due(now)
+                        if due:
+                            break
+
+                        timeout = None
+                        if self._deadlines:
+                            timeout = max(min(self._deadlines.itervalues()) - now, 0.0)
+                        self._cond.wait(timeout)
+
+                    batches = []
+                    for path in due:
+                        self._full.discard(path)
+                        self._deadlines.pop(path, None)
+                        batch = self._pending.pop(path, None)
+                        if batch:
+                            batches.append((path, batch))
+                    closing, self._closing = self._closing, {}
+
+                for path, batch in batches:
+                    self._write(path, batch)
+
+                for path in list(closing):
+                    self._close(path)
+                    for done in closing.pop(path):
+                        done.set()
+        except BaseException:
+            with self._cond:
+                self._failure = sys.exc_info()
+                closing.update(self._closing)
+                self._closing = {}
+
+            for waiters in closing.itervalues():
+                for done in waiters:
+                    done.set()
+
+    def _open(self, files, path, repair):
+        fileobj = files.get(path, None)
+        if fileobj is None:
+            _ensure_dir(os.path.dirname(path))
+
+            if os.path.isfile(path):
+                dropped = repair(path)
+                if dropped:
+                    self._error("Dropped {0} bytes of partially written data from {1!r}".format(dropped, path))
+
+            fileobj = open(path, "ab")
+            files[path] = fileobj
+        return fileobj
+
+    def _append(self, fileobj, data):
+        offset = os.fstat(fileobj.fileno()).st_size
+        fileobj.write(data)
+        fileobj.flush()
+        if self._fsync_policy == "flush":
+            os.fsync(fileobj.fileno())
+        return offset
+
+    def _write(self, path, batch):
+        times = [timestamp for (timestamp, _) in batch]
+        batch = [event for (_, event) in batch]
+
+        data = "".join(_encode_event(event) for event in batch)
+        if self._compress:
+            data = _gzip_member(data)
+
+        try:
+            if self._index_keys is not None:
+                # Repair the index first, so that the blocks it lists can
+                # be trusted when repairing the archive file.
+                self._open(self._index_files, index_path(path), _truncate_partial_line)
+
+            repair = _truncate_partial_members if self._compress else _truncate_partial_line
+            offset = self._append(self._open(self._files, path, repair), data)
+
+            if self._index_keys is not None:
+                block = _index_block(offset, len(data), times, batch, self._index_keys, self._index_error_rate)
+                self._append(self._open(self._index_files, index_path(path), _truncate_partial_line), block)
+        except (IOError, OSError) as error:
+            self._error("Failed to write {0} events to archive {1!r}: {2}".format(len(batch), path, error))
+
+            # Reopen the files for the next group, dropping whatever got
+            # partially written.
+            self._discard(self._files, path)
+            self._discard(self._index_files, index_path(path))
+
+    def _discard(self, files, path):
+        fileobj = files.pop(path, None)
+        if fileobj is None:
+            return
+
+        try:
+            fileobj.close()
+        except (IOError, OSError):
+            pass
+
+    def _close(self, path):
+        self._close_file(self._files, path)
+        self._close_file(self._index_files, index_path(path))
+
+    def _close_file(self, files, path):
+        fileobj = files.pop(path, None)
+        if fileobj is None:
+            return
+
+        try:
+            try:
+                fileobj.flush()
+                if self._fsync_policy != "never":
+                    os.fsync(fileobj.fileno())
+            finally:
+                fileobj.close()
+        except (IOError, OSError) as error:
+            self._error("Failed to close archive {0!r}: {1}".format(path, error))
+
+
 class ArchiveBot(bot.ServiceBot):
     archive_dir = bot.Param("directory where archive files are written")
+    group_commit = bot.BoolParam("""
+        buffer the archived events and write them to the archive
+        files in groups from a separate writer thread
+        """)
+    flush_size = bot.IntParam("""
+        with group_commit, write the buffered events of an archive
+        file when this many events have been buffered
+        (default: %default)
+        """, default=1000)
+    flush_interval = bot.FloatParam("""
+        with group_commit, write each buffered event within this
+        many seconds, i.e. at most this many seconds of events can
+        get lost on a crash (default: %default)
+        """, default=1.0)
+    stream_compress = bot.BoolParam("""
+        write the archive files gzip compressed as they are written,
+        one gzip member per flush (implies group_commit)
+        """)
+    index_keys = bot.ListParam("""
+        write a sidecar index for each archive file, with a Bloom
+        filter over the values of these keys for each written block
+        (e.g. "ip, domain name, asn", implies stream_compress)
+        """, default=None)
+    index_error_rate = bot.FloatParam("""
+        the false positive rate of the index Bloom filters
+        (default: %default)
+        """, default=0.01)
+    compress_concurrency = bot.IntParam("""
+        how many archive files can be compressed at the same time,
+        e.g. when recompressing leftover files on startup
+        (default: %default)
+        """, default=1)
+    fsync = _FsyncParam("""
+        when to sync the written archive data to the disk: never,
+        on archive file close or after every flush (default: %default)
+        """, default="never")
 
     def __init__(self, *args, **keys):
         super(ArchiveBot, self).__init__(*args, **keys)
@@ -211,6 +739,50 @@ class ArchiveBot(bot.ServiceBot):
         self.rooms = taskfarm.TaskFarm(self._handle_room, grace_period=0.0)
         self.archive_dir = _ensure_dir(self.archive_dir)
 
+        self._compress_queue = utils.WaitQueue()
+
+        # Indexed blocks are only useful when the archive files are not
+        # recompressed afterwards.
+        if self.index_keys is not None:
+            self.stream_compress = True
+
+        self._writer = None
+        if self.group_commit or self.stream_compress:
+            self._writer = _GroupWriter(
+                self.flush_size,
+                self.flush_interval,
+                self.fsync,
+                compress=self.stream_compress,
+                index_keys=self.index_keys,
+                index_error_rate=self.index_error_rate)
+
+    @idiokit.stream
+    def main(self, state):
+        workers = [self._compress(self._compress_queue) for _ in xrange(max(self.compress_concurrency, 1))]
+        if self._writer is not None:
+            workers.append(self._report_write_errors())
+
+        try:
+            yield idiokit.pipe(*workers)
+        finally:
+            if self._writer is not None:
+                try:
+                    closed = yield idiokit.thread(self._writer.close_all, 60.0)
+                    if not closed:
+                        self.log.error("Could not write and close all archives in 60 seconds")
+                finally:
+                    self._log_write_errors()
+
+    @idiokit.stream
+    def _report_write_errors(self, interval=1.0):
+        while True:
+            yield idiokit.sleep(interval)
+            self._log_write_errors()
+
+    def _log_write_errors(self):
+        for message in self._writer.pop_errors():
+            self.log.error(message)
+
     @idiokit.stream
     def session(self, state, src_room):
         src_jid = yield self.xmpp.muc.get_full_room_jid(src_room)
@@ -241,7 +813,7 @@ class ArchiveBot(bot.ServiceBot):
                 log.close("Left " + msg, attrs, status="left")
 
     def _archive(self, room_bare_jid):
-        compress = utils.WaitQueue()
+        compress = self._compress_queue
         room_name = _encode_room_jid(room_bare_jid)
 
         _dir = os.path.join(self.archive_dir, room_name)
@@ -255,29 +827,65 @@ class ArchiveBot(bot.ServiceBot):
                 if _is_compress_path(path):
                     compress.queue(0.0, path)
 
-        return idiokit.pipe(
-            self._collect(room_name, compress),
-            self._compress(compress)
-        )
+        return self._collect(room_name, compress)
 
     @idiokit.stream
     def _collect(self, room_name, compress):
+        if self._writer is not None:
+            yield self._collect_groups(room_name, compress)
+            return
+
         event = yield idiokit.next()
 
         while True:
-            current = datetime.utcnow().day
+            now = time.time()
+            day_end = _next_utc_day(now)
 
-            with _open_archive(self.archive_dir, time.time(), room_name) as archive:
+            with _open_archive(self.archive_dir, now, room_name) as archive:
                 self.log.info("Opened archive {0!r}".format(archive.name))
 
-                while current == datetime.utcnow().day:
-                    json_dict = dict((key, event.values(key)) for key in event.keys())
-                    archive.write(json.dumps(json_dict) + os.linesep)
+                try:
+                    while time.time() < day_end:
+                        archive.write(_encode_event(event))
+                        if self.fsync == "flush":
+                            os.fsync(archive.fileno())
 
-                    event = yield idiokit.next()
+                        event = yield idiokit.next()
+                finally:
+                    if self.fsync != "never":
+                        archive.flush()
+                        os.fsync(archive.fileno())
 
             yield compress.queue(0.0, _rename(archive.name))
 
+    @idiokit.stream
+    def _collect_groups(self, room_name, compress):
+        event = yield idiokit.next()
+
+        while True:
+            now = time.time()
+            day_end = _next_utc_day(now)
+
+            path = os.path.join(self.archive_dir, _archive_path(now, room_name))
+            if self.stream_compress:
+                path += ".gz"
+            self.log.info("Opened archive {0!r}".format(path))
+
+            try:
+                while time.time() < day_end:
+                    self._writer.write(path, event)
+                    event = yield idiokit.next()
+            finally:
+                closed = self._writer.close(path)
+
+            yield idiokit.thread(closed.wait)
+            self._writer.check()
+
+            # Compressed archives are complete as they are, as each flush
+            # appended a whole gzip member.
+            if not self.stream_compress and os.path.isfile(path):
+                yield compress.queue(0.0, _rename(path))
+
     @idiokit.stream
     def _compress(self, queue):
         while True:
@@ -0,0 +1,89 @@
+"""
+Measure the archiving throughput of the line buffered writes done by
+default against the group commit writer with different fsync policies.
+
+Both the total throughput and the throughput seen by the thread handing
+the events over (the bot's event loop) are reported.
+
+Run with: python -m abusehelper.bots.archivebot.tests.bench_archivebot
+"""
+
+import os
+import time
+import shutil
+import tempfile
+
+from abusehelper.core.events import Event
+
+from .. import archivebot
+
+
+def sample_events(count):
+    for index in xrange(count):
+        yield Event({
+            "feed": "example feed",
+            "type": "malware",
+            "ip": "192.0.2.{0}".format(index % 256),
+            "domain name": "host{0}.example".format(index),
+            "url": "http://host{0}.example/path/file.exe".format(index)
+        })
+
+
+def bench_line_buffered(directory, events, rooms):
+    archives = []
+    for room in xrange(rooms):
+        path = os.path.join(directory, "room{0}.json".format(room))
+        archives.append(open(path, "ab", buffering=1))
+
+    try:
+        for index, event in enumerate(events):
+            archives[index % rooms].write(archivebot._encode_event(event))
+        return time.time()
+    finally:
+        for archive in archives:
+            archive.close()
+
+
+def bench_group_commit(fsync_policy):
+    def bench(directory, events, rooms):
+        paths = [os.path.join(directory, "room{0}.json".format(room)) for room in xrange(rooms)]
+
+        writer = archivebot._GroupWriter(1000, 1.0, fsync_policy)
+        for index, event in enumerate(events):
+            writer.write(paths[index % rooms], event)
+        handed_over = time.time()
+        writer.close_all()
+        return handed_over
+    return bench
+
+
+BENCHMARKS = [
+    ("line buffered", bench_line_buffered),
+    ("group commit", bench_group_commit("never")),
+    ("group commit, fsync on close", bench_group_commit("close")),
+    ("group commit, fsync on flush", bench_group_commit("flush"))
+]
+
+
+def main(event_count=100000, rooms=10):
+    events = list(sample_events(event_count))
+
+    print "{0} events to {1} rooms".format(event_count, rooms)
+    for name, bench in BENCHMARKS:
+        directory = tempfile.mkdtemp()
+        try:
+            start = time.time()
+            handed_over = bench(directory, events, rooms)
+            elapsed = time.time() - start
+        finally:
+            shutil.rmtree(directory)
+
+        print "{0:>30}: {1:>9.0f} events/s total, {2:>9.0f} events/s handed over".format(
+            name,
+            event_count / elapsed,
+            event_count / (handed_over - start)
+        )
+
+
+if __name__ == "__main__":
+    main()
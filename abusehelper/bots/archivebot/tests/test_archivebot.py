@@ -1,10 +1,15 @@
 import os
+import gzip
+import json
+import time
 import stat
 import shutil
 import tempfile
 import unittest
 import contextlib
 
+from abusehelper.core import bot, bloom, events
+
 from .. import archivebot
 
 
@@ -94,3 +99,184 @@ class TestCompress(unittest.TestCase):
                 self.assertEqual(gz_file, tmp.name[:-18] + ".gz")
             finally:
                 os.remove(gz_file)
+
+
+class TestGroupWriter(unittest.TestCase):
+    def _read(self, path):
+        with open(path, "rb") as archive:
+            return [json.loads(line) for line in archive]
+
+    def test_should_write_buffered_events_on_close(self):
+        with tmpdir() as directory:
+            path = os.path.join(directory, "room", "archive.json")
+
+            writer = archivebot._GroupWriter(flush_size=100, flush_interval=60.0)
+            writer.write(path, events.Event(a="1"))
+            writer.write(path, events.Event(a="2", b="3"))
+            self.assertTrue(writer.close(path).wait(10.0) is not False)
+
+            self.assertEqual(self._read(path), [{"a": ["1"]}, {"a": ["2"], "b": ["3"]}])
+
+    def test_should_flush_when_buffer_is_full(self):
+        with tmpdir() as directory:
+            path = os.path.join(directory, "archive.json")
+
+            writer = archivebot._GroupWriter(flush_size=2, flush_interval=60.0)
+            writer.write(path, events.Event(a="1"))
+            writer.write(path, events.Event(a="2"))
+
+            for _ in xrange(100):
+                if os.path.isfile(path) and len(self._read(path)) == 2:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(self._read(path), [{"a": ["1"]}, {"a": ["2"]}])
+            writer.close_all()
+
+    def test_should_flush_after_the_flush_interval(self):
+        with tmpdir() as directory:
+            path = os.path.join(directory, "archive.json")
+
+            writer = archivebot._GroupWriter(flush_size=100, flush_interval=0.01)
+            writer.write(path, events.Event(a="1"))
+
+            for _ in xrange(100):
+                if os.path.isfile(path) and self._read(path):
+                    break
+                time.sleep(0.05)
+            self.assertEqual(self._read(path), [{"a": ["1"]}])
+            writer.close_all()
+
+    def test_should_append_after_reopening(self):
+        with tmpdir() as directory:
+            path = os.path.join(directory, "archive.json")
+
+            writer = archivebot._GroupWriter(flush_size=100, flush_interval=60.0, fsync_policy="close")
+            writer.write(path, events.Event(a="1"))
+            writer.close(path).wait(10.0)
+            writer.write(path, events.Event(a="2"))
+            writer.close_all(10.0)
+
+            self.assertEqual(self._read(path), [{"a": ["1"]}, {"a": ["2"]}])
+
+    def test_should_append_gzip_members_when_compressing(self):
+        with tmpdir() as directory:
+            path = os.path.join(directory, "archive.json.gz")
+
+            writer = archivebot._GroupWriter(flush_size=1, flush_interval=60.0, compress=True)
+            writer.write(path, events.Event(a="1"))
+            writer.close(path).wait(10.0)
+            writer.write(path, events.Event(a="2"))
+            writer.close_all(10.0)
+
+            with contextlib.closing(gzip.GzipFile(path, "rb")) as archive:
+                lines = [json.loads(line) for line in archive]
+            self.assertEqual(lines, [{"a": ["1"]}, {"a": ["2"]}])
+
+    def test_should_write_an_index_line_per_block(self):
+        with tmpdir() as directory:
+            path = os.path.join(directory, "archive.json.gz")
+
+            writer = archivebot._GroupWriter(flush_size=100, flush_interval=60.0, compress=True, index_keys=["ip"])
+            writer.write(path, events.Event(ip="192.0.2.1"))
+            writer.close(path).wait(10.0)
+            writer.write(path, events.Event(ip="192.0.2.2"))
+            writer.close_all(10.0)
+
+            blocks = self._read(archivebot.index_path(path))
+            self.assertEqual(len(blocks), 2)
+            self.assertEqual(blocks[0]["offset"], 0)
+            self.assertEqual(blocks[1]["offset"], blocks[0]["size"])
+            self.assertEqual(blocks[0]["size"] + blocks[1]["size"], os.path.getsize(path))
+
+            first = bloom.BloomFilter.from_string(str(blocks[0]["bloom"]))
+            self.assertTrue(archivebot.index_item(u"ip", u"192.0.2.1") in first)
+
+    def test_should_index_the_canonical_form_of_ip_addresses(self):
+        with tmpdir() as directory:
+            path = os.path.join(directory, "archive.json")
+
+            writer = archivebot._GroupWriter(flush_size=100, flush_interval=60.0, index_keys=["ip"])
+            writer.write(path, events.Event(ip="2001:DB8:0::1"))
+            writer.close_all(10.0)
+
+            blocks = self._read(archivebot.index_path(path))
+            block = bloom.BloomFilter.from_string(str(blocks[0]["bloom"]))
+            self.assertTrue(archivebot.index_item(u"ip", u"2001:DB8:0::1") in block)
+            self.assertTrue(archivebot.index_item(u"ip", u"2001:db8::1") in block)
+
+    def test_partially_written_members_are_dropped_on_reopen(self):
+        with tmpdir() as directory:
+            path = os.path.join(directory, "archive.json.gz")
+
+            writer = archivebot._GroupWriter(flush_size=100, flush_interval=60.0, compress=True, index_keys=["ip"])
+            writer.write(path, events.Event(ip="192.0.2.1"))
+            writer.close_all(10.0)
+
+            # Simulate a crash in the middle of writing a group and its index line.
+            with open(path, "ab") as archive:
+                archive.write(archivebot._gzip_member("{}\n" * 100)[:-20])
+            with open(archivebot.index_path(path), "ab") as index:
+                index.write("{\"offset\": ")
+
+            writer = archivebot._GroupWriter(flush_size=100, flush_interval=60.0, compress=True, index_keys=["ip"])
+            writer.write(path, events.Event(ip="192.0.2.2"))
+            writer.close_all(10.0)
+            self.assertEqual(2, len(writer.pop_errors()))
+
+            with contextlib.closing(gzip.GzipFile(path, "rb")) as archive:
+                lines = [json.loads(line) for line in archive]
+            self.assertEqual(lines, [{"ip": ["192.0.2.1"]}, {"ip": ["192.0.2.2"]}])
+
+            blocks = self._read(archivebot.index_path(path))
+            self.assertEqual(2, len(blocks))
+            self.assertEqual(blocks[1]["offset"] + blocks[1]["size"], os.path.getsize(path))
+
+    def test_partial_lines_are_dropped_on_reopen(self):
+        with tmpdir() as directory:
+            path = os.path.join(directory, "archive.json")
+            with open(path, "wb") as archive:
+                archive.write("{\"a\": [\"1\"]}\n{\"a\": ")
+
+            writer = archivebot._GroupWriter(flush_size=100, flush_interval=60.0)
+            writer.write(path, events.Event(a="2"))
+            writer.close_all(10.0)
+
+            self.assertEqual(self._read(path), [{"a": ["1"]}, {"a": ["2"]}])
+
+    def test_failed_writes_are_collected(self):
+        with tmpdir() as directory:
+            touch(os.path.join(directory, "file"))
+            path = os.path.join(directory, "file", "archive.json")
+
+            writer = archivebot._GroupWriter(flush_size=100, flush_interval=60.0)
+            writer.write(path, events.Event(a="1"))
+            self.assertTrue(writer.close_all(10.0))
+
+            errors = writer.pop_errors()
+            self.assertEqual(1, len(errors))
+            self.assertTrue(errors[0].startswith("Failed to write 1 events to archive"))
+            self.assertEqual([], writer.pop_errors())
+
+    def test_writer_failures_are_reraised(self):
+        with tmpdir() as directory:
+            path = os.path.join(directory, "archive.json")
+
+            writer = archivebot._GroupWriter(flush_size=100, flush_interval=60.0)
+            writer.write(path, object())
+
+            # Waiting for the close doesn't hang after the writer has failed.
+            self.assertTrue(writer.close(path).wait(10.0) is not False)
+            self.assertRaises(AttributeError, writer.check)
+            self.assertRaises(AttributeError, writer.write, path, events.Event(a="1"))
+            self.assertRaises(AttributeError, writer.close_all, 10.0)
+
+
+class TestFsyncParam(unittest.TestCase):
+    def test_valid_policies(self):
+        param = archivebot._FsyncParam()
+        self.assertEqual(param.parse("never"), "never")
+        self.assertEqual(param.parse(" Flush "), "flush")
+
+    def test_invalid_policy(self):
+        param = archivebot._FsyncParam()
+        self.assertRaises(bot.ParamError, param.parse, "always")
@@ -0,0 +1,131 @@
+import os
+import time
+import shutil
+import calendar
+import tempfile
+import unittest
+
+from abusehelper.core import bot, events
+from abusehelper.tools import archivereplay
+
+from .. import archivebot
+
+
+DAY = calendar.timegm((2016, 2, 9, 0, 0, 0))
+
+
+class _Log(object):
+    def __init__(self):
+        self.messages = []
+
+    def info(self, message, *args, **keys):
+        pass
+
+    def warning(self, message, *args, **keys):
+        self.messages.append(message)
+
+
+class TestPaceParam(unittest.TestCase):
+    def test_valid_paces(self):
+        param = archivereplay._PaceParam()
+        self.assertEqual(("speed", 10.0), param.parse("10x"))
+        self.assertEqual(("rate", 2.5), param.parse(" 2.5/S "))
+
+    def test_invalid_paces(self):
+        param = archivereplay._PaceParam()
+        for value in ["10", "0x", "-1/s", "x"]:
+            self.assertRaises(bot.ParamError, param.parse, value)
+
+
+class TestSchedule(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, rel_path, lines):
+        path = os.path.join(self.directory, rel_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with open(path, "wb") as archive:
+            for timestamp, event in lines:
+                if timestamp is None:
+                    archive.write(archivebot._encode_event(event))
+                else:
+                    line = time.strftime("%Y-%m-%d %H:%M:%SZ", time.gmtime(timestamp))
+                    archive.write(line + " " + unicode(event).encode("utf-8") + "\n")
+        return path
+
+    def schedule(self, paths, pace=None):
+        replay = archivereplay.ArchiveReplay(
+            xmpp_jid="replay@example.com",
+            xmpp_password="password",
+            room="room@conference.example.com",
+            paths=paths,
+            pace=pace)
+        replay.log = _Log()
+
+        scheduled = list(replay._schedule())
+        dues = [due for (due, _) in scheduled]
+        if any(due is not None for due in dues):
+            first = dues[0]
+            dues = [round(due - first, 6) for due in dues]
+        return dues, [event for (_, event) in scheduled], replay.log.messages
+
+    def test_as_fast_as_possible_by_default(self):
+        path = self.write("legacy", [(DAY, events.Event(a="1")), (DAY + 10, events.Event(a="2"))])
+
+        dues, event_list, _ = self.schedule([path])
+        self.assertEqual([None, None], dues)
+        self.assertEqual([events.Event(a="1"), events.Event(a="2")], event_list)
+
+    def test_fixed_rate(self):
+        path = self.write("legacy", [(DAY, events.Event(a=unicode(index))) for index in range(3)])
+
+        dues, _, _ = self.schedule([path], ("rate", 5.0))
+        self.assertEqual([0.0, 0.2, 0.4], dues)
+
+    def test_recorded_times_are_followed_faster(self):
+        path = self.write("legacy", [(DAY, events.Event(a="1")), (DAY + 10, events.Event(a="2"))])
+
+        dues, _, messages = self.schedule([path], ("speed", 10.0))
+        self.assertEqual([0.0, 1.0], dues)
+        self.assertEqual([], messages)
+
+    def test_untimed_archives_are_timed_by_their_day(self):
+        timed = self.write("legacy", [(DAY - 3600, events.Event(a="1"))])
+        untimed = self.write("room/2016/02/09.json", [(None, events.Event(a="2")), (None, events.Event(a="3"))])
+
+        dues, _, messages = self.schedule([timed, untimed], ("speed", 10.0))
+        self.assertEqual([0.0, 360.0, 360.0], dues)
+
+        # The missing times are warned about once per archive.
+        self.assertEqual(1, len(messages))
+        self.assertTrue("at the start of their day" in messages[0])
+
+    def test_untimed_archives_do_not_go_back_in_time(self):
+        timed = self.write("legacy", [(DAY + 3600, events.Event(a="1"))])
+        untimed = self.write("room/2016/02/09.json", [(None, events.Event(a="2"))])
+        later = self.write("later", [(DAY + 3610, events.Event(a="3"))])
+
+        dues, _, _ = self.schedule([timed, untimed, later], ("speed", 10.0))
+        self.assertEqual([0.0, 0.0, 1.0], dues)
+
+    def test_untimed_archives_without_a_day_are_sent_right_away(self):
+        path = self.write("events.json", [(None, events.Event(a="1"))])
+
+        dues, _, messages = self.schedule([path], ("speed", 10.0))
+        self.assertEqual([None], dues)
+        self.assertTrue("as fast as possible" in messages[0])
+
+    def test_read_errors_are_logged(self):
+        path = self.write("room/2016/02/09.json", [(None, events.Event(a="1"))])
+        with open(path, "ab") as archive:
+            archive.write("broken\n")
+
+        _, event_list, messages = self.schedule([path])
+        self.assertEqual([events.Event(a="1")], event_list)
+        self.assertEqual(1, len(messages))
+        self.assertTrue(messages[0].startswith("Could not read all of the archive"))
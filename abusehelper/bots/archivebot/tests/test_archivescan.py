@@ -0,0 +1,194 @@
+import os
+import gzip
+import time
+import shutil
+import calendar
+import tempfile
+import unittest
+
+from abusehelper.core import events
+from abusehelper.tools import archivescan
+
+from .. import archivebot
+
+
+DAY = calendar.timegm((2016, 2, 9, 0, 0, 0))
+
+
+def _line(**attrs):
+    return archivebot._encode_event(events.Event(attrs))
+
+
+def _legacy_line(timestamp, **attrs):
+    return time.strftime("%Y-%m-%d %H:%M:%SZ", time.gmtime(timestamp)) + " " + unicode(events.Event(attrs)).encode("utf-8") + "\n"
+
+
+class _ArchiveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, rel_path):
+        path = os.path.join(self.directory, rel_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        return path
+
+    def write(self, rel_path, data):
+        with open(self.path(rel_path), "ab") as archive:
+            archive.write(data)
+        return self.path(rel_path)
+
+    def write_gzip(self, rel_path, data):
+        archive = gzip.open(self.path(rel_path), "wb")
+        try:
+            archive.write(data)
+        finally:
+            archive.close()
+        return self.path(rel_path)
+
+    def write_block(self, rel_path, timestamp, event_list, indexed=True):
+        path = self.path(rel_path)
+        offset = os.path.getsize(path) if os.path.isfile(path) else 0
+
+        data = archivebot._gzip_member("".join(archivebot._encode_event(event) for event in event_list))
+        self.write(rel_path, data)
+        if indexed:
+            block = archivebot._index_block(offset, len(data), [timestamp], event_list, ["a"], 0.01)
+            self.write(rel_path + ".idx", block)
+        return path
+
+
+class TestReadEvents(_ArchiveTestCase):
+    def read(self, path):
+        errors = []
+        result = list(archivescan.read_events(path, errors))
+        return result, errors
+
+    def test_plain_archives_have_no_times(self):
+        path = self.write("room/2016/02/09.json", _line(a="1") + _line(a="2"))
+        result, errors = self.read(path)
+        self.assertEqual([(None, events.Event(a="1")), (None, events.Event(a="2"))], result)
+        self.assertEqual([], errors)
+
+    def test_legacy_lines_have_times(self):
+        path = self.write_gzip("legacy.gz", _legacy_line(DAY + 1, a="1"))
+        result, errors = self.read(path)
+        self.assertEqual([(DAY + 1, events.Event(a="1"))], result)
+
+    def test_bad_lines_are_skipped_and_reported(self):
+        path = self.write("room/2016/02/09.json", _line(a="1") + "not an event\n" + _line(a="2"))
+        result, errors = self.read(path)
+        self.assertEqual([events.Event(a="1"), events.Event(a="2")], [event for (_, event) in result])
+        self.assertEqual(1, len(errors))
+        self.assertTrue("line 2" in errors[0])
+
+    def test_blocks_get_the_time_of_their_own_index_line(self):
+        rel_path = "room/2016/02/09.json.gz"
+        self.write_block(rel_path, DAY + 10, [events.Event(a="1"), events.Event(a="2")])
+        self.write_block(rel_path, DAY + 20, [events.Event(a="3")], indexed=False)
+        path = self.write_block(rel_path, DAY + 30, [events.Event(a="4")])
+        self.write(rel_path, archivebot._gzip_member(_line(a="5")))
+
+        result, errors = self.read(path)
+        self.assertEqual([
+            (DAY + 10, events.Event(a="1")),
+            (DAY + 10, events.Event(a="2")),
+            (None, events.Event(a="3")),
+            (DAY + 30, events.Event(a="4")),
+            (None, events.Event(a="5"))
+        ], result)
+        self.assertEqual([], errors)
+
+    def test_damaged_gzip_data_is_reported(self):
+        member = archivebot._gzip_member(_line(a="1") * 10)
+        path = self.write("room/2016/02/09.json.gz", member + member[:len(member) // 2] + member)
+
+        result, errors = self.read(path)
+        self.assertEqual(1, len(errors))
+
+
+class TestFindArchives(_ArchiveTestCase):
+    def test_day_archives_are_limited_to_the_time_range(self):
+        for day in ["08", "09", "10"]:
+            self.write("room/2016/02/" + day + ".json", _line(a="1"))
+        self.write("room/2016/02/09.json.idx", "")
+        self.write("legacy", "")
+
+        found = archivescan.find_archives(self.directory, start=DAY, end=DAY + 86400)
+        self.assertEqual(["legacy", os.path.join("room", "2016", "02", "09.json")], [rel for (_, rel) in found])
+
+    def test_rooms_can_be_chosen(self):
+        self.write("a/2016/02/09.json", _line(a="1"))
+        self.write("b/2016/02/09.json", _line(a="1"))
+
+        found = archivescan.find_archives(self.directory, rooms=["b"])
+        self.assertEqual([os.path.join("b", "2016", "02", "09.json")], [rel for (_, rel) in found])
+
+
+class TestScan(_ArchiveTestCase):
+    def scan(self, rule, **keys):
+        matches, errors = archivescan.scan(self.directory, rule, processes=2, **keys)
+        return list(matches), errors
+
+    def test_matches_are_merged_in_time_order(self):
+        self.write("a/2016/02/09.json", _line(a="1", n="a09"))
+        self.write_block("b/2016/02/08.json.gz", DAY - 12 * 3600, [events.Event(a="1", n="b08")])
+        self.write("b/2016/02/09.json", _line(a="2", n="b09"))
+        self.write("legacy", _legacy_line(DAY - 18 * 3600, a="1", n="l08") + _legacy_line(DAY + 6 * 3600, a="1", n="l09"))
+
+        matches, errors = self.scan("a=1")
+        self.assertEqual(
+            [DAY - 18 * 3600, DAY - 12 * 3600, DAY, DAY + 6 * 3600],
+            [timestamp for (timestamp, _, _, _) in matches])
+        self.assertEqual(
+            ["legacy", os.path.join("b", "2016", "02", "08.json.gz"), os.path.join("a", "2016", "02", "09.json"), "legacy"],
+            [rel_path for (_, rel_path, _, _) in matches])
+        self.assertEqual([], errors)
+
+    def test_time_range_limits_timed_lines(self):
+        self.write("legacy", _legacy_line(DAY - 1, a="1") + _legacy_line(DAY, a="1") + _legacy_line(DAY + 86400, a="1"))
+
+        matches, errors = self.scan("a=1", start=DAY, end=DAY + 86400)
+        self.assertEqual([DAY], [timestamp for (timestamp, _, _, _) in matches])
+
+    def test_read_errors_do_not_stop_the_scan(self):
+        member = archivebot._gzip_member(_line(a="1"))
+        self.write("a/2016/02/09.json.gz", member + member[:len(member) // 2] + member)
+        self.write("b/2016/02/09.json", _line(a="1") + "broken\n")
+
+        matches, errors = self.scan("a=1")
+        self.assertEqual(os.path.join("b", "2016", "02", "09.json"), matches[-1][1])
+        self.assertEqual(2, len(errors))
+
+
+class _Result(object):
+    def __init__(self, pool, value):
+        self._pool = pool
+        self._value = value
+
+    def get(self):
+        self._pool.pending -= 1
+        return self._value
+
+
+class _Pool(object):
+    def __init__(self):
+        self.pending = 0
+        self.max_pending = 0
+
+    def apply_async(self, func, args):
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        return _Result(self, args[0])
+
+
+class TestOrderedResults(unittest.TestCase):
+    def test_results_are_in_task_order_within_the_window(self):
+        pool = _Pool()
+        results = list(archivescan._ordered_results(pool, range(10), 3))
+
+        self.assertEqual(range(10), results)
+        self.assertEqual(3, pool.max_pending)
@@ -58,18 +58,22 @@ class AutoshunBot(bot.PollingBot):
 
     feed_url = bot.Param(default=AUTOSHUN_CSV_URL)
     use_cymru_whois = bot.BoolParam()
+    cymru_whois_bulk = bot.BoolParam("""
+        do the Cymru whois lookups in batches over the Team Cymru
+        bulk whois service instead of DNS (with use_cymru_whois)
+        """)
 
     def poll(self):
         pipe = self._poll(url=self.feed_url)
         if self.use_cymru_whois:
-            pipe = pipe | cymruwhois.augment("ip")
+            pipe = pipe | cymruwhois.augment("ip", bulk=self.cymru_whois_bulk)
         return pipe | self._normalize()
 
     @idiokit.stream
     def _poll(self, url):
         self.log.info("Downloading %s" % url)
         try:
-            info, fileobj = yield utils.fetch_url(url)
+            info, fileobj = yield self.fetch_url(url)
         except utils.FetchUrlFailed, fuf:
             self.log.error("Download failed: %r", fuf)
             idiokit.stop()
@@ -46,7 +46,7 @@ class CleanMXBot(bot.PollingBot):
     def poll(self, url, name):
         try:
             self.log.info("Downloading page from: %r", url)
-            info, fileobj = yield utils.fetch_url(url)
+            info, fileobj = yield self.fetch_url(url)
         except utils.FetchUrlFailed, e:
             self.log.error("Failed to download page %r: %r", url, e)
             return
@@ -15,17 +15,21 @@ class BruteForceBlockerBot(bot.PollingBot):
     COLUMNS = ["ip", "time", "count", None]
 
     use_cymru_whois = bot.BoolParam()
+    cymru_whois_bulk = bot.BoolParam("""
+        do the Cymru whois lookups in batches over the Team Cymru
+        bulk whois service instead of DNS (with use_cymru_whois)
+        """)
 
     def poll(self):
         if self.use_cymru_whois:
-            return self._poll() | cymruwhois.augment("ip")
+            return self._poll() | cymruwhois.augment("ip", bulk=self.cymru_whois_bulk)
         return self._poll()
 
     @idiokit.stream
     def _poll(self, url="http://danger.rulez.sk/projects/bruteforceblocker/blist.php"):
         self.log.info("Downloading %s" % url)
         try:
-            info, fileobj = yield utils.fetch_url(url)
+            info, fileobj = yield self.fetch_url(url)
         except utils.FetchUrlFailed, fuf:
             self.log.error("Download failed: %r", fuf)
             idiokit.stop(False)
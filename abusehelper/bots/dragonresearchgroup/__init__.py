@@ -11,20 +11,24 @@ from abusehelper.core import utils, cymruwhois, bot
 class DragonBot(bot.PollingBot):
     url = bot.Param()
     use_cymru_whois = bot.BoolParam()
+    cymru_whois_bulk = bot.BoolParam("""
+        do the Cymru whois lookups in batches over the Team Cymru
+        bulk whois service instead of DNS (with use_cymru_whois)
+        """)
 
     # The first column values (ASN and AS name) are ignored.
     COLUMNS = [None, None, "ip", "time", "category"]
 
     def poll(self):
         if self.use_cymru_whois:
-            return self._poll() | cymruwhois.augment("ip")
+            return self._poll() | cymruwhois.augment("ip", bulk=self.cymru_whois_bulk)
         return self._poll()
 
     @idiokit.stream
     def _poll(self):
         self.log.info("Downloading %s" % self.url)
         try:
-            info, fileobj = yield utils.fetch_url(self.url)
+            info, fileobj = yield self.fetch_url(self.url)
         except utils.FetchUrlFailed, fuf:
             self.log.error("Download failed: %r", fuf)
             return
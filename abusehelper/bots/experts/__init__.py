@@ -60,6 +60,23 @@ def _embed_eids():
 
 
 class Expert(_RoomBot):
+    xmpp_batch_size = bot.IntParam("""
+        how many events to pack into a single XMPP stanza at most
+        (default: %default)
+        """, default=1)
+    xmpp_batch_latency = bot.FloatParam("""
+        how many seconds to wait for a partial batch of events
+        before sending it, when xmpp_batch_size is over 1
+        (default: %default)
+        """, default=0.1)
+    xmpp_omit_body = bot.BoolParam("""
+        leave the human-readable text body out of the sent stanzas
+        """)
+    xmpp_compact_events = bot.BoolParam("""
+        send events in the compact base64 encoded format instead
+        of the legacy format
+        """)
+
     def __init__(self, *args, **keys):
         _RoomBot.__init__(self, *args, **keys)
         self._augments = taskfarm.TaskFarm(self._handle_augment)
@@ -72,7 +89,11 @@ class Expert(_RoomBot):
             _create_eids(),
             self.augment(*args),
             _embed_eids(),
-            events.events_to_elements(),
+            events.events_to_elements(
+                self.xmpp_batch_size,
+                self.xmpp_batch_latency,
+                not self.xmpp_omit_body,
+                self.xmpp_compact_events),
             self.to_room(dst_room)
         )
 
@@ -1,9 +1,30 @@
 import idiokit
-from ...core import events, cymruwhois
+from ...core import bot, events, cymruwhois, pfx2as
 from . import Expert
 
 
 class CymruWhoisExpert(Expert):
+    pfx2as_file = bot.Param("""
+        look up the ASN, BGP prefix and country code offline from
+        this prefix to ASN dump file (see abusehelper.core.pfx2as)
+        instead of the Team Cymru DNS service (default: use DNS)
+        """, default=None)
+    pfx2as_check_interval = bot.FloatParam("""
+        how often to check pfx2as_file for changes and reload it,
+        in seconds (default: %default)
+        """, default=60.0)
+
+    def __init__(self, *args, **keys):
+        Expert.__init__(self, *args, **keys)
+
+        if self.pfx2as_file is None:
+            self._lookup = cymruwhois.lookup
+        else:
+            self._lookup = pfx2as.Pfx2asLookup(
+                self.pfx2as_file,
+                self.pfx2as_check_interval,
+                self.log).lookup
+
     def augment_keys(self, keys=["ip"], **_):
         for key in keys:
             if isinstance(key, basestring):
@@ -18,7 +39,7 @@ class CymruWhoisExpert(Expert):
             eid, event = yield idiokit.next()
 
             for ip in event.values(ip_key):
-                items = yield cymruwhois.lookup(ip)
+                items = yield self._lookup(ip)
                 if not items:
                     continue
 
@@ -69,15 +69,18 @@ class MDLBot(bot.PollingBot):
     def poll(self):
         self.log.info("Downloading updates from {0!r}".format(self.url))
         try:
-            info, fileobj = yield utils.fetch_url(self.url)
+            info, fileobj = yield self.open_url(self.url)
+            try:
+                yield idiokit.pipe(
+                    utils.read_chunks(fileobj),
+                    utils.csv_to_events(columns=self._columns),
+                    idiokit.map(self._normalize))
+            finally:
+                fileobj.close()
         except utils.FetchUrlFailed as fuf:
             raise bot.PollSkipped("Downloading {0!r} failed ({1})".format(self.url, fuf))
         self.log.info("Updates downloaded from {0!r}".format(self.url))
 
-        yield idiokit.pipe(
-            utils.csv_to_events(fileobj, columns=self._columns),
-            idiokit.map(self._normalize))
-
     def _normalize(self, event):
         yield events.Event({
             "feed": "mdl",
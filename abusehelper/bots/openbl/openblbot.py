@@ -20,18 +20,22 @@ def normalize_time(time):
 class OpenBLBot(bot.PollingBot):
     feed_url = bot.Param(default=OPENBL_FEED_URL)
     use_cymru_whois = bot.BoolParam()
+    cymru_whois_bulk = bot.BoolParam("""
+        do the Cymru whois lookups in batches over the Team Cymru
+        bulk whois service instead of DNS (with use_cymru_whois)
+        """)
 
     def poll(self):
         pipe = self._poll(url=self.feed_url)
         if self.use_cymru_whois:
-            pipe = pipe | cymruwhois.augment("ip")
+            pipe = pipe | cymruwhois.augment("ip", bulk=self.cymru_whois_bulk)
         return pipe
 
     @idiokit.stream
     def _poll(self, url):
         self.log.info("Downloading %s" % url)
         try:
-            info, fileobj = yield utils.fetch_url(url)
+            info, fileobj = yield self.fetch_url(url)
         except utils.FetchUrlFailed, fuf:
             raise bot.PollSkipped("failed to download {0!r} ({1})".format(url, fuf))
         self.log.info("Downloaded")
@@ -13,6 +13,10 @@ from abusehelper.core import bot, cymruwhois, events, utils
 class RSSBot(bot.PollingBot):
     feeds = bot.ListParam("a list of RSS feed URLs")
     use_cymru_whois = bot.BoolParam()
+    cymru_whois_bulk = bot.BoolParam("""
+        do the Cymru whois lookups in batches over the Team Cymru
+        bulk whois service instead of DNS (with use_cymru_whois)
+        """)
     http_headers = bot.ListParam("a list of http header (k,v) tuples", default=[])
 
     def __init__(self, *args, **keys):
@@ -24,7 +28,7 @@ class RSSBot(bot.PollingBot):
 
     def poll(self, url):
         if self.use_cymru_whois:
-            return self._poll(url) | cymruwhois.augment()
+            return self._poll(url) | cymruwhois.augment(bulk=self.cymru_whois_bulk)
         return self._poll(url)
 
     @idiokit.stream
@@ -35,7 +39,7 @@ class RSSBot(bot.PollingBot):
 
         try:
             self.log.info('Downloading feed from: "%s"', url)
-            _, fileobj = yield utils.fetch_url(request)
+            _, fileobj = yield self.fetch_url(request)
         except utils.FetchUrlFailed as e:
             self.log.error('Failed to download feed "%s": %r', url, e)
             idiokit.stop(False)
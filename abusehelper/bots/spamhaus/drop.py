@@ -9,19 +9,32 @@ import urllib2
 from abusehelper.core import utils, cymruwhois, bot, events
 
 
+def _netblock_ip(netblock):
+    return netblock.split("/")[0]
+
+
 class SpamhausDropBot(bot.PollingBot):
     use_cymru_whois = bot.BoolParam()
+    cymru_whois_bulk = bot.BoolParam("""
+        do the Cymru whois lookups in batches over the Team Cymru
+        bulk whois service instead of DNS (with use_cymru_whois)
+        """)
     http_headers = bot.ListParam("a list of http header (k, v) tuples", default=[])
 
-    @idiokit.stream
     def poll(self, url="http://www.spamhaus.org/drop/drop.lasso"):
+        if self.use_cymru_whois:
+            return self._poll(url) | cymruwhois.augment("netblock", parser=_netblock_ip, bulk=self.cymru_whois_bulk)
+        return self._poll(url)
+
+    @idiokit.stream
+    def _poll(self, url):
         request = urllib2.Request(url)
         for key, value in self.http_headers:
             request.add_header(key, value)
 
         self.log.info("Downloading %s" % url)
         try:
-            info, fileobj = yield utils.fetch_url(request)
+            info, fileobj = yield self.fetch_url(request)
         except utils.FetchUrlFailed as fuf:
             self.log.error("Download failed: %r", fuf)
             idiokit.stop(False)
@@ -48,11 +61,6 @@ class SpamhausDropBot(bot.PollingBot):
             new.add('feed', 'spamhaus drop list')
             new.add('type', 'hijacked network')
 
-            if self.use_cymru_whois:
-                values = yield cymruwhois.lookup(netblock.split('/')[0])
-                for key, value in values:
-                    new.add(key, value)
-
             yield idiokit.send(new)
 
 if __name__ == "__main__":
@@ -39,7 +39,7 @@ class VxVaultBot(bot.PollingBot):
     def poll(self):
         self.log.info("Downloading {0}".format(self.feed_url))
         try:
-            info, fileobj = yield utils.fetch_url(self.feed_url)
+            info, fileobj = yield self.fetch_url(self.feed_url)
         except utils.FetchUrlFailed as fuf:
             raise bot.PollSkipped("failed to download {0} ({1})".format(self.feed_url, fuf))
         self.log.info("Downloaded")
@@ -0,0 +1,90 @@
+from __future__ import absolute_import
+
+import math
+import struct
+import hashlib
+from base64 import b64encode, b64decode
+
+
+def _to_bytes(item):
+    if isinstance(item, unicode):
+        return item.encode("utf-8")
+    return item
+
+
+class BloomFilter(object):
+    r"""
+    A fixed size Bloom filter sized for the given capacity and false
+    positive rate.
+
+    >>> bloom = BloomFilter(100, 0.01)
+    >>> bloom.add("a")
+    >>> "a" in bloom
+    True
+    >>> "b" in bloom
+    False
+
+    Unicode items are handled as their UTF-8 encoded forms.
+
+    >>> bloom.add(u"\xe4")
+    >>> "\xc3\xa4" in bloom
+    True
+
+    A Bloom filter can be serialized to and parsed from a string.
+
+    >>> copy = BloomFilter.from_string(bloom.to_string())
+    >>> "a" in copy and u"\xe4" in copy
+    True
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        if not 0.0 < error_rate < 1.0:
+            raise ValueError("error rate should be between 0.0 and 1.0")
+
+        capacity = max(capacity, 1)
+        bit_count = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        bit_count = max(bit_count, 8)
+        hash_count = max(int(round(float(bit_count) / capacity * math.log(2))), 1)
+
+        self._init(bit_count, hash_count, bytearray((bit_count + 7) // 8))
+
+    @classmethod
+    def from_string(cls, string):
+        bit_count, hash_count, data = string.split(":", 2)
+
+        bloom = cls.__new__(cls)
+        bloom._init(int(bit_count), int(hash_count), bytearray(b64decode(data)))
+        return bloom
+
+    def _init(self, bit_count, hash_count, bits):
+        self._bit_count = bit_count
+        self._hash_count = hash_count
+        self._bits = bits
+
+    def __getstate__(self):
+        return self._bit_count, self._hash_count, str(self._bits)
+
+    def __setstate__(self, (bit_count, hash_count, data)):
+        self._init(bit_count, hash_count, bytearray(data))
+
+    def to_string(self):
+        return "{0}:{1}:{2}".format(self._bit_count, self._hash_count, b64encode(str(self._bits)))
+
+    def _positions(self, item):
+        # Derive all the bit positions from one digest using the
+        # double hashing scheme h1 + i * h2.
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(_to_bytes(item)).digest())
+        for index in xrange(self._hash_count):
+            yield (h1 + index * h2) % self._bit_count
+
+    def add(self, item):
+        bits = self._bits
+        for position in self._positions(item):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        bits = self._bits
+        for position in self._positions(item):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
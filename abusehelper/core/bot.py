@@ -4,10 +4,13 @@ import os
 import csv
 import sys
 import time
+import random
 import getpass
-import hashlib
 import inspect
 import logging
+import urllib2
+import urlparse
+import collections
 import warnings
 import logging.handlers
 import optparse
@@ -17,7 +20,7 @@ import cPickle as pickle
 import idiokit
 from idiokit.xmpp import connect
 
-from . import log, events, taskfarm, utils, services, version
+from . import log, events, taskfarm, utils, services, version, dedup
 
 
 class ParamError(Exception):
@@ -414,7 +417,47 @@ class ServiceBot(XMPPBot):
                 yield idiokit.consume()
             except idiokit.Signal:
                 raise services.Stop()
-        return idiokit.main_loop(throw_stop_on_signal() | self._run())
+        return idiokit.main_loop(throw_stop_on_signal() | self._run() | self._periodic_stats())
+
+    def _periodic_stats(self, interval=60.0):
+        @idiokit.stream
+        def logger():
+            while True:
+                yield idiokit.sleep(interval)
+                self.log_stats()
+
+        result = idiokit.map(lambda x: (x,))
+        idiokit.pipe(logger(), result)
+        return result
+
+    def log_stats(self):
+        """
+        Log the statistics gathered since the previous call. Called once
+        a minute while the bot runs. Subclasses extending this should
+        call the parent method too.
+        """
+
+        for name, stats in utils.pop_cache_stats():
+            if not any(stats[key] for key in ("hits", "misses", "evictions")):
+                continue
+
+            self.log.info(
+                "Cache {0!r}: {1} hits ({2} negative), {3} misses, {4} evictions, {5} items".format(
+                    name,
+                    stats["hits"],
+                    stats["negative hits"],
+                    stats["misses"],
+                    stats["evictions"],
+                    stats["size"]),
+                event=events.Event({
+                    "type": "cache",
+                    "service": self.bot_name,
+                    "cache": name,
+                    "cache hits": unicode(stats["hits"]),
+                    "cache negative hits": unicode(stats["negative hits"]),
+                    "cache misses": unicode(stats["misses"]),
+                    "cache evictions": unicode(stats["evictions"]),
+                    "cache size": unicode(stats["size"])}))
 
     def main(self, state):
         return idiokit.consume()
@@ -428,6 +471,22 @@ class FeedBot(ServiceBot):
         how many XMPP stanzas the bot can send per second
         (default: no limiting)
         """, default=None)
+    xmpp_batch_size = IntParam("""
+        how many events to pack into a single XMPP stanza at most
+        (default: %default)
+        """, default=1)
+    xmpp_batch_latency = FloatParam("""
+        how many seconds to wait for a partial batch of events
+        before sending it, when xmpp_batch_size is over 1
+        (default: %default)
+        """, default=0.1)
+    xmpp_omit_body = BoolParam("""
+        leave the human-readable text body out of the sent stanzas
+        """)
+    xmpp_compact_events = BoolParam("""
+        send events in the compact base64 encoded format instead
+        of the legacy format
+        """)
 
     def __init__(self, *args, **keys):
         ServiceBot.__init__(self, *args, **keys)
@@ -486,10 +545,15 @@ class FeedBot(ServiceBot):
 
             log.open("Joined " + msg, attrs, status="joined")
             try:
-                tail = self._stats(name) | room | idiokit.consume()
+                tail = room | idiokit.consume()
                 if self.xmpp_rate_limit is not None:
                     tail = self._output_rate_limiter() | tail
-                yield self.augment() | events.events_to_elements() | tail
+                to_elements = events.events_to_elements(
+                    self.xmpp_batch_size,
+                    self.xmpp_batch_latency,
+                    not self.xmpp_omit_body,
+                    self.xmpp_compact_events)
+                yield self.augment() | self._stats(name) | to_elements | tail
             finally:
                 log.close("Left " + msg, attrs, status="left")
 
@@ -535,17 +599,126 @@ class PollSkipped(Exception):
         return self.args[0]
 
 
+class _DedupBackendParam(Param):
+    def parse(self, value):
+        value = value.strip().lower()
+        if value not in dedup.BACKENDS:
+            raise ParamError("expected one of {0}, got {1!r}".format(", ".join(dedup.BACKENDS), value))
+        return value
+
+
+class _ErrorRateParam(FloatParam):
+    def parse(self, value):
+        value = FloatParam.parse(self, value)
+        if not 0.0 < value < 1.0:
+            raise ParamError("expected a rate between 0.0 and 1.0, got " + repr(value))
+        return value
+
+
+class _PollSlots(object):
+    """
+    Limit the number of concurrently running polls, both in total and
+    per host. Polls waiting for a slot get one in the order they asked
+    for it, except that a poll waiting for a busy host doesn't block
+    the polls for other hosts.
+    """
+
+    def __init__(self, limit=None, host_limit=None):
+        self._limit = limit
+        self._host_limit = host_limit
+
+        self._running = 0
+        self._hosts = dict()
+        self._waiters = collections.deque()
+
+    def _available(self, host):
+        if self._limit is not None and self._running >= self._limit:
+            return False
+        if host is None or self._host_limit is None:
+            return True
+        return self._hosts.get(host, 0) < self._host_limit
+
+    def _take(self, host):
+        self._running += 1
+        if host is not None:
+            self._hosts[host] = self._hosts.get(host, 0) + 1
+
+    def _wake(self):
+        for waiter in list(self._waiters):
+            host, event = waiter
+            if self._available(host):
+                self._waiters.remove(waiter)
+                self._take(host)
+                event.succeed()
+
+    def acquire(self, host=None):
+        """
+        Return an event that succeeds when the poll gets a slot. The
+        slot has to be given back with release(), even when the poll
+        is cancelled before getting the slot.
+        """
+
+        waiter = host, idiokit.Event()
+        self._waiters.append(waiter)
+        self._wake()
+        return waiter[1]
+
+    def release(self, host, slot):
+        waiter = host, slot
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+            return
+
+        self._running -= 1
+        if host is not None:
+            self._hosts[host] -= 1
+            if self._hosts[host] <= 0:
+                del self._hosts[host]
+        self._wake()
+
+
 class PollingBot(FeedBot):
     poll_interval = IntParam("""
         wait at least the given amount of seconds before polling
         the data source again (default: %default seconds)
         """, default=3600)
+    poll_concurrency = IntParam("""
+        run at most the given amount of polls concurrently, or
+        any number of them when the value is not positive
+        (default: %default)
+        """, default=1)
+    poll_host_concurrency = IntParam("""
+        run at most the given amount of polls concurrently per
+        host (default: no per-host limit)
+        """, default=None)
+    poll_jitter = FloatParam("""
+        delay the start of each poll by a random amount of at most
+        the given amount of seconds, to spread out the polls
+        (default: %default seconds)
+        """, default=0.0)
+    http_no_conditional_get = BoolParam("""
+        always download the polled resources in full instead of
+        skipping the polls of resources that have not been
+        modified since the previous poll (the ETag and
+        Last-Modified headers of responses are used by default)
+        """)
     ignore_initial_poll = BoolParam("""
         don't send out events collected during the first poll,
         just use them to populate the deduplication filter
         (WARNING: this is an experimental flag that may change
         or be removed without prior notice)
         """)
+    dedup_backend = _DedupBackendParam("""
+        how to store the deduplication filters: "set" keeps full
+        digests in Python sets, "array" keeps 64-bit digests in
+        sorted arrays and "bloom" keeps them in Bloom filters that
+        suppress a new event with the probability given by
+        dedup_error_rate (default: %default)
+        """, default="set")
+    dedup_error_rate = _ErrorRateParam("""
+        false positive rate of the "bloom" deduplication backend
+        (default: %default)
+        """, default=0.001)
 
     def __init__(self, *args, **keys):
         FeedBot.__init__(self, *args, **keys)
@@ -553,31 +726,117 @@ class PollingBot(FeedBot):
         self._poll_queue = utils.WaitQueue()
         self._poll_dedup = dict()
         self._poll_cleanup = dict()
+        self._poll_validators = dict()
+        self._poll_new_validators = dict()
+        self._poll_timings = []
+
+        self._http_pool = utils.KeepAliveHandler()
+        self._http_opener = urllib2.build_opener(self._http_pool)
+
+        limit = self.poll_concurrency if self.poll_concurrency > 0 else None
+        self._poll_slots = _PollSlots(limit, self.poll_host_concurrency)
+
+    def poll_host(self, *key):
+        """
+        Return the host polled for the given feed key, for limiting the
+        number of concurrent polls per host. By default the host is
+        parsed from the first URL in the key, and None (no per-host
+        limit) is returned for keys without URLs.
+        """
+
+        for item in key:
+            if isinstance(item, basestring) and "://" in item:
+                return urlparse.urlparse(item).netloc.lower() or None
+        return None
 
     @idiokit.stream
     def poll(self, *key):
         yield idiokit.sleep(0.0)
 
+    def _polling_key(self, url):
+        # The feed key of the running poll that fetches the given URL:
+        # the poll whose key contains the URL, or the only running poll.
+        # None when this can't be told, and the URL is then fetched
+        # without a conditional GET.
+        keys = list(self._poll_new_validators)
+        matching = [key for key in keys if url in key]
+        if len(matching) == 1:
+            return matching[0]
+        if not matching and len(keys) == 1:
+            return keys[0]
+        return None
+
+    @idiokit.stream
+    def _open(self, open_func, url, timeout, key):
+        full_url = url.get_full_url() if isinstance(url, urllib2.Request) else url
+        if key is None:
+            key = self._polling_key(full_url)
+        if self.http_no_conditional_get or key not in self._poll_new_validators:
+            key = None
+
+        validators = None
+        if key is not None:
+            validators = self._poll_validators.get(key, {}).get(full_url, None)
+
+        try:
+            info, fileobj = yield open_func(url, self._http_opener, timeout=timeout, validators=validators)
+        except utils.FetchUrlNotModified as not_modified:
+            raise PollSkipped(str(not_modified))
+
+        # Stored only after the poll has finished successfully.
+        if key is not None:
+            self._poll_new_validators[key][full_url] = utils.response_validators(info)
+        idiokit.stop(info, fileobj)
+
+    def fetch_url(self, url, timeout=60.0, key=None):
+        """
+        Like utils.fetch_url, but reuse the bot's connections to each host
+        and raise PollSkipped when the resource has not been modified
+        since it was previously fetched by the poll of the same feed key.
+        Use this in poll() instead of utils.fetch_url to avoid downloading
+        and parsing unmodified resources.
+
+        The feed key defaults to the key of the running poll that has the
+        URL as one of its items, or of the only running poll.
+        """
+
+        return self._open(utils.fetch_url, url, timeout, key)
+
+    def open_url(self, url, timeout=60.0, key=None):
+        """
+        Like fetch_url, but return the response as a file object that is
+        read while the body downloads (see utils.open_url).
+        """
+
+        return self._open(utils.open_url, url, timeout, key)
+
     @idiokit.stream
     def dedup(self, key):
         initial_poll = key not in self._poll_dedup
 
-        old_filter = self._poll_dedup.setdefault(key, set())
-        new_filter = set()
+        previous = self._poll_dedup.get(key, None)
+        if previous is not None:
+            previous = dedup.restore(previous, self.dedup_backend, self.dedup_error_rate)
+            if previous is None:
+                self.log.warning("Could not convert the deduplication filter of {0!r} for the {1!r} backend, starting with an empty one".format(
+                    key, self.dedup_backend))
+        poll = dedup.start_poll(previous, self.dedup_backend, self.dedup_error_rate)
 
         while True:
             try:
                 event = yield idiokit.next()
             except StopIteration:
-                self._poll_dedup[key] = new_filter
+                self._poll_dedup[key] = poll.finish()
+                raise
+            except BaseException:
+                # Remember the events a failed poll has already sent.
+                if not initial_poll or not self.ignore_initial_poll:
+                    self._poll_dedup[key] = poll.abort()
                 raise
 
-            event_key = int(events.hexdigest(event, hashlib.md5), 16)
-            if event_key not in old_filter:
+            if poll.is_new(event):
                 if not initial_poll or not self.ignore_initial_poll:
                     yield idiokit.send(event)
-            old_filter.add(event_key)
-            new_filter.add(event_key)
 
     @idiokit.stream
     def feed(self, *key):
@@ -585,10 +844,12 @@ class PollingBot(FeedBot):
             node = self._poll_cleanup.pop(key)
             yield self._poll_queue.cancel(node)
 
+        host = self.poll_host(*key)
         try:
+            delay = random.uniform(0.0, self.poll_jitter)
+            due = time.time() + delay
             waiter = idiokit.Event()
-            result = idiokit.Event()
-            node = yield self._poll_queue.queue(0.0, (False, (waiter, result)))
+            node = yield self._poll_queue.queue(delay, (False, waiter))
 
             while True:
                 try:
@@ -596,25 +857,85 @@ class PollingBot(FeedBot):
                 finally:
                     yield self._poll_queue.cancel(node)
 
+                slot = self._poll_slots.acquire(host)
                 try:
-                    yield self.poll(*key) | self.dedup(key)
-                except PollSkipped as skip:
-                    self.log.info("Poll skipped: {0.reason}".format(skip))
+                    yield slot
+
+                    start = time.time()
+                    self._poll_new_validators[key] = dict()
+                    try:
+                        yield self.poll(*key) | self.dedup(key)
+                    except PollSkipped as skip:
+                        self.log.info("Poll skipped: {0.reason}".format(skip))
+                    else:
+                        self._commit_validators(key)
+                    finally:
+                        self._poll_new_validators.pop(key, None)
+                    self._poll_timings.append((time.time() - start, max(start - due, 0.0), key))
                 finally:
-                    result.succeed()
+                    self._poll_slots.release(host, slot)
 
+                delay = self.poll_interval + random.uniform(0.0, self.poll_jitter)
+                due = time.time() + delay
                 waiter = idiokit.Event()
-                result = idiokit.Event()
-                node = yield self._poll_queue.queue(self.poll_interval, (False, (waiter, result)))
+                node = yield self._poll_queue.queue(delay, (False, waiter))
         finally:
             node = yield self._poll_queue.queue(self.poll_interval, (True, key))
             self._poll_cleanup[key] = node
 
+    def _commit_validators(self, key):
+        validators = self._poll_validators.get(key, {})
+        for url, new in self._poll_new_validators.get(key, {}).iteritems():
+            if new is None:
+                validators.pop(url, None)
+            else:
+                validators[url] = new
+
+        if validators:
+            self._poll_validators[key] = validators
+        else:
+            self._poll_validators.pop(key, None)
+
+    def log_stats(self):
+        FeedBot.log_stats(self)
+
+        timings, self._poll_timings = self._poll_timings, []
+        if not timings:
+            return
+
+        count = len(timings)
+        duration = sum(duration for (duration, _, _) in timings) / count
+        lag = sum(lag for (_, lag, _) in timings) / count
+        max_duration, _, slowest = max(timings)
+        max_lag = max(lag for (_, lag, _) in timings)
+
+        self.log.info(
+            "Finished {0} polls in {1:.2f} seconds on average (at most {2:.2f} seconds, for {3!r}), {4:.2f} seconds after they were due on average (at most {5:.2f} seconds)".format(
+                count, duration, max_duration, slowest, lag, max_lag),
+            event=events.Event({
+                "type": "poll",
+                "service": self.bot_name,
+                "polls": unicode(count),
+                "poll duration": u"{0:.3f}".format(duration),
+                "max poll duration": u"{0:.3f}".format(max_duration),
+                "slowest poll key": repr(slowest),
+                "queue lag": u"{0:.3f}".format(lag),
+                "max queue lag": u"{0:.3f}".format(max_lag)}))
+
     @idiokit.stream
     def main(self, state):
         if state is None:
-            state = dict()
-        self._poll_dedup = state
+            state = dict(), dict()
+        elif isinstance(state, dict):
+            # The state format used before the HTTP validators were saved.
+            state = state, dict()
+        self._poll_dedup, validators = state
+
+        # The validators are kept per feed key, and only for the keys
+        # that have a deduplication filter.
+        self._poll_validators = dict(
+            (key, value) for (key, value) in validators.iteritems()
+            if key in self._poll_dedup and isinstance(value, dict))
 
         if self.ignore_initial_poll:
             self.log.info("Ignoring initial polls")
@@ -628,10 +949,11 @@ class PollingBot(FeedBot):
                 cleanup, arg = yield self._poll_queue.wait()
                 if cleanup:
                     self._poll_dedup.pop(arg, None)
+                    self._poll_validators.pop(arg, None)
                     self._poll_cleanup.pop(arg, None)
                 else:
-                    waiter, result = arg
-                    waiter.succeed()
-                    yield result
+                    arg.succeed()
         except services.Stop:
-            idiokit.stop(self._poll_dedup)
+            idiokit.stop((self._poll_dedup, self._poll_validators))
+        finally:
+            self._http_pool.close()
@@ -0,0 +1,168 @@
+"""
+Caches that depend only on the standard library, so that modules that
+must not pull in idiokit (such as the rule parsers) can use them too.
+The same names are available from abusehelper.core.utils.
+"""
+
+from __future__ import absolute_import
+
+import time
+import weakref
+
+
+_named_caches = weakref.WeakValueDictionary()
+
+_PREV, _NEXT, _KEY, _VALUE, _EXPIRES, _NEGATIVE = range(6)
+
+_CACHE_STATS = ("hits", "negative hits", "misses", "evictions")
+
+
+class LRUCache(object):
+    """
+    A cache that holds at most max_size items (None for no limit),
+    evicting the least recently used items first. Items expire
+    cache_time seconds after they were set, or negative_cache_time
+    seconds when set with negative=True (e.g. for failed lookups).
+
+    >>> cache = LRUCache(60.0, max_size=2)
+    >>> cache.set("a", 1)
+    >>> cache.set("b", 2)
+    >>> cache.get("a", None)
+    1
+    >>> cache.set("c", 3)
+    >>> cache.get("b", None) is None
+    True
+    >>> cache.get("a", None), cache.get("c", None)
+    (1, 3)
+
+    The hit, miss and eviction counts of caches with a name are
+    reported by pop_cache_stats().
+    """
+
+    def __init__(self, cache_time, max_size=None, negative_cache_time=None, name=None):
+        if negative_cache_time is None:
+            negative_cache_time = cache_time
+
+        self.cache_time = cache_time
+        self.negative_cache_time = negative_cache_time
+        self.max_size = max_size
+        self.name = name
+
+        # A circular doubly linked list from the least to the most
+        # recently used item, with self._root as the sentinel.
+        self._items = dict()
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None, None]
+
+        self._sweep_interval = min(cache_time, negative_cache_time)
+        self._next_sweep = time.time() + self._sweep_interval
+
+        self._stats = dict.fromkeys(_CACHE_STATS, 0)
+        if name is not None:
+            _named_caches[id(self)] = self
+
+    def __len__(self):
+        return len(self._items)
+
+    def _unlink(self, link):
+        link[_PREV][_NEXT] = link[_NEXT]
+        link[_NEXT][_PREV] = link[_PREV]
+
+    def _append(self, link):
+        last = self._root[_PREV]
+        link[_PREV] = last
+        link[_NEXT] = self._root
+        last[_NEXT] = link
+        self._root[_PREV] = link
+
+    def _remove(self, link):
+        self._unlink(link)
+        del self._items[link[_KEY]]
+
+    def _sweep(self, now):
+        # Drop the expired items every now and then, as the items that
+        # are not looked up again would otherwise linger until evicted.
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self._sweep_interval
+
+        for link in self._items.values():
+            if link[_EXPIRES] <= now:
+                self._remove(link)
+
+    def get(self, key, default):
+        link = self._items.get(key, None)
+        if link is None:
+            self._stats["misses"] += 1
+            return default
+
+        if link[_EXPIRES] <= time.time():
+            self._remove(link)
+            self._stats["misses"] += 1
+            return default
+
+        self._stats["hits"] += 1
+        if link[_NEGATIVE]:
+            self._stats["negative hits"] += 1
+
+        self._unlink(link)
+        self._append(link)
+        return link[_VALUE]
+
+    def set(self, key, value, negative=False):
+        now = time.time()
+        self._sweep(now)
+
+        cache_time = self.negative_cache_time if negative else self.cache_time
+        link = self._items.get(key, None)
+        if link is None:
+            link = [None, None, key, value, now + cache_time, negative]
+            self._items[key] = link
+        else:
+            link[_VALUE] = value
+            link[_EXPIRES] = now + cache_time
+            link[_NEGATIVE] = negative
+            self._unlink(link)
+        self._append(link)
+
+        if self.max_size is not None:
+            while len(self._items) > self.max_size:
+                self._remove(self._root[_NEXT])
+                self._stats["evictions"] += 1
+
+    def pop_stats(self):
+        """
+        Return a dict of the hit, negative hit, miss and eviction counts
+        since the previous call, and the current number of items.
+        """
+
+        stats, self._stats = self._stats, dict.fromkeys(_CACHE_STATS, 0)
+        stats["size"] = len(self._items)
+        return stats
+
+
+def pop_cache_stats():
+    """
+    Return a list of (name, stats) pairs for the named LRUCache
+    instances, as returned by their pop_stats() methods and summed over
+    the instances sharing a name.
+    """
+
+    totals = dict()
+    for cache in _named_caches.values():
+        stats = cache.pop_stats()
+        if cache.name in totals:
+            for key, value in stats.iteritems():
+                totals[cache.name][key] += value
+        else:
+            totals[cache.name] = stats
+    return sorted(totals.items())
+
+
+class TimedCache(LRUCache):
+    """
+    An LRUCache without a size limit, kept for backwards compatibility.
+    """
+
+    def __init__(self, cache_time):
+        LRUCache.__init__(self, cache_time)
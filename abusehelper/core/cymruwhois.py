@@ -1,12 +1,21 @@
 from __future__ import absolute_import
 
 import socket
+import collections
+
 import idiokit
 from idiokit import dns
 
 from . import utils
 
 
+CACHE_SIZE = 100000
+
+# Failed lookups are cached for a shorter while, so that unresolvable
+# addresses are not queried over and over again.
+NEGATIVE_CACHE_TIME = 5 * 60
+
+
 def _parse_ip(string, families=(socket.AF_INET, socket.AF_INET6)):
     for family in families:
         try:
@@ -48,12 +57,94 @@ def _split(txt_results, keys):
     return tuple(tuple(x) for x in results)
 
 
+class _SingleFlight(object):
+    """
+    Coalesce concurrent calls with the same key so that only the first
+    one runs, and the rest wait for and share its result.
+    """
+
+    def __init__(self):
+        self._pending = dict()
+
+    @idiokit.stream
+    def run(self, key, func, *args):
+        pending = self._pending.get(key, None)
+        if pending is not None:
+            result = yield pending.fork()
+            idiokit.stop(result)
+
+        event = idiokit.Event()
+        self._pending[key] = event
+
+        # The waiters get an empty result if this call fails.
+        result = ()
+        try:
+            result = yield func(*args)
+        finally:
+            del self._pending[key]
+            event.succeed(result)
+        idiokit.stop(result)
+
+
+class _Limit(object):
+    def __init__(self, limit):
+        self._free = limit
+        self._waiters = collections.deque()
+
+    def acquire(self):
+        event = idiokit.Event()
+        if self._free > 0:
+            self._free -= 1
+            event.succeed()
+        else:
+            self._waiters.append(event)
+        return event
+
+    def release(self):
+        if self._waiters:
+            self._waiters.popleft().succeed()
+        else:
+            self._free += 1
+
+
+class _OrderedQueue(object):
+    def __init__(self):
+        self._items = collections.deque()
+        self._waiter = None
+        self._closed = False
+
+    def _wake(self):
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None:
+            waiter.succeed()
+
+    def put(self, item):
+        self._items.append(item)
+        self._wake()
+
+    def close(self):
+        self._closed = True
+        self._wake()
+
+    @idiokit.stream
+    def get(self):
+        while not self._items:
+            if self._closed:
+                idiokit.stop(None)
+            self._waiter = idiokit.Event()
+            yield self._waiter
+        idiokit.stop(self._items.popleft())
+
+
 class ASNameLookup(object):
     _keys = (None, None, None, "as allocated", "as name")
+    _cache_name = "cymruwhois as name"
 
-    def __init__(self, resolver=None, cache_time=4 * 60 * 60):
+    def __init__(self, resolver=None, cache_time=4 * 60 * 60,
+                 cache_size=CACHE_SIZE, negative_cache_time=NEGATIVE_CACHE_TIME):
         self._resolver = resolver
-        self._cache = utils.TimedCache(cache_time)
+        self._cache = utils.LRUCache(cache_time, cache_size, negative_cache_time, self._cache_name)
+        self._single_flight = _SingleFlight()
 
     @idiokit.stream
     def lookup(self, asn):
@@ -66,11 +157,17 @@ class ASNameLookup(object):
         if results is not None:
             idiokit.stop(results)
 
+        results = yield self._single_flight.run(asn, self._query, asn)
+        idiokit.stop(results)
+
+    @idiokit.stream
+    def _query(self, asn):
         try:
             txt_results = yield dns.txt(
                 "AS{0}.asn.cymru.com".format(asn),
                 resolver=self._resolver)
         except dns.DNSError:
+            self._cache.set(asn, (), negative=True)
             idiokit.stop(())
 
         results = _split(txt_results, self._keys)
@@ -80,10 +177,13 @@ class ASNameLookup(object):
 
 class OriginLookup(object):
     _keys = ("asn", "bgp prefix", "cc", "registry", "bgp prefix allocated")
+    _cache_name = "cymruwhois origin"
 
-    def __init__(self, resolver=None, cache_time=4 * 60 * 60):
+    def __init__(self, resolver=None, cache_time=4 * 60 * 60,
+                 cache_size=CACHE_SIZE, negative_cache_time=NEGATIVE_CACHE_TIME):
         self._resolver = resolver
-        self._cache = utils.TimedCache(cache_time)
+        self._cache = utils.LRUCache(cache_time, cache_size, negative_cache_time, self._cache_name)
+        self._single_flight = _SingleFlight()
 
     @idiokit.stream
     def _lookup(self, cache_key, query):
@@ -91,9 +191,15 @@ class OriginLookup(object):
         if results is not None:
             idiokit.stop(results)
 
+        results = yield self._single_flight.run(cache_key, self._query, cache_key, query)
+        idiokit.stop(results)
+
+    @idiokit.stream
+    def _query(self, cache_key, query):
         try:
             txt_results = yield dns.txt(query, resolver=self._resolver)
         except dns.DNSError:
+            self._cache.set(cache_key, (), negative=True)
             idiokit.stop(())
 
         results = []
@@ -105,7 +211,8 @@ class OriginLookup(object):
                 result_dict["asn"] = asn
                 results.append(tuple(result_dict.iteritems()))
 
-        self._cache.set(cache_key, tuple(results))
+        results = tuple(results)
+        self._cache.set(cache_key, results)
         idiokit.stop(results)
 
     @idiokit.stream
@@ -125,34 +232,293 @@ class OriginLookup(object):
         idiokit.stop(())
 
 
-class CymruWhois(object):
-    def __init__(self, resolver=None, cache_time=4 * 60 * 60):
-        self._origin_lookup = OriginLookup(resolver, cache_time)
-        self._asname_lookup = ASNameLookup(resolver, cache_time)
+BULK_ADDRESS = ("whois.cymru.com", 43)
+
+_BULK_KEYS = ("asn", None, "bgp prefix", "cc", "registry", "bgp prefix allocated", "as name")
+
+
+def _parse_bulk_line(line):
+    """
+    Parse a line of verbose bulk whois output into a (normalized IP,
+    items) pair, or return None for lines that are not answers.
 
-    def _ip_values(self, event, keys):
+    >>> ip, items = _parse_bulk_line("64496 | 192.0.2.1 | 192.0.2.0/24 | FI | ripencc | 2016-01-01 | EXAMPLE-AS, FI")
+    >>> ip
+    '192.0.2.1'
+    >>> dict(items)["asn"], dict(items)["as name"]
+    (u'64496', u'EXAMPLE-AS, FI')
+    >>> _parse_bulk_line("NA | 198.51.100.1 | NA | | | | NA")
+    ('198.51.100.1', ())
+    >>> _parse_bulk_line("Bulk mode; whois.cymru.com [2016-02-10 12:00:00 +0000]") is None
+    True
+    """
+
+    pieces = line.split("|")
+    if len(pieces) != len(_BULK_KEYS):
+        return None
+
+    ip = _parse_ip(pieces[1].strip())
+    if ip is None:
+        return None
+
+    decoded = map(lambda x: x.strip().decode("utf-8", "replace"), pieces)
+    asns = decoded[0].split()
+    if not asns or not asns[0].isdigit():
+        return ip, ()
+    decoded[0] = asns[0]
+
+    items = []
+    for key, value in zip(_BULK_KEYS, decoded):
+        if key is None:
+            continue
+        if value in ("", "-", "NA"):
+            continue
+        items.append((key, value))
+    return ip, tuple(items)
+
+
+class _BulkConnection(object):
+    """
+    A blocking client for the Team Cymru bulk whois protocol. The
+    connection is kept open between queries and reopened when the
+    server has closed it.
+    """
+
+    def __init__(self, address=BULK_ADDRESS, timeout=30.0):
+        self._address = address
+        self._timeout = timeout
+
+        self._socket = None
+        self._file = None
+
+    def close(self):
+        sock, self._socket = self._socket, None
+        fileobj, self._file = self._file, None
+        if fileobj is not None:
+            fileobj.close()
+        if sock is not None:
+            sock.close()
+
+    def query(self, ips):
+        """
+        Query the given normalized IP addresses in one batch and return
+        a dict mapping the answered IP addresses to their whois items.
+        """
+
+        if self._socket is not None:
+            try:
+                return self._query(ips)
+            except socket.error:
+                # The server may have dropped the idle connection.
+                self.close()
+
+        sock = socket.create_connection(self._address, self._timeout)
+        self._socket = sock
+        self._file = sock.makefile("rb")
+        try:
+            return self._query(ips)
+        except socket.error:
+            self.close()
+            raise
+
+    def _query(self, ips):
+        lines = ["begin", "verbose"] + list(ips) + ["end"]
+        self._socket.sendall("".join(line + "\n" for line in lines))
+
+        results = dict()
+        remaining = set(ips)
+        answered = False
+        while remaining:
+            try:
+                line = self._file.readline()
+            except socket.timeout:
+                # Keep what was answered, the rest are looked up elsewhere.
+                self.close()
+                break
+
+            if not line:
+                self.close()
+                if not answered:
+                    raise socket.error("connection closed by the server")
+                break
+            answered = True
+
+            parsed = _parse_bulk_line(line)
+            if parsed is None:
+                continue
+
+            ip, items = parsed
+            if ip in remaining:
+                remaining.discard(ip)
+                results[ip] = items
+        return results
+
+
+class BulkLookup(object):
+    """
+    Collect IP addresses looked up concurrently into batches and resolve
+    them over the Team Cymru bulk whois protocol. The addresses the bulk
+    service fails to answer are looked up with the given fallback
+    function, a stream returning the whois items for an IP address.
+    """
+
+    def __init__(self, fallback, address=BULK_ADDRESS, cache_time=4 * 60 * 60,
+                 batch_size=500, batch_latency=0.5, timeout=30.0, cache_size=CACHE_SIZE):
+        self._fallback = fallback
+        self._connection = _BulkConnection(address, timeout)
+        self._cache = utils.LRUCache(cache_time, cache_size, name="cymruwhois bulk")
+        self._batch_size = batch_size
+        self._batch_latency = batch_latency
+
+        self._pending = dict()
+        self._queue = collections.deque()
+        self._flushing = False
+
+    @idiokit.stream
+    def lookup(self, ip):
+        ip = _parse_ip(ip)
+        if ip is None:
+            idiokit.stop(())
+
+        result = self._cache.get(ip, None)
+        if result is not None:
+            idiokit.stop(result)
+
+        event = self._pending.get(ip, None)
+        if event is None:
+            event = idiokit.Event()
+            self._pending[ip] = event
+            self._queue.append(ip)
+
+            if not self._flushing:
+                self._flushing = True
+                self._flush()
+
+        result = yield event.fork()
+        if result is None:
+            result = yield self._fallback(ip)
+        idiokit.stop(result)
+
+    @idiokit.stream
+    def _flush(self):
+        try:
+            while self._queue:
+                if len(self._queue) < self._batch_size:
+                    yield idiokit.sleep(self._batch_latency)
+
+                count = min(self._batch_size, len(self._queue))
+                batch = [self._queue.popleft() for _ in xrange(count)]
+
+                # The waiters get None (and fall back) for the addresses
+                # that didn't get an answer.
+                results = dict()
+                try:
+                    results = yield idiokit.thread(self._connection.query, batch)
+                except socket.error:
+                    pass
+                finally:
+                    for ip in batch:
+                        result = results.get(ip, None)
+                        if result is not None:
+                            self._cache.set(ip, result)
+                        self._pending.pop(ip).succeed(result)
+        finally:
+            self._flushing = False
+
+
+class CymruWhois(object):
+    """
+    Look up the whois information of IP addresses over DNS, or with a
+    bulk address (a (host, port) pair such as BULK_ADDRESS) in batches
+    over the bulk whois protocol, falling back to DNS. The bulk whois
+    service doesn't tell the "as allocated" date.
+    """
+
+    def __init__(self, resolver=None, cache_time=4 * 60 * 60, concurrency=16, bulk=None,
+                 cache_size=CACHE_SIZE, negative_cache_time=NEGATIVE_CACHE_TIME):
+        self._origin_lookup = OriginLookup(resolver, cache_time, cache_size, negative_cache_time)
+        self._asname_lookup = ASNameLookup(resolver, cache_time, cache_size, negative_cache_time)
+        self._concurrency = concurrency
+
+        self._bulk_lookup = None
+        if bulk is not None:
+            self._bulk_lookup = BulkLookup(self._dns_lookup, bulk, cache_time, cache_size=cache_size)
+
+    def _ip_values(self, event, keys, parser):
+        if not keys:
+            return list(event.values(parser=parser))
+
+        values = []
         for key in keys:
-            for value in event.values(key, parser=_parse_ip):
-                yield value
+            values.extend(event.values(key, parser=parser))
+        return values
+
+    def augment(self, *ip_keys, **keys):
+        """
+        Return a stream that augments the passing events with the whois
+        information of the IP addresses in the given keys (or in all
+        keys when no keys are given).
+
+        Up to the CymruWhois instance's concurrency limit of lookups are
+        run concurrently, but the events are sent onwards in the order
+        they came in. An optional parser keyword argument can be used
+        to extract the IP addresses from the values (by default values
+        that are not IP addresses are skipped).
+        """
+
+        parser = keys.pop("parser", _parse_ip)
+        if keys:
+            raise TypeError("unexpected keyword arguments " + ", ".join(map(repr, keys)))
+
+        limit = _Limit(self._concurrency)
+        queue = _OrderedQueue()
+        return idiokit.pipe(
+            self._start_lookups(ip_keys, parser, limit, queue),
+            self._finish_lookups(limit, queue))
+
+    @idiokit.stream
+    def _start_lookups(self, ip_keys, parser, limit, queue):
+        try:
+            while True:
+                try:
+                    event = yield idiokit.next()
+                except StopIteration:
+                    break
+
+                for ip in self._ip_values(event, ip_keys, parser):
+                    yield limit.acquire()
+                    queue.put((event, self.lookup(ip)))
+                queue.put((event, None))
+        finally:
+            queue.close()
 
     @idiokit.stream
-    def augment(self, *ip_keys):
+    def _finish_lookups(self, limit, queue):
         while True:
-            event = yield idiokit.next()
-            if not ip_keys:
-                values = event.values(parser=_parse_ip)
-            else:
-                values = self._ip_values(event, ip_keys)
+            item = yield queue.get()
+            if item is None:
+                break
 
-            for ip in values:
-                items = yield self.lookup(ip)
-                for key, value in items:
-                    event.add(key, value)
+            event, lookup = item
+            if lookup is None:
+                yield idiokit.send(event)
+                continue
 
-            yield idiokit.send(event)
+            try:
+                items = yield lookup
+            finally:
+                limit.release()
+
+            for key, value in items:
+                event.add(key, value)
 
-    @idiokit.stream
     def lookup(self, ip):
+        if self._bulk_lookup is not None:
+            return self._bulk_lookup.lookup(ip)
+        return self._dns_lookup(ip)
+
+    @idiokit.stream
+    def _dns_lookup(self, ip):
         results = yield self._origin_lookup.lookup(ip)
         for result in results:
             result = dict(result)
@@ -168,6 +534,20 @@ class CymruWhois(object):
 
 
 global_whois = CymruWhois()
+global_bulk_whois = CymruWhois(concurrency=500, bulk=BULK_ADDRESS)
+
+
+def augment(*ip_keys, **keys):
+    """
+    Augment the passing events with the shared CymruWhois instance, see
+    CymruWhois.augment. With bulk=True the lookups are done in batches
+    over the bulk whois service.
+    """
+
+    whois = global_bulk_whois if keys.pop("bulk", False) else global_whois
+    return whois.augment(*ip_keys, **keys)
+
 
-augment = global_whois.augment
-lookup = global_whois.lookup
+def lookup(ip, bulk=False):
+    whois = global_bulk_whois if bulk else global_whois
+    return whois.lookup(ip)
@@ -0,0 +1,390 @@
+"""
+Deduplication filters for PollingBot.
+
+The "set" backend keeps the full 128-bit MD5 digest of each seen event
+in a Python set. The compact backends keep only a truncated 64-bit
+digest per event: the "array" backend as a sorted array of machine
+integers (8 bytes per event) and the "bloom" backend as a Bloom filter
+(roughly 1.2 bytes per event for a 1% false positive rate). A false
+positive in the Bloom filter means that a new event is mistaken for an
+already seen one and suppressed.
+
+During a poll the compact backends keep the digests seen so far in
+sorted arrays too, so that the peak memory use stays at roughly 8 bytes
+per event (plus the previous poll's filter) instead of the size of a
+Python set.
+
+When a poll fails partway, all backends keep the previous poll's filter
+extended with the events seen so far, so that the events already sent
+are not sent again by the next poll.
+"""
+
+from __future__ import absolute_import
+
+import heapq
+import struct
+import bisect
+import hashlib
+from array import array
+
+from . import bloom, events
+
+
+BACKENDS = ("set", "array", "bloom")
+
+
+def _digest_typecode():
+    for typecode in ("L", "Q"):
+        try:
+            if array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    return "L"
+
+
+# Python 2 doesn't have the "Q" typecode, but "unsigned long" is 64 bits
+# wide on the common 64-bit platforms. Elsewhere the digests are truncated
+# to the width of the chosen type.
+_TYPECODE = _digest_typecode()
+_DIGEST_BITS = 8 * array(_TYPECODE).itemsize
+
+
+def event_digest(event):
+    """
+    Return the truncated digest the compact backends use for an event.
+
+    >>> event_digest(events.Event(a="b")) == event_digest(events.Event(a="b"))
+    True
+    >>> event_digest(events.Event(a="b")) == event_digest(events.Event(a="c"))
+    False
+    """
+
+    return int(events.hexdigest(event, hashlib.md5)[:_DIGEST_BITS // 4], 16)
+
+
+def _unique(sorted_digests):
+    previous = None
+    for digest in sorted_digests:
+        if digest != previous:
+            yield digest
+            previous = digest
+
+
+def _sorted_unique(digests):
+    return array(_TYPECODE, _unique(sorted(digests)))
+
+
+def _merge_sorted(*arrays):
+    # Merge sorted arrays without building intermediate lists.
+    result = array(_TYPECODE)
+    result.extend(_unique(heapq.merge(*arrays)))
+    return result
+
+
+def _contains(digests, digest):
+    index = bisect.bisect_left(digests, digest)
+    return index < len(digests) and digests[index] == digest
+
+
+class DigestArray(object):
+    """
+    An immutable set of digests stored as a sorted array.
+
+    >>> digests = DigestArray([3, 1, 2, 1])
+    >>> len(digests)
+    3
+    >>> 2 in digests
+    True
+    >>> 4 in digests
+    False
+    >>> list(digests)
+    [1L, 2L, 3L]
+    """
+
+    def __init__(self, digests=()):
+        self._digests = _sorted_unique(digests)
+
+    @classmethod
+    def _from_sorted(cls, digests):
+        # Take the ownership of an array that is already sorted and
+        # has no duplicates, skipping the sort.
+        self = cls.__new__(cls)
+        self._digests = digests
+        return self
+
+    def __len__(self):
+        return len(self._digests)
+
+    def __iter__(self):
+        return iter(self._digests)
+
+    def __contains__(self, digest):
+        return _contains(self._digests, digest)
+
+    # The default pickling of arrays goes through a list of Python
+    # integers, so pickle the raw machine representation instead.
+
+    def __getstate__(self):
+        return self._digests.typecode, self._digests.tostring()
+
+    def __setstate__(self, (typecode, data)):
+        self._digests = array(typecode)
+        self._digests.fromstring(data)
+
+
+class DigestBloom(object):
+    """
+    A set of digests stored in a Bloom filter. Contains all the added
+    digests, and other digests with the given false positive rate.
+
+    >>> digests = DigestBloom([1, 2, 3], 0.001)
+    >>> len(digests)
+    3
+    >>> 2 in digests
+    True
+    >>> 4 in digests
+    False
+    """
+
+    def __init__(self, digests, error_rate):
+        if isinstance(digests, DigestArray):
+            digests = digests._digests
+        else:
+            digests = _sorted_unique(digests)
+
+        self._count = len(digests)
+        self._bloom = bloom.BloomFilter(self._count, error_rate)
+        for digest in digests:
+            self._bloom.add(struct.pack(">Q", digest))
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, digest):
+        return struct.pack(">Q", digest) in self._bloom
+
+
+class DigestUnion(object):
+    """
+    A set of digests made of several filters, kept after a failed poll
+    that had a Bloom filter from the previous poll.
+
+    >>> digests = DigestUnion([DigestBloom([1, 2], 0.001), DigestArray([3])])
+    >>> len(digests)
+    3
+    >>> 3 in digests, 4 in digests
+    (True, False)
+    """
+
+    def __init__(self, filters):
+        self._filters = []
+        for digest_filter in filters:
+            if isinstance(digest_filter, DigestUnion):
+                self._filters.extend(digest_filter._filters)
+            else:
+                self._filters.append(digest_filter)
+
+    def __len__(self):
+        return sum(len(digest_filter) for digest_filter in self._filters)
+
+    def __contains__(self, digest):
+        for digest_filter in self._filters:
+            if digest in digest_filter:
+                return True
+        return False
+
+
+class _SetPoll(object):
+    def __init__(self, previous):
+        self._old = previous
+        self._new = set()
+
+    def is_new(self, event):
+        digest = int(events.hexdigest(event, hashlib.md5), 16)
+        is_new = digest not in self._old
+        self._old.add(digest)
+        self._new.add(digest)
+        return is_new
+
+    def finish(self):
+        return self._new
+
+    def abort(self):
+        # The previous set already contains the digests of this poll.
+        return self._old
+
+
+class _DigestRuns(object):
+    """
+    A growing set of digests kept in sorted arrays ("runs"), like in a
+    log-structured merge tree. New digests go to a small buffer that is
+    sorted into a new run when full, and runs of similar sizes are
+    merged, so that there are O(log n) runs and a lookup is a binary
+    search per run.
+
+    >>> runs = _DigestRuns(buffer_size=2)
+    >>> for digest in [5, 3, 9, 1, 7]:
+    ...     runs.add(digest)
+    >>> 3 in runs, 7 in runs, 4 in runs
+    (True, True, False)
+    >>> list(runs.finish())
+    [1L, 3L, 5L, 7L, 9L]
+    """
+
+    def __init__(self, buffer_size=4096):
+        self._buffer_size = buffer_size
+        self._buffer = set()
+        self._runs = []
+
+    def __len__(self):
+        return len(self._buffer) + sum(len(run) for run in self._runs)
+
+    def __contains__(self, digest):
+        if digest in self._buffer:
+            return True
+        for run in self._runs:
+            if _contains(run, digest):
+                return True
+        return False
+
+    def add(self, digest):
+        self._buffer.add(digest)
+        if len(self._buffer) >= self._buffer_size:
+            self._flush()
+
+    def _flush(self):
+        run = array(_TYPECODE, sorted(self._buffer))
+        self._buffer = set()
+
+        while self._runs and len(self._runs[-1]) <= 2 * len(run):
+            run = _merge_sorted(self._runs.pop(), run)
+        self._runs.append(run)
+
+    def finish(self):
+        """
+        Return all the digests as one sorted array.
+        """
+
+        if self._buffer:
+            self._flush()
+        runs, self._runs = self._runs, []
+
+        if not runs:
+            return array(_TYPECODE)
+        if len(runs) == 1:
+            return runs[0]
+        return _merge_sorted(*runs)
+
+
+class _CompactPoll(object):
+    def __init__(self, previous, build, merge):
+        self._old = previous
+        self._build = build
+        self._merge = merge
+
+        # All digests of this poll, for suppressing duplicates within
+        # this poll and for building the next poll's filter.
+        self._seen = _DigestRuns()
+
+    def is_new(self, event):
+        digest = event_digest(event)
+        if digest in self._seen:
+            return False
+
+        self._seen.add(digest)
+        return digest not in self._old
+
+    def finish(self):
+        seen, self._seen = self._seen, None
+        return self._build(DigestArray._from_sorted(seen.finish()))
+
+    def abort(self):
+        seen, self._seen = self._seen, None
+        if not len(seen):
+            return self._old
+        return self._merge(self._old, DigestArray._from_sorted(seen.finish()))
+
+
+def _merge_arrays(previous, digests):
+    return DigestArray._from_sorted(_merge_sorted(previous, digests))
+
+
+def _merge_blooms(previous, digests):
+    return DigestUnion([previous, digests])
+
+
+def restore(previous, backend="set", error_rate=0.01):
+    """
+    Return the filter of a previous poll converted for the given backend,
+    or None when the conversion is not possible. Filters can be converted
+    from the "set" backend to the compact backends and from the "array"
+    backend to the "bloom" backend, but not back.
+
+    >>> legacy = set([int(events.hexdigest(events.Event(a="b"), hashlib.md5), 16)])
+    >>> event_digest(events.Event(a="b")) in restore(legacy, "array")
+    True
+    >>> restore(DigestArray(), "set") is None
+    True
+    """
+
+    if backend == "set":
+        if isinstance(previous, set):
+            return previous
+        return None
+
+    if isinstance(previous, DigestUnion):
+        if backend == "bloom":
+            return previous
+        return None
+
+    if isinstance(previous, set):
+        shift = 128 - _DIGEST_BITS
+        previous = DigestArray(digest >> shift for digest in previous)
+
+    if backend == "array":
+        if isinstance(previous, DigestArray):
+            return previous
+        return None
+
+    if backend == "bloom":
+        if isinstance(previous, DigestArray):
+            return DigestBloom(previous, error_rate)
+        if isinstance(previous, DigestBloom):
+            return previous
+        return None
+
+    raise ValueError("unknown deduplication backend " + repr(backend))
+
+
+def start_poll(previous=None, backend="set", error_rate=0.01):
+    """
+    Return an object for deduplicating the events of a new poll against
+    the previous poll's filter, already converted for the backend with
+    restore(), or None. Its is_new(event) method tells whether an event
+    was seen neither in the previous poll nor earlier in this one, and its
+    finish() method returns the filter for the next poll. When the poll
+    fails, its abort() method returns the previous filter extended with
+    the events seen so far instead.
+
+    >>> first = start_poll(None, "array")
+    >>> first.is_new(events.Event(a="b")), first.is_new(events.Event(a="b"))
+    (True, False)
+    >>> second = start_poll(first.finish(), "array")
+    >>> second.is_new(events.Event(a="b")), second.is_new(events.Event(a="c"))
+    (False, True)
+    """
+
+    if backend == "set":
+        return _SetPoll(set() if previous is None else previous)
+    if backend == "array":
+        return _CompactPoll(
+            DigestArray() if previous is None else previous,
+            lambda digests: digests,
+            _merge_arrays)
+    if backend == "bloom":
+        return _CompactPoll(
+            DigestArray() if previous is None else previous,
+            lambda digests: DigestBloom(digests, error_rate),
+            _merge_blooms)
+    raise ValueError("unknown deduplication backend " + repr(backend))
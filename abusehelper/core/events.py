@@ -1,11 +1,13 @@
 import re
+import time
 import hashlib
 import inspect
 import collections
 
-from base64 import b64decode
+from base64 import b64encode, b64decode
 
 import idiokit
+from idiokit import timer
 from idiokit.xmlcore import Element, Elements
 
 
@@ -36,6 +38,8 @@ def _normalize(value):
     UnicodeDecodeError: ...
     """
 
+    if type(value) is unicode:
+        return value
     if isinstance(value, basestring):
         return unicode(value)
 
@@ -86,15 +90,38 @@ class Event(object):
 
     _UNDEFINED = object()
 
+    @classmethod
+    def _from_trusted(cls, attrs):
+        """Return a new event that takes the ownership of attrs.
+
+        The attrs should be a dictionary mapping unicode keys to non-empty
+        sets of unicode values. Neither the keys nor the values are
+        normalized or copied, so the caller must make sure that the values
+        are already correct and that the dictionary or the sets are not
+        used afterwards.
+
+        >>> Event._from_trusted({u"a": set([u"b"])}) == Event(a="b")
+        True
+        """
+
+        event = cls.__new__(cls)
+        event._init(attrs)
+        return event
+
     @classmethod
     def _itemize(cls, *args, **keys):
         result = dict()
 
+        if not keys and len(args) == 1 and isinstance(args[0], Event):
+            for key, values in args[0]._attrs.iteritems():
+                result[key] = set(values)
+            return result
+
         for obj in args + (keys,):
-            if type(obj) == Event:
+            if isinstance(obj, Event):
                 for key, values in obj._attrs.iteritems():
                     if key not in result:
-                        result[key] = values.copy()
+                        result[key] = set(values)
                     else:
                         result[key].update(values)
                 continue
@@ -186,24 +213,35 @@ class Event(object):
         True
         """
 
-        # Future event format
+        # Future event format. The decoded keys and values are already
+        # unicode, so the event can be built without normalizing them again.
         for event_element in elements.children("e", EVENT_NS):
-            attrs = collections.defaultdict(list)
+            attrs = dict()
             for key_element in event_element.children("k").with_attrs("a"):
-                key = b64decode(key_element.get_attr("a")).decode("utf-8")
+                values = set()
                 for value_element in key_element.children("v").with_attrs("a"):
-                    value = b64decode(value_element.get_attr("a")).decode("utf-8")
-                    attrs[key].append(value)
-            yield Event(attrs)
+                    values.add(b64decode(value_element.get_attr("a")).decode("utf-8"))
+                if not values:
+                    continue
+
+                key = b64decode(key_element.get_attr("a")).decode("utf-8")
+                if key in attrs:
+                    attrs[key].update(values)
+                else:
+                    attrs[key] = values
+            yield Event._from_trusted(attrs)
 
         # Legacy event format
         for event_element in elements.children("event", EVENT_NS):
-            attrs = collections.defaultdict(list)
+            attrs = dict()
             for attr in event_element.children("attr").with_attrs("key", "value"):
-                key = attr.get_attr("key")
-                value = attr.get_attr("value")
-                attrs[key].append(value)
-            yield Event(attrs)
+                key = _normalize(attr.get_attr("key"))
+                value = _normalize(attr.get_attr("value"))
+                if key in attrs:
+                    attrs[key].add(value)
+                else:
+                    attrs[key] = set([value])
+            yield Event._from_trusted(attrs)
 
     def __init__(self, *args, **keys):
         """
@@ -215,7 +253,10 @@ class Event(object):
         ((u'\\xe4', u'\\xe4'),)
         """
 
-        self._attrs = self._itemize(*args, **keys)
+        self._init(self._itemize(*args, **keys))
+
+    def _init(self, attrs):
+        self._attrs = attrs
 
     def union(self, *args, **keys):
         """Return a new event that contains all key-value pairs from
@@ -225,7 +266,7 @@ class Event(object):
         [(u'a', u'1'), (u'a', u'2'), (u'a', u'3')]
         """
 
-        return type(self)(self, *args, **keys)
+        return self._from_trusted(self._itemize(self, *args, **keys))
 
     def difference(self, *args, **keys):
         """Return a new event that contains all key-value pairs
@@ -242,7 +283,7 @@ class Event(object):
             diff = values.difference(other.get(key, ()))
             if diff:
                 result[key] = diff
-        return type(self)(result)
+        return self._from_trusted(result)
 
     def add(self, key, value, *values):
         """Add value(s) for a key.
@@ -626,14 +667,36 @@ class Event(object):
         return tuple(key for key in self._attrs
                      if self.contains(key, parser=parser, filter=filter))
 
-    def to_elements(self, include_body=True):
-        element = Element("event", xmlns=EVENT_NS)
+    def to_elements(self, include_body=True, compact=False):
+        """Serialize the event to XML elements.
 
-        for key, value in self.items():
-            key = _replace_non_xml_chars(key)
-            value = _replace_non_xml_chars(value)
-            attr = Element("attr", key=key, value=value)
-            element.add(attr)
+        By default the event is written in the legacy <event> format and
+        accompanied with a human-readable <body>. With compact=True the
+        event is written in the base64 encoded <e> format understood by
+        from_elements. The compact format preserves also the characters
+        that can not appear in XML.
+
+        >>> event = Event({u"\\uffff": [u"\\x05", u"b"]})
+        >>> element = Element("message")
+        >>> element.add(event.to_elements(include_body=False, compact=True))
+        >>> list(Event.from_elements(element)) == [event]
+        True
+        """
+
+        if compact:
+            element = Element("e", xmlns=EVENT_NS)
+            for key, values in self._attrs.iteritems():
+                key_element = Element("k", a=b64encode(key.encode("utf-8")))
+                for value in values:
+                    key_element.add(Element("v", a=b64encode(value.encode("utf-8"))))
+                element.add(key_element)
+        else:
+            element = Element("event", xmlns=EVENT_NS)
+            for key, value in self.items():
+                key = _replace_non_xml_chars(key)
+                value = _replace_non_xml_chars(value)
+                attr = Element("attr", key=key, value=value)
+                element.add(attr)
 
         if not include_body:
             return element
@@ -642,6 +705,19 @@ class Event(object):
         body.text = _replace_non_xml_chars(unicode(self))
         return Elements(body, element)
 
+    def freeze(self):
+        """Return an immutable FrozenEvent copy of the event.
+
+        >>> event = Event(a="b")
+        >>> frozen = event.freeze()
+        >>> frozen == event
+        True
+        >>> frozen.freeze() is frozen
+        True
+        """
+
+        return FrozenEvent(self)
+
     def __reduce__(self):
         return self.__class__, (self._attrs,)
 
@@ -677,6 +753,114 @@ class Event(object):
         return self.__class__.__name__ + "(" + repr(attrs) + ")"
 
 
+_INTERNED_KEYS = dict()
+_MAX_INTERNED_KEYS = 2 ** 14
+
+
+def _intern_key(key):
+    interned = _INTERNED_KEYS.get(key, None)
+    if interned is not None:
+        return interned
+
+    if len(_INTERNED_KEYS) < _MAX_INTERNED_KEYS:
+        _INTERNED_KEYS[key] = key
+    return key
+
+
+class FrozenEvent(Event):
+    """An immutable event that caches its canonical forms.
+
+    Frozen events share the interned key objects and store their values as
+    frozensets. The sorted key-value pairs, the unicode representation, the
+    hash and the digests calculated by hexdigest(...) are calculated at most
+    once per frozen event.
+
+    >>> event = FrozenEvent(b="2", a=["1", "3"])
+    >>> event.items()
+    ((u'a', u'1'), (u'a', u'3'), (u'b', u'2'))
+    >>> unicode(event)
+    u'a=1, a=3, b=2'
+    >>> event == Event(a=["1", "3"], b="2")
+    True
+    >>> hash(event) == hash(FrozenEvent(a=["1", "3"], b="2"))
+    True
+
+    Methods that would modify the event raise a TypeError.
+
+    >>> event.add("c", "4")
+    Traceback (most recent call last):
+        ...
+    TypeError: FrozenEvent objects are immutable
+
+    Methods that return new events return frozen events.
+
+    >>> event.union(c="4") == FrozenEvent(a=["1", "3"], b="2", c="4")
+    True
+    >>> type(event.union(c="4")).__name__
+    'FrozenEvent'
+    """
+
+    # Effective only because Event defines __slots__ as well, see
+    # TestFrozenEvent.test_no_instance_dict.
+    __slots__ = ["_items", "_unicode", "_digests", "_hash"]
+
+    def _init(self, attrs):
+        self._attrs = dict((_intern_key(key), frozenset(values)) for (key, values) in attrs.iteritems())
+
+        self._items = None
+        self._unicode = None
+        self._digests = None
+        self._hash = None
+
+    def _immutable(self, *args, **keys):
+        raise TypeError("FrozenEvent objects are immutable")
+
+    add = update = discard = clear = pop = _immutable
+
+    def freeze(self):
+        return self
+
+    def items(self, parser=None, filter=None):
+        if parser is not None or filter is not None:
+            return Event.items(self, parser, filter)
+
+        if self._items is None:
+            self._items = tuple(sorted(Event.items(self)))
+        return self._items
+
+    def hexdigest(self, func):
+        if self._digests is None:
+            self._digests = dict()
+
+        digest = self._digests.get(func, None)
+        if digest is None:
+            digest = _hexdigest(self.items(), func)
+            self._digests[func] = digest
+        return digest
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(self.items())
+        return self._hash
+
+    def __unicode__(self):
+        if self._unicode is None:
+            self._unicode = Event.__unicode__(self)
+        return self._unicode
+
+
+def _hexdigest(items, func):
+    result = func()
+
+    for key, value in sorted(items):
+        result.update(key.encode("utf-8"))
+        result.update("\xc0")
+        result.update(value.encode("utf-8"))
+        result.update("\xc0")
+
+    return result.hexdigest()
+
+
 def hexdigest(event, func=hashlib.sha1):
     """Return a hexadecimal digest string created by from the given event's
     key-value pairs.
@@ -713,22 +897,234 @@ def hexdigest(event, func=hashlib.sha1):
     >>> import hashlib
     >>> hexdigest(Event(a="b"), hashlib.sha1)
     'edf6294fc1d3f9fe8be4a2d5626788bcfde05e62'
+
+    The digests of frozen events are calculated only once per hash function.
+
+    >>> hexdigest(FrozenEvent(a="b"), hashlib.sha1)
+    'edf6294fc1d3f9fe8be4a2d5626788bcfde05e62'
     """
 
-    result = func()
+    if isinstance(event, FrozenEvent):
+        return event.hexdigest(func)
+    return _hexdigest(event.items(), func)
 
-    for key, value in sorted(event.items()):
-        result.update(key.encode("utf-8"))
-        result.update("\xc0")
-        result.update(value.encode("utf-8"))
-        result.update("\xc0")
 
-    return result.hexdigest()
+def _encode_varint(num):
+    r"""
+    Return a non-negative integer encoded as a little-endian base 128 varint.
+
+    >>> _encode_varint(0)
+    '\x00'
+    >>> _encode_varint(300)
+    '\xac\x02'
+    """
+
+    if num < 0x80:
+        return chr(num)
+
+    result = []
+    while num >= 0x80:
+        result.append(chr((num & 0x7f) | 0x80))
+        num >>= 7
+    result.append(chr(num))
+    return "".join(result)
+
+
+def _decode_varint(data, index):
+    r"""
+    Return a (num, index) pair, where num is the varint decoded from the given
+    index of the data and index points to the byte following the varint.
+
+    >>> _decode_varint("\xac\x02", 0)
+    (300, 2)
+    """
+
+    byte = ord(data[index])
+    if byte < 0x80:
+        return byte, index + 1
+
+    num = 0
+    shift = 0
+    while byte >= 0x80:
+        num |= (byte & 0x7f) << shift
+        shift += 7
+        index += 1
+        byte = ord(data[index])
+    return num | (byte << shift), index + 1
+
+
+class EventEncoder(object):
+    r"""
+    Encode events into a compact binary form decodable with EventDecoder.
+
+    Keys and values are written as varint length prefixed UTF-8 strings.
+    Each encoder keeps a dictionary of the keys it has already written, and
+    repeated keys are written as small integer references to the dictionary
+    instead. Therefore an encoder and the decoder on the other end of a
+    connection must process the same events in the same order.
+
+    >>> encoder = EventEncoder()
+    >>> decoder = EventDecoder()
+    >>> first = encoder.encode(Event(a=["1", "2"], b="3"))
+    >>> second = encoder.encode(Event(a="1"))
+    >>> len(second) < len(first)
+    True
+    >>> decoder.decode(first) == Event(a=["1", "2"], b="3")
+    True
+    >>> decoder.decode(second) == Event(a="1")
+    True
+
+    The key dictionary holds at most max_keys keys. Once it is full any new
+    keys are written out in full every time.
+
+    >>> encoder = EventEncoder(max_keys=0)
+    >>> decoder = EventDecoder(max_keys=0)
+    >>> decoder.decode(encoder.encode(Event({u"\xe4": u"\xe4"}))) == Event({u"\xe4": u"\xe4"})
+    True
+    """
+
+    def __init__(self, max_keys=4096):
+        self._max_keys = max_keys
+        self._keys = dict()
+
+    def _encode_string(self, string):
+        string = string.encode("utf-8")
+        return _encode_varint(len(string)) + string
+
+    def encode(self, event):
+        keys = self._keys
+        encode_string = self._encode_string
+
+        result = [_encode_varint(len(event._attrs))]
+        for key, values in event._attrs.iteritems():
+            key_id = keys.get(key, None)
+            if key_id is not None:
+                result.append(_encode_varint(key_id + 1))
+            else:
+                result.append("\x00")
+                result.append(encode_string(key))
+                if len(keys) < self._max_keys:
+                    keys[key] = len(keys)
+
+            result.append(_encode_varint(len(values)))
+            for value in values:
+                result.append(encode_string(value))
+        return "".join(result)
+
+
+class EventDecoder(object):
+    def __init__(self, max_keys=4096):
+        self._max_keys = max_keys
+        self._keys = []
+
+    def _decode_string(self, data, index):
+        length, index = _decode_varint(data, index)
+        end = index + length
+        return data[index:end].decode("utf-8"), end
+
+    def decode(self, data):
+        keys = self._keys
+        decode_string = self._decode_string
+
+        attrs = dict()
+
+        key_count, index = _decode_varint(data, 0)
+        for _ in xrange(key_count):
+            key_id, index = _decode_varint(data, index)
+            if key_id > 0:
+                key = keys[key_id - 1]
+            else:
+                key, index = decode_string(data, index)
+                if len(keys) < self._max_keys:
+                    keys.append(key)
+
+            value_count, index = _decode_varint(data, index)
+            values = set()
+            for _ in xrange(value_count):
+                value, index = decode_string(data, index)
+                values.add(value)
+            attrs[key] = values
+
+        # The decoded keys and values are unicode already, so skip the
+        # normalization done by Event.__init__.
+        return Event._from_trusted(attrs)
 
 
 def stanzas_to_events():
     return idiokit.map(Event.from_elements)
 
 
-def events_to_elements():
-    return idiokit.map(lambda x: (x.to_elements(),))
+def join_elements(elements, bodies=None):
+    """Return XML elements for sending several serialized events in a
+    single message.
+
+    The elements should be the events serialized with
+    to_elements(include_body=False). When a list of body texts (e.g.
+    unicode(event) for each event) is given, they are joined into a single
+    message body, one line per event. Otherwise the message will not have
+    a body.
+    """
+
+    if bodies is None:
+        return Elements(*elements)
+
+    body = Element("body")
+    body.text = _replace_non_xml_chars(u"\n".join(bodies))
+    return Elements(body, *elements)
+
+
+@idiokit.stream
+def batch(batch_size, batch_latency):
+    """Collect the incoming objects into lists of at most batch_size
+    objects. A list is sent when it is full or when its oldest object has
+    waited for batch_latency seconds, and when the input ends.
+    """
+
+    items = []
+    deadline = None
+
+    while True:
+        try:
+            if items:
+                timeout = max(0.0, deadline - time.time())
+                item = yield timer.timeout(timeout, idiokit.next())
+            else:
+                item = yield idiokit.next()
+        except timer.Timeout:
+            sent, items, deadline = items, [], None
+            yield idiokit.send(sent)
+            continue
+        except StopIteration:
+            if items:
+                yield idiokit.send(items)
+            raise
+
+        if not items:
+            deadline = time.time() + batch_latency
+        items.append(item)
+
+        if len(items) >= batch_size:
+            sent, items, deadline = items, [], None
+            yield idiokit.send(sent)
+
+
+def events_to_elements(batch_size=1, batch_latency=0.0, include_body=True, compact=False):
+    """Serialize events to XML elements, one message per event by default.
+    See Event.to_elements for include_body and compact.
+
+    With batch_size > 1 up to batch_size events are packed into a single
+    message, waiting at most batch_latency seconds for the message to
+    fill up. Receivers using Event.from_elements will see the events
+    just like they were sent one by one.
+    """
+
+    if batch_size <= 1:
+        return idiokit.map(lambda x: (x.to_elements(include_body, compact),))
+
+    def _join(events):
+        elements = [event.to_elements(False, compact) for event in events]
+        if not include_body:
+            return (join_elements(elements),)
+        return (join_elements(elements, [unicode(event) for event in events]),)
+
+    return batch(batch_size, batch_latency) | idiokit.map(_join)
@@ -0,0 +1,327 @@
+"""
+An offline backend for the cymruwhois lookups, answering from a local
+prefix to origin ASN dump instead of the Team Cymru services.
+
+The dump is a text file (gzipped when the name ends with ".gz") with one
+prefix per line, either in the CAIDA Routeviews pfx2as format:
+
+    192.0.2.0   24  64496
+
+or with a CIDR prefix, optionally followed by a country code:
+
+    2001:db8::/32 64497 FI
+
+Multi-origin ASN fields such as "64496_64497" or "64496,64497" resolve
+to the first ASN. Empty lines and lines starting with "#" are ignored.
+
+Updated dumps should be written to a temporary file and renamed over
+the old one, so that a half-written dump is never loaded.
+"""
+
+from __future__ import absolute_import
+
+import os
+import re
+import gzip
+import time
+import socket
+import struct
+import bisect
+from array import array
+
+import idiokit
+
+
+_ASN_SEPARATOR = re.compile(r"[_,]")
+
+_FAMILIES = ((socket.AF_INET, 32), (socket.AF_INET6, 128))
+
+
+def _ip_to_int(family, string):
+    packed = socket.inet_pton(family, string)
+    if family == socket.AF_INET:
+        return struct.unpack("!I", packed)[0]
+    high, low = struct.unpack("!QQ", packed)
+    return (high << 64) | low
+
+
+def _int_to_ip(family, number):
+    if family == socket.AF_INET:
+        packed = struct.pack("!I", number)
+    else:
+        packed = struct.pack("!QQ", number >> 64, number & 0xffffffffffffffff)
+    return socket.inet_ntop(family, packed)
+
+
+def _parse_line(line):
+    fields = line.split()
+    if not fields or fields[0].startswith("#"):
+        return None
+
+    if "/" in fields[0]:
+        address, _, length = fields[0].partition("/")
+        rest = fields[1:]
+    else:
+        address, length, rest = fields[0], fields[1:2], fields[2:]
+        length = length[0] if length else ""
+    if not rest:
+        raise ValueError("missing ASN")
+
+    asn = _ASN_SEPARATOR.split(rest[0])[0]
+    if not asn.isdigit():
+        raise ValueError("invalid ASN " + repr(rest[0]))
+    cc = rest[1].upper() if len(rest) > 1 else None
+
+    for family, bits in _FAMILIES:
+        try:
+            network = _ip_to_int(family, address)
+        except (ValueError, socket.error):
+            continue
+
+        if not length.isdigit() or int(length) > bits:
+            raise ValueError("invalid prefix length " + repr(length))
+        length = int(length)
+        network &= ~((1 << (bits - length)) - 1)
+        return family, network, length, asn, cc
+
+    raise ValueError("invalid address " + repr(address))
+
+
+class _Table(object):
+    """
+    Longest prefix matching over the prefixes of one address family.
+    The nested prefixes are flattened into sorted, non-overlapping
+    address ranges, so that a lookup is a single binary search.
+    """
+
+    def __init__(self, bits, prefixes):
+        # IPv6 addresses don't fit into machine integers.
+        seq = (lambda: array("L")) if bits <= 32 else list
+
+        self._networks = seq()
+        self._lengths = array("B")
+        self._origins = array("L")
+
+        self._starts = seq()
+        self._ends = seq()
+        self._indexes = array("L")
+
+        cursor = 0
+        stack = []
+        for index, (network, length, origin) in enumerate(sorted(prefixes)):
+            self._networks.append(network)
+            self._lengths.append(length)
+            self._origins.append(origin)
+
+            while stack and stack[-1][0] < network:
+                end, parent = stack.pop()
+                self._add_range(cursor, end, parent)
+                cursor = end + 1
+            if stack:
+                self._add_range(cursor, network - 1, stack[-1][1])
+
+            stack.append((network | ((1 << (bits - length)) - 1), index))
+            cursor = network
+
+        while stack:
+            end, parent = stack.pop()
+            self._add_range(cursor, end, parent)
+            cursor = end + 1
+
+    def _add_range(self, start, end, index):
+        if start > end:
+            return
+        self._starts.append(start)
+        self._ends.append(end)
+        self._indexes.append(index)
+
+    def __len__(self):
+        return len(self._networks)
+
+    def get(self, number):
+        """
+        Return the (network, prefix length, origin index) of the longest
+        prefix containing the given address number, or None.
+        """
+
+        position = bisect.bisect_right(self._starts, number) - 1
+        if position < 0 or number > self._ends[position]:
+            return None
+
+        index = self._indexes[position]
+        return self._networks[index], self._lengths[index], self._origins[index]
+
+
+class Pfx2asTables(object):
+    """
+    The prefixes of a dump, indexed for longest prefix matching.
+
+    >>> tables = Pfx2asTables([
+    ...     "192.0.2.0 24 64496",
+    ...     "192.0.2.128/25 64497_64498 FI"
+    ... ])
+    >>> len(tables)
+    2
+    >>> tables.get("192.0.2.1")
+    ((u'asn', u'64496'), (u'bgp prefix', u'192.0.2.0/24'))
+    >>> tables.get("192.0.2.200")
+    ((u'asn', u'64497'), (u'bgp prefix', u'192.0.2.128/25'), (u'cc', u'FI'))
+    >>> tables.get("198.51.100.1")
+    ()
+    """
+
+    def __init__(self, lines):
+        origins = []
+        origin_ids = dict()
+        prefixes = dict((family, []) for family, _ in _FAMILIES)
+
+        for number, line in enumerate(lines, 1):
+            try:
+                parsed = _parse_line(line)
+            except ValueError as error:
+                raise ValueError("line {0}: {1}".format(number, error))
+            if parsed is None:
+                continue
+
+            family, network, length, asn, cc = parsed
+            origin = asn, cc
+            origin_id = origin_ids.get(origin, None)
+            if origin_id is None:
+                origin_id = len(origins)
+                origin_ids[origin] = origin_id
+                origins.append((unicode(asn), None if cc is None else unicode(cc)))
+            prefixes[family].append((network, length, origin_id))
+
+        self._origins = origins
+        self._tables = dict()
+        for family, bits in _FAMILIES:
+            self._tables[family] = _Table(bits, prefixes.pop(family))
+
+    def __len__(self):
+        return sum(len(table) for table in self._tables.itervalues())
+
+    def get(self, ip):
+        """
+        Return the whois items ("asn", "bgp prefix" and, when known,
+        "cc") of the longest prefix containing the given IP address.
+        """
+
+        for family, _ in _FAMILIES:
+            try:
+                number = _ip_to_int(family, ip)
+            except (ValueError, socket.error):
+                continue
+
+            found = self._tables[family].get(number)
+            if found is None:
+                return ()
+
+            network, length, origin_id = found
+            asn, cc = self._origins[origin_id]
+            prefix = u"{0}/{1}".format(_int_to_ip(family, network), length)
+
+            items = ((u"asn", asn), (u"bgp prefix", prefix))
+            if cc is not None:
+                items += ((u"cc", cc),)
+            return items
+        return ()
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return stat.st_mtime, stat.st_size, stat.st_ino
+
+
+def load(path):
+    """
+    Load a dump file into a Pfx2asTables instance.
+    """
+
+    opener = gzip.open if path.endswith(".gz") else open
+    fileobj = opener(path, "rb")
+    try:
+        return Pfx2asTables(fileobj)
+    except ValueError as error:
+        raise ValueError("{0}: {1}".format(path, error))
+    finally:
+        fileobj.close()
+
+
+class Pfx2asLookup(object):
+    """
+    Answer cymruwhois style lookups from a dump file. The file is
+    checked for changes at most every check_interval seconds, and a
+    changed file is loaded in the background and swapped in only after
+    it has been fully loaded. The old prefixes are kept in use when a
+    reload fails.
+    """
+
+    def __init__(self, path, check_interval=60.0, log=None):
+        self._path = path
+        self._check_interval = check_interval
+        self._log = log
+
+        self._stamp = _stamp(path)
+        self._tables = load(path)
+        self._last_check = time.time()
+        self._reloading = False
+
+        if log:
+            log.info("Loaded {0} prefixes from {1!r}".format(len(self._tables), path))
+
+    def get(self, ip):
+        return self._tables.get(ip)
+
+    def lookup(self, ip):
+        """
+        Return an already finished idiokit.Event with the whois items of
+        the given IP address, as a drop-in for cymruwhois.lookup.
+        """
+
+        self._check()
+
+        event = idiokit.Event()
+        event.succeed(self._tables.get(ip))
+        return event
+
+    def reload(self):
+        """
+        Reload the file right away if it has changed. Return True when
+        the file was reloaded.
+        """
+
+        loaded = self._load_if_changed()
+        if loaded is None:
+            return False
+        self._stamp, self._tables = loaded
+        return True
+
+    def _load_if_changed(self):
+        stamp = _stamp(self._path)
+        if stamp == self._stamp:
+            return None
+        return stamp, load(self._path)
+
+    def _check(self):
+        now = time.time()
+        if self._reloading or abs(now - self._last_check) < self._check_interval:
+            return
+
+        self._last_check = now
+        self._reloading = True
+        self._reload()
+
+    @idiokit.stream
+    def _reload(self):
+        try:
+            loaded = yield idiokit.thread(self._load_if_changed)
+        except (IOError, OSError, ValueError) as error:
+            if self._log:
+                self._log.error("Could not reload {0!r}: {1}".format(self._path, error))
+        else:
+            if loaded is not None:
+                self._stamp, self._tables = loaded
+                if self._log:
+                    self._log.info("Reloaded {0} prefixes from {1!r}".format(len(self._tables), self._path))
+        finally:
+            self._reloading = False
@@ -2,7 +2,9 @@ from __future__ import absolute_import
 
 import os
 import sys
+import time
 import uuid
+import zlib
 import errno
 import struct
 import shutil
@@ -11,7 +13,7 @@ import idiokit
 import tempfile
 import subprocess
 import contextlib
-from idiokit import socket, select
+from idiokit import socket, select, timer
 from . import events, rules, taskfarm, bot
 
 
@@ -53,12 +55,16 @@ def recvall(sock, amount, timeout=None):
     idiokit.stop("".join(data))
 
 
+def _frame(msg):
+    msg_bytes = cPickle.dumps(msg, cPickle.HIGHEST_PROTOCOL)
+    return struct.pack("!I", len(msg_bytes)) + msg_bytes
+
+
 @idiokit.stream
 def encode(sock):
     while True:
         msg = yield idiokit.next()
-        msg_bytes = cPickle.dumps(msg, cPickle.HIGHEST_PROTOCOL)
-        data = struct.pack("!I", len(msg_bytes)) + msg_bytes
+        data = _frame(msg)
 
         with wrapped_socket_errnos(errno.ECONNRESET, errno.EPIPE):
             yield sock.sendall(data)
@@ -76,29 +82,137 @@ def decode(sock):
         yield idiokit.send(msg)
 
 
+class _AffinityParam(bot.Param):
+    def parse(self, value):
+        if value == "room":
+            return "room", None
+
+        kind, _, key = value.partition(":")
+        if kind != "key" or not key:
+            raise bot.ParamError("expected \"room\" or \"key:<name>\", got " + repr(value))
+        return "key", key
+
+
+class _Scheduler(object):
+    def __init__(self, socks, affinity=None):
+        self._socks = tuple(socks)
+        self._affinity, self._affinity_key = affinity or (None, None)
+
+        self._in_flight = dict((sock, 0) for sock in self._socks)
+        self._peaks = dict(self._in_flight)
+
+    def affine(self, src, event):
+        if self._affinity == "room":
+            values = (unicode(src),)
+        elif self._affinity == "key":
+            values = event.values(self._affinity_key)
+        else:
+            return None
+
+        if not values:
+            return None
+
+        # A stable hash, so that the same value always maps to the same
+        # worker regardless of the Python process.
+        digest = zlib.crc32(min(values).encode("utf-8")) & 0xffffffff
+        return self._socks[digest % len(self._socks)]
+
+    def least_loaded(self):
+        return min(self._socks, key=self._in_flight.get)
+
+    def sent(self, sock, count):
+        in_flight = self._in_flight[sock] + count
+        self._in_flight[sock] = in_flight
+        if in_flight > self._peaks[sock]:
+            self._peaks[sock] = in_flight
+
+    def done(self, sock, count):
+        self._in_flight[sock] -= count
+
+    def pop_stats(self):
+        stats = []
+        for sock in self._socks:
+            in_flight = self._in_flight[sock]
+            stats.append((in_flight, self._peaks[sock]))
+            self._peaks[sock] = in_flight
+        return stats
+
+
 @idiokit.stream
-def distribute_encode(socks):
-    writable = []
+def distribute_encode(socks, scheduler, batch_size=1, batch_latency=0.0):
+    # Coalesce ("event", args) messages into ("events", [args, ...]) frames,
+    # one pending frame per worker socket. A frame is sent when it holds
+    # batch_size events or when its oldest event has waited for
+    # batch_latency seconds. Pending frames are sent before any other
+    # message to keep the original message order.
+    #
+    # The events are encoded with a separate events.EventEncoder for each
+    # socket, so the encoding is done only when the frame gets sent.
+    batches = {}
+    deadlines = {}
+    encoders = dict((sock, events.EventEncoder()) for sock in socks)
 
-    while True:
-        to_all, msg = yield idiokit.next()
-        msg_bytes = cPickle.dumps(msg, cPickle.HIGHEST_PROTOCOL)
-        data = struct.pack("!I", len(msg_bytes)) + msg_bytes
+    @idiokit.stream
+    def flush(sock):
+        batch = batches.pop(sock)
+        del deadlines[sock]
 
+        encode_event = encoders[sock].encode
+        data = _frame(("events", [(src, encode_event(event)) for (src, event) in batch]))
+        yield sock.sendall(data)
+
+    while True:
+        try:
+            if deadlines:
+                timeout = max(0.0, min(deadlines.itervalues()) - time.time())
+                to_all, msg = yield timer.timeout(timeout, idiokit.next())
+            else:
+                to_all, msg = yield idiokit.next()
+        except timer.Timeout:
+            now = time.time()
+            for sock, deadline in deadlines.items():
+                if deadline <= now:
+                    yield flush(sock)
+            continue
+
+        if not to_all and msg[0] == "event":
+            src, event = msg[1]
+
+            # Events without affinity join any pending frame before
+            # a new frame is started for the least loaded worker.
+            sock = scheduler.affine(src, event)
+            if sock is None:
+                sock = next(iter(batches), None)
+            if sock is None:
+                sock = scheduler.least_loaded()
+
+            batch = batches.get(sock, None)
+            if batch is None:
+                batch = []
+                batches[sock] = batch
+                deadlines[sock] = time.time() + batch_latency
+            batch.append(msg[1])
+            scheduler.sent(sock, 1)
+
+            if len(batch) >= batch_size:
+                yield flush(sock)
+            continue
+
+        for sock in list(batches):
+            yield flush(sock)
+
+        data = _frame(msg)
         if to_all:
             for sock in socks:
                 yield sock.sendall(data)
-            writable = []
         else:
-            while not writable:
-                _, writable, _ = yield select.select((), socks, ())
-                writable = list(writable)
-            yield writable.pop().sendall(data)
+            yield scheduler.least_loaded().sendall(data)
 
 
 @idiokit.stream
-def collect_decode(socks):
+def collect_decode(socks, scheduler):
     readable = []
+    decoders = dict((sock, events.EventDecoder()) for sock in socks)
 
     while True:
         while not readable:
@@ -111,9 +225,12 @@ def collect_decode(socks):
         length, = struct.unpack("!I", length_bytes)
 
         msg_bytes = yield recvall(sock, length)
-        msg = cPickle.loads(msg_bytes)
+        count, results = cPickle.loads(msg_bytes)
+        scheduler.done(sock, count)
 
-        yield idiokit.send(msg)
+        if results:
+            decode_event = decoders[sock].decode
+            yield idiokit.send([(src, decode_event(data), dsts) for (src, data, dsts) in results])
 
 
 def run():
@@ -140,6 +257,37 @@ class RoomGraphBot(bot.ServiceBot):
         the number of worker processes used for rule matching
         (default: %default)
         """, default=1)
+    batch_size = bot.IntParam("""
+        the maximum number of events sent to a worker process
+        in one batch (default: %default)
+        """, default=1)
+    batch_latency = bot.FloatParam("""
+        the maximum time an event waits for its batch to fill up
+        before the batch is sent to a worker process, in seconds
+        (default: %default seconds)
+        """, default=0.01)
+    worker_affinity = _AffinityParam("""
+        always route the events from the same source room ("room")
+        or with the same value for an event key ("key:<name>") to
+        the same worker process (default: send events to the least
+        loaded worker process)
+        """, default=None)
+    xmpp_batch_size = bot.IntParam("""
+        how many events to pack into a single XMPP stanza at most
+        (default: %default)
+        """, default=1)
+    xmpp_batch_latency = bot.FloatParam("""
+        how many seconds to wait for a partial batch of events
+        before sending it, when xmpp_batch_size is over 1
+        (default: %default)
+        """, default=0.1)
+    xmpp_omit_body = bot.BoolParam("""
+        leave the human-readable text body out of the sent stanzas
+        """)
+    xmpp_compact_events = bot.BoolParam("""
+        send events in the compact base64 encoded format instead
+        of the legacy format
+        """)
 
     def __init__(self, *args, **keys):
         bot.ServiceBot.__init__(self, *args, **keys)
@@ -149,6 +297,9 @@ class RoomGraphBot(bot.ServiceBot):
         self._processes = ()
         self._ready = idiokit.Event()
         self._stats = {}
+        self._scheduler = None
+        self._serialize_time = 0.0
+        self._serialize_count = 0
 
     def _inc_stats(self, room, seen=0, sent=0):
         seen_count, sent_count = self._stats.get(room, (0, 0))
@@ -172,20 +323,110 @@ class RoomGraphBot(bot.ServiceBot):
                 )
             self._stats.clear()
 
+            if self._serialize_count > 0:
+                self.log.info(
+                    u"Serialized {0} events in {1:.3f} seconds".format(self._serialize_count, self._serialize_time),
+                    event=events.Event({
+                        "type": "serialization",
+                        "service": self.bot_name,
+                        "serialized events": unicode(self._serialize_count),
+                        "serialization time": u"{0:.6f}".format(self._serialize_time)
+                    })
+                )
+            self._serialize_time = 0.0
+            self._serialize_count = 0
+
+            if self._scheduler is not None:
+                for index, (in_flight, peak) in enumerate(self._scheduler.pop_stats()):
+                    self.log.info(
+                        u"Worker {0}: {1} events queued (peak {2})".format(index, in_flight, peak),
+                        event=events.Event({
+                            "type": "worker",
+                            "service": self.bot_name,
+                            "worker": unicode(index),
+                            "queued events": unicode(in_flight),
+                            "peak queued events": unicode(peak)
+                        })
+                    )
+
     @idiokit.stream
     def _distribute(self):
+        batch_size = self.xmpp_batch_size
+        include_body = not self.xmpp_omit_body
+        compact = self.xmpp_compact_events
+
+        # With xmpp_batch_size > 1 the serialized events are collected
+        # into per-destination batches that are sent as single stanzas
+        # when they fill up or their oldest event gets too old.
+        batches = {}
+        deadlines = {}
+
+        @idiokit.stream
+        def flush(dst):
+            batch = batches.pop(dst)
+            del deadlines[dst]
+
+            dst_room = self._rooms.get(dst)
+            if dst_room is None:
+                return
+
+            elements = [element for (element, _) in batch]
+            bodies = [body for (_, body) in batch] if include_body else None
+            yield dst_room.send(events.join_elements(elements, bodies))
+
+        def serialize(event):
+            if batch_size <= 1:
+                return event.to_elements(include_body, compact)
+            return event.to_elements(False, compact), unicode(event) if include_body else None
+
         while True:
-            src, event, dsts = yield idiokit.next()
+            try:
+                if deadlines:
+                    timeout = max(0.0, min(deadlines.itervalues()) - time.time())
+                    results = yield timer.timeout(timeout, idiokit.next())
+                else:
+                    results = yield idiokit.next()
+            except timer.Timeout:
+                now = time.time()
+                for dst, deadline in deadlines.items():
+                    if deadline <= now:
+                        yield flush(dst)
+                continue
+
+            for src, event, dsts in results:
+                # Serialize each event only once and share the resulting
+                # elements between all the destination rooms.
+                serialized = None
+
+                count = 0
+                for dst in dsts:
+                    dst_room = self._rooms.get(dst)
+                    if dst_room is None:
+                        continue
+
+                    if serialized is None:
+                        start = time.time()
+                        serialized = serialize(event)
+                        self._serialize_time += time.time() - start
+                        self._serialize_count += 1
 
-            count = 0
-            for dst in dsts:
-                dst_room = self._rooms.get(dst)
-                if dst_room is not None:
                     count += 1
-                    yield dst_room.send(event.to_elements())
+                    if batch_size <= 1:
+                        yield dst_room.send(serialized)
+                        continue
+
+                    batch = batches.get(dst, None)
+                    if batch is None:
+                        batch = []
+                        batches[dst] = batch
+                        deadlines[dst] = time.time() + self.xmpp_batch_latency
+                    batch.append(serialized)
 
-            if count > 0:
-                self._inc_stats(src, sent=1)
+                    if len(batch) >= batch_size:
+                        yield flush(dst)
+
+                if count > 0:
+                    self._inc_stats(src, sent=1)
 
     @idiokit.stream
     def _handle_room(self, room_name):
@@ -293,8 +534,9 @@ class RoomGraphBot(bot.ServiceBot):
                 self.log.info(u"Started 1 worker process")
             else:
                 self.log.info(u"Started {0} worker processes".format(self.concurrency))
-            self._ready.succeed(distribute_encode(connections))
-            yield collect_decode(connections) | self._distribute() | self._log_stats()
+            self._scheduler = _Scheduler(connections, self.worker_affinity)
+            self._ready.succeed(distribute_encode(connections, self._scheduler, self.batch_size, self.batch_latency))
+            yield collect_decode(connections, self._scheduler) | self._distribute() | self._log_stats()
         finally:
             for conn in connections:
                 yield conn.close()
@@ -303,15 +545,25 @@ class RoomGraphBot(bot.ServiceBot):
 @idiokit.stream
 def roomgraph():
     srcs = {}
+    decoder = events.EventDecoder()
+    encoder = events.EventEncoder()
 
     while True:
         type_id, args = yield idiokit.next()
-        if type_id == "event":
-            src, event = args
-            if src in srcs:
-                dsts = set(srcs[src].classify(event))
-                if dsts:
-                    yield idiokit.send(src, event, dsts)
+        if type_id == "events":
+            results = []
+            for src, data in args:
+                # Decode every event, even those with no matching rules,
+                # to keep the decoder's key dictionary in sync.
+                event = decoder.decode(data)
+                if src in srcs:
+                    dsts = set(srcs[src].classify(event))
+                    if dsts:
+                        results.append((src, encoder.encode(event), dsts))
+
+            # Always reply, so that the parent can keep count of the
+            # events in flight for each worker.
+            yield idiokit.send((len(args), results))
         elif type_id == "inc_rule":
             src, rule, dst = args
             if src not in srcs:
@@ -1,8 +1,10 @@
 import re
+import threading
 from itertools import izip
 from encodings import idna
 
 from . import parsing
+from ..cache import LRUCache
 
 
 # A regular expression for checking a validity of a ASCII domain name label.
@@ -27,6 +29,14 @@ def _parse_labels(string):
     return tuple(idna.ToUnicode(x) for x in labels)
 
 
+# Names seen in events tend to repeat a lot, and running them through the IDNA
+# transformations is expensive. Keep a bounded process-wide cache of the most
+# recently parsed names. The parsed names never go stale, so they don't expire.
+_NAME_CACHE = LRUCache(float("inf"), max_size=2 ** 13, name="domain names")
+_NAME_CACHE_LOCK = threading.Lock()
+_MISSING = object()
+
+
 def parse_name(string):
     r"""
     Return domain name as a tuple of unicode labels parsed from the given
@@ -79,7 +89,14 @@ def parse_name(string):
     # Don't accept plain top-level domains.
     if "." not in string:
         return None
-    return _parse_labels(string)
+
+    with _NAME_CACHE_LOCK:
+        result = _NAME_CACHE.get(string, _MISSING)
+    if result is _MISSING:
+        result = _parse_labels(string)
+        with _NAME_CACHE_LOCK:
+            _NAME_CACHE.set(string, result)
+    return result
 
 
 def _issubdomain(name, pattern_labels):
@@ -275,3 +292,118 @@ class Pattern(object):
         if len(name) < self._length:
             return False
         return _issubdomain(name, self._labels)
+
+
+class PatternTrie(object):
+    r"""
+    A trie of domain name patterns keyed by their reversed labels, mapping
+    each pattern to a set of hashable items.
+
+    All patterns containing a parsed name can be resolved in one walk that
+    is proportional to the number of labels in the name, regardless of how
+    many patterns have been added.
+
+    >>> trie = PatternTrie()
+    >>> trie.add(Pattern(0, [u"example"]), "a")
+    >>> trie.add(Pattern.from_string("*.example"), "b")
+    >>> trie.add(Pattern.from_string("domain.example"), "c")
+    >>> trie.add(Pattern.from_string("*.*.example"), "d")
+    >>> trie.add(Pattern.from_string("other.test"), "e")
+
+    >>> sorted(trie.find(parse_name(u"domain.example")))
+    ['a', 'b', 'c']
+    >>> sorted(trie.find(parse_name(u"sub.domain.example")))
+    ['a', 'b', 'c', 'd']
+    >>> sorted(trie.find(parse_name(u"sub.other.example")))
+    ['a', 'b', 'd']
+    >>> sorted(trie.find(parse_name(u"domain.test")))
+    []
+    >>> trie.covers(parse_name(u"other.test"))
+    True
+
+    Items can be removed, after which their patterns no longer match.
+
+    >>> trie.discard(Pattern.from_string("*.example"), "b")
+    >>> sorted(trie.find(parse_name(u"domain.example")))
+    ['a', 'c']
+    """
+
+    def __init__(self):
+        self._size = 0
+
+        # Each node is a (children, terminals) pair, where children maps
+        # labels to child nodes and terminals maps the wildcard label
+        # counts of the patterns ending at the node to their item sets.
+        self._root = dict(), dict()
+
+    def add(self, pattern, item):
+        node = self._root
+        for label in reversed(pattern._labels):
+            children = node[0]
+            child = children.get(label, None)
+            if child is None:
+                child = dict(), dict()
+                children[label] = child
+            node = child
+
+        items = node[1].setdefault(pattern._free, set())
+        if item not in items:
+            items.add(item)
+            self._size += 1
+
+    def discard(self, pattern, item):
+        path = []
+
+        node = self._root
+        for label in reversed(pattern._labels):
+            child = node[0].get(label, None)
+            if child is None:
+                return
+            path.append((node, label))
+            node = child
+
+        items = node[1].get(pattern._free, None)
+        if items is None or item not in items:
+            return
+        items.discard(item)
+        self._size -= 1
+        if items:
+            return
+        del node[1][pattern._free]
+
+        # Prune the nodes that became empty.
+        while path and not node[0] and not node[1]:
+            parent, label = path.pop()
+            del parent[0][label]
+            node = parent
+
+    def _walk(self, name):
+        length = len(name)
+
+        node = self._root
+        depth = 0
+        while True:
+            for free, items in node[1].iteritems():
+                if depth + free <= length:
+                    yield items
+
+            if depth >= length:
+                break
+            node = node[0].get(name[length - depth - 1], None)
+            if node is None:
+                break
+            depth += 1
+
+    def find(self, name):
+        result = set()
+        for items in self._walk(name):
+            result.update(items)
+        return result
+
+    def covers(self, name):
+        for _ in self._walk(name):
+            return True
+        return False
+
+    def is_empty(self):
+        return self._size == 0
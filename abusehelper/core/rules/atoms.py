@@ -8,7 +8,7 @@ from . import _domainname
 
 
 class Atom(core.Matcher):
-    def match(self, value):
+    def match(self, value, cache=None):
         return False
 
 
@@ -28,7 +28,7 @@ class String(Atom):
     def value(self):
         return self._value
 
-    def match(self, value):
+    def match(self, value, cache=None):
         return self._value == value
 
     def dump(self):
@@ -82,7 +82,7 @@ class RegExp(Atom):
             return Atom.__repr__(self, pattern, ignore_case=True)
         return Atom.__repr__(self, pattern)
 
-    def match(self, value):
+    def match(self, value, cache=None):
         return self._regexp.search(value)
 
     def dump(self):
@@ -117,10 +117,9 @@ class IP(Atom):
     def __unicode__(self):
         return unicode(self._range)
 
-    def match(self, value):
-        try:
-            range = iprange.IPRange.from_autodetected(value)
-        except ValueError:
+    def match(self, value, cache=None):
+        range = core.parse_with_cache(iprange.parse_range, value, cache)
+        if range is None:
             return False
         return self._range.contains(range)
 
@@ -153,8 +152,8 @@ class DomainName(Atom):
     def __unicode__(self):
         return unicode(self._pattern)
 
-    def match(self, value):
-        name = _domainname.parse_name(value)
+    def match(self, value, cache=None):
+        name = core.parse_with_cache(_domainname.parse_name, value, cache)
         if name is None:
             return False
         return self._pattern.contains(name)
@@ -1,12 +1,160 @@
+from . import core
+from . import atoms
+from . import rules
+from . import iprange
+from . import _domainname
+
+
+# Indexable atom types, mapped to the value parser, the index type and a
+# function for getting the indexed object from an atom.
+_INDEXED = {
+    atoms.IP: (iprange.parse_range, iprange.IPRangeIndex, lambda x: x.range),
+    atoms.DomainName: (_domainname.parse_name, _domainname.PatternTrie, lambda x: x.pattern)
+}
+
+
+def _compile(rule):
+    r"""
+    Return a (triggers, exact) pair for the rule.
+
+    The triggers are a set of (key, atom) pairs, at least one of which an
+    event has to contain for the rule to match. None is returned instead
+    when no such set can be determined, meaning that the rule has to be
+    evaluated against every event. When exact is True a triggered rule is
+    known to match without evaluating the rule itself.
+
+    >>> _compile(rules.Match("a", "b")) == (frozenset([("a", atoms.String("b"))]), True)
+    True
+    >>> _compile(rules.Match("a", atoms.RegExp("b")))
+    (None, False)
+    >>> _compile(rules.And(rules.Match("a", "b"), rules.Match("c", atoms.RegExp("d"))))[1]
+    False
+    """
+
+    if isinstance(rule, rules.NonMatch):
+        return None, False
+
+    if isinstance(rule, rules.Match):
+        if not isinstance(rule.key, atoms.String):
+            return None, False
+        if not isinstance(rule.value, atoms.String) and type(rule.value) not in _INDEXED:
+            return None, False
+        return frozenset([(rule.key.value, rule.value)]), True
+
+    if isinstance(rule, rules.Or):
+        triggers = set()
+        exact = True
+        for subrule in rule.subrules:
+            sub_triggers, sub_exact = _compile(subrule)
+            if sub_triggers is None:
+                return None, False
+            triggers.update(sub_triggers)
+            exact = exact and sub_exact
+        return frozenset(triggers), exact
+
+    if isinstance(rule, rules.And):
+        triggers = None
+        for subrule in rule.subrules:
+            sub_triggers, _ = _compile(subrule)
+            if sub_triggers is None:
+                continue
+            if triggers is None or len(sub_triggers) < len(triggers):
+                triggers = sub_triggers
+        return triggers, False
+
+    return None, False
+
+
+class _RuleIndex(object):
+    def __init__(self):
+        self._strings = dict()
+        self._indexes = dict()
+
+    def add(self, triggers, rule):
+        for key, atom in triggers:
+            if isinstance(atom, atoms.String):
+                self._strings.setdefault((key, atom.value), set()).add(rule)
+                continue
+
+            atom_type = type(atom)
+            _, index_type, indexed = _INDEXED[atom_type]
+
+            index = self._indexes.get((atom_type, key), None)
+            if index is None:
+                index = index_type()
+                self._indexes[atom_type, key] = index
+            index.add(indexed(atom), rule)
+
+    def discard(self, triggers, rule):
+        for key, atom in triggers:
+            if isinstance(atom, atoms.String):
+                string_key = key, atom.value
+                matching = self._strings.get(string_key, None)
+                if matching is None:
+                    continue
+                matching.discard(rule)
+                if not matching:
+                    del self._strings[string_key]
+                continue
+
+            atom_type = type(atom)
+            _, _, indexed = _INDEXED[atom_type]
+
+            index = self._indexes.get((atom_type, key), None)
+            if index is None:
+                continue
+            index.discard(indexed(atom), rule)
+            if index.is_empty():
+                del self._indexes[atom_type, key]
+
+    def find(self, obj, cache):
+        result = set()
+
+        if self._strings:
+            for item in obj.items():
+                matching = self._strings.get(item, None)
+                if matching is not None:
+                    result.update(matching)
+
+        for (atom_type, key), index in self._indexes.iteritems():
+            parser, _, _ = _INDEXED[atom_type]
+            for value in obj.values(key):
+                parsed = core.parse_with_cache(parser, value, cache)
+                if parsed is not None:
+                    result.update(index.find(parsed))
+
+        return result
+
+
 class Classifier(object):
     def __init__(self):
         self._rules = dict()
 
+        self._index = _RuleIndex()
+        self._compiled = dict()
+        self._unindexed = set()
+
+    def _add_rule(self, rule):
+        triggers, exact = _compile(rule)
+        self._compiled[rule] = triggers, exact
+        if triggers is None:
+            self._unindexed.add(rule)
+        else:
+            self._index.add(triggers, rule)
+
+    def _remove_rule(self, rule):
+        triggers, _ = self._compiled.pop(rule)
+        if triggers is None:
+            self._unindexed.discard(rule)
+        else:
+            self._index.discard(triggers, rule)
+
     def inc(self, rule, class_id):
         classes = self._rules.get(rule, None)
         if classes is None:
             classes = dict()
             self._rules[rule] = classes
+            self._add_rule(rule)
         classes[class_id] = classes.get(class_id, 0) + 1
 
     def dec(self, rule, class_id):
@@ -21,12 +169,23 @@ class Classifier(object):
             classes.pop(class_id, None)
             if not classes:
                 self._rules.pop(rule, None)
+                self._remove_rule(rule)
 
     def classify(self, obj):
         result = set()
         cache = dict()
 
-        for rule, classes in self._rules.iteritems():
+        for rule in self._index.find(obj, cache):
+            classes = self._rules[rule]
+            if result.issuperset(classes):
+                continue
+
+            _, exact = self._compiled[rule]
+            if exact or rule.match(obj, cache):
+                result.update(classes)
+
+        for rule in self._unindexed:
+            classes = self._rules[rule]
             if result.issuperset(classes):
                 continue
 
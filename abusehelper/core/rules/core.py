@@ -2,6 +2,38 @@ import weakref
 import threading
 
 
+def parse_with_cache(parser, value, cache=None):
+    r"""
+    Return parser(value), memoizing the result in the given cache dict
+    under the key (parser, value).
+
+    The cache is the same dict that rules use to memoize their match results
+    for a single object, so a value gets parsed only once per object no
+    matter how many atoms need the parsed form.
+
+    >>> calls = []
+    >>> def parser(value):
+    ...     calls.append(value)
+    ...     return None
+    >>> cache = {}
+    >>> parse_with_cache(parser, "a", cache)
+    >>> parse_with_cache(parser, "a", cache)
+    >>> calls
+    ['a']
+    """
+
+    if cache is None:
+        return parser(value)
+
+    key = parser, value
+    if key in cache:
+        return cache[key]
+
+    result = parser(value)
+    cache[key] = result
+    return result
+
+
 def load_reduced(cls, dumped):
     return cls.load(dumped)
 
@@ -234,3 +234,161 @@ class IPRange(object):
             return first_str + u"/" + unicode(repr(bits))
 
         return first_str + u"-" + unicode(self._version.format(self._last))
+
+
+def parse_range(string):
+    r"""
+    Return an IPRange autodetected from the given string, or None if the
+    string is not a valid IP address, CIDR or IP range.
+
+    >>> parse_range(u"192.0.2.0/24") == IPRange.from_cidr(u"192.0.2.0", 24)
+    True
+    >>> parse_range(u"not an ip")
+    """
+
+    try:
+        return IPRange.from_autodetected(string)
+    except ValueError:
+        return None
+
+
+def _cidr_blocks(version, first, last):
+    r"""
+    Yield (network, bits) pairs for the CIDR blocks that together exactly
+    cover the IP numbers between first and last (inclusive).
+
+    >>> list(_cidr_blocks(ipv4, 0, 255))
+    [(0, 24)]
+    >>> list(_cidr_blocks(ipv4, 1, 6))
+    [(1, 32), (2, 31), (4, 31), (6, 32)]
+    """
+
+    max_bits = version.max_bits
+
+    while first <= last:
+        host_bits = 0
+        while host_bits < max_bits:
+            size = 1 << (host_bits + 1)
+            if first % size != 0 or first + size - 1 > last:
+                break
+            host_bits += 1
+
+        yield first, max_bits - host_bits
+        first += 1 << host_bits
+
+
+class IPRangeIndex(object):
+    r"""
+    A prefix index from IP ranges to sets of hashable items.
+
+    Each added range is split into CIDR blocks, which are stored in hash
+    tables per IP version and prefix length. A lookup therefore costs one
+    hash table probe per distinct prefix length instead of one range check
+    per indexed range.
+
+    >>> index = IPRangeIndex()
+    >>> index.add(IPRange.from_cidr("192.0.2.0", 24), "a")
+    >>> index.add(IPRange.from_range("192.0.2.1", "192.0.2.2"), "b")
+    >>> index.add(IPRange.from_cidr("2001:db8::", 32), "c")
+
+    Return the items of all ranges that contain the looked up range.
+
+    >>> sorted(index.find(IPRange.from_ip("192.0.2.1")))
+    ['a', 'b']
+    >>> sorted(index.find(IPRange.from_range("192.0.2.1", "192.0.2.2")))
+    ['a', 'b']
+    >>> sorted(index.find(IPRange.from_range("192.0.2.1", "192.0.2.3")))
+    ['a']
+    >>> sorted(index.find(IPRange.from_ip("2001:db8::1")))
+    ['c']
+    >>> sorted(index.find(IPRange.from_ip("198.51.100.1")))
+    []
+
+    Items can be removed, after which their ranges no longer match.
+
+    >>> index.discard(IPRange.from_cidr("192.0.2.0", 24), "a")
+    >>> sorted(index.find(IPRange.from_ip("192.0.2.1")))
+    ['b']
+    """
+
+    def __init__(self):
+        self._items = dict()
+        self._tables = dict()
+
+    def add(self, range, item):
+        items = self._items.get(range, None)
+        if items is None:
+            items = set()
+            self._items[range] = items
+
+            tables = self._tables.setdefault(range._version, dict())
+            for network, bits in _cidr_blocks(range._version, range._first, range._last):
+                table = tables.setdefault(bits, dict())
+                table.setdefault(network, set()).add(range)
+        items.add(item)
+
+    def discard(self, range, item):
+        items = self._items.get(range, None)
+        if items is None:
+            return
+
+        items.discard(item)
+        if items:
+            return
+        del self._items[range]
+
+        tables = self._tables[range._version]
+        for network, bits in _cidr_blocks(range._version, range._first, range._last):
+            table = tables[bits]
+            ranges = table[network]
+            ranges.discard(range)
+            if not ranges:
+                del table[network]
+                if not table:
+                    del tables[bits]
+        if not tables:
+            del self._tables[range._version]
+
+    def find(self, range):
+        result = set()
+
+        tables = self._tables.get(range._version, None)
+        if tables is None:
+            return result
+
+        version = range._version
+        first = range._first
+        for bits, table in tables.iteritems():
+            network, _ = version.range_from_bitmask(first, bits)
+            for candidate in table.get(network, ()):
+                if candidate.contains(range):
+                    result.update(self._items[candidate])
+        return result
+
+    def covers(self, range):
+        r"""
+        Return True if any of the indexed ranges contains the given range.
+
+        >>> index = IPRangeIndex()
+        >>> index.add(IPRange.from_cidr("192.0.2.0", 24), "a")
+        >>> index.covers(IPRange.from_ip("192.0.2.1"))
+        True
+        >>> index.covers(IPRange.from_ip("198.51.100.1"))
+        False
+        """
+
+        tables = self._tables.get(range._version, None)
+        if tables is None:
+            return False
+
+        version = range._version
+        first = range._first
+        for bits, table in tables.iteritems():
+            network, _ = version.range_from_bitmask(first, bits)
+            for candidate in table.get(network, ()):
+                if candidate.contains(range):
+                    return True
+        return False
+
+    def is_empty(self):
+        return not self._items
@@ -4,6 +4,8 @@ import re
 
 from . import core
 from . import atoms
+from . import iprange
+from . import _domainname
 
 
 class Rule(core.Matcher):
@@ -51,14 +53,59 @@ class And(Rule):
         return cls(*subrules)
 
 
+# Atom types whose matches can be collapsed into a single index lookup in
+# disjunctions, along with the value parser, the index type and a function
+# for getting the indexed object from an atom.
+_COLLAPSIBLE = [
+    (atoms.IP, iprange.parse_range, iprange.IPRangeIndex, lambda x: x.range),
+    (atoms.DomainName, _domainname.parse_name, _domainname.PatternTrie, lambda x: x.pattern)
+]
+
+
 class Or(And):
+    def init(self, first, *rest):
+        And.init(self, first, *rest)
+
+        # Collapse IP range and domain name pattern matches that share the
+        # same key into a single index lookup, so that each value gets parsed
+        # and looked up only once instead of once per atom.
+        groups = dict()
+        for rule in self._rules:
+            if type(rule) is not Match or not isinstance(rule.key, atoms.String):
+                continue
+            for collapsible in _COLLAPSIBLE:
+                if isinstance(rule.value, collapsible[0]):
+                    groups.setdefault((collapsible, rule.key.value), []).append(rule)
+
+        collapsed = set()
+        self._indexes = []
+        for ((_, parser, index_type, indexed), key), matches in groups.iteritems():
+            if len(matches) < 2:
+                continue
+
+            index = index_type()
+            for match in matches:
+                index.add(indexed(match.value), match)
+            self._indexes.append((key, parser, index))
+            collapsed.update(matches)
+        self._uncollapsed = tuple(x for x in self._rules if x not in collapsed)
+
     def match_with_cache(self, obj, cache):
-        for rule in self.subrules:
+        for key, parser, index in self._indexes:
+            if obj.contains(key, filter=lambda x: _in_index(x, parser, index, cache)):
+                return True
+
+        for rule in self._uncollapsed:
             if rule.match(obj, cache):
                 return True
         return False
 
 
+def _in_index(value, parser, index, cache):
+    parsed = core.parse_with_cache(parser, value, cache)
+    return parsed is not None and index.covers(parsed)
+
+
 class No(Rule):
     def init(self, rule):
         Rule.init(self)
@@ -137,12 +184,15 @@ class Match(Rule):
         return self._value
 
     def match_with_cache(self, event, cache):
+        def _filter(value):
+            return self.filter(value, cache)
+
         if self._key is None:
-            return event.contains(filter=self.filter)
-        return event.contains(self._key.value, filter=self.filter)
+            return event.contains(filter=_filter)
+        return event.contains(self._key.value, filter=_filter)
 
-    def filter(self, value):
-        return self._value is None or self._value.match(value)
+    def filter(self, value, cache=None):
+        return self._value is None or self._value.match(value, cache)
 
     def dump(self):
         return (self._key, self._value)
@@ -153,8 +203,8 @@ class Match(Rule):
 
 
 class NonMatch(Match):
-    def filter(self, value):
-        return self._value is None or not self._value.match(value)
+    def filter(self, value, cache=None):
+        return self._value is None or not self._value.match(value, cache)
 
 
 class Fuzzy(Rule):
@@ -179,9 +229,12 @@ class Fuzzy(Rule):
         return Rule.__repr__(self, self._atom)
 
     def match_with_cache(self, event, cache):
-        if any(self._matcher.match(x) for x in event.keys()):
+        def _filter(value):
+            return self._matcher.match(value, cache)
+
+        if any(_filter(x) for x in event.keys()):
             return True
-        if event.contains(filter=self._matcher.match):
+        if event.contains(filter=_filter):
             return True
         return False
 
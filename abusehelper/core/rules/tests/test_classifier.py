@@ -1,8 +1,10 @@
 from __future__ import unicode_literals
 
+import re
 import unittest
 from ...events import Event
 
+from .. import atoms
 from .. import rules
 from .. import classifier
 
@@ -31,3 +33,51 @@ class TestClassifier(unittest.TestCase):
         c.dec(rules.Match("a", "b"), "Y")
         self.assertEqual([], sorted(c.classify(Event(a="b"))))
         self.assertTrue(c.is_empty())
+
+    def test_ip_rules(self):
+        c = classifier.Classifier()
+        c.inc(rules.Match("ip", atoms.IP("192.0.2.0/24")), "X")
+        c.inc(rules.Match("ip", atoms.IP("192.0.2.1-192.0.2.2")), "Y")
+        c.inc(rules.Match("ip", atoms.IP("2001:db8::/32")), "Z")
+
+        self.assertEqual(["X", "Y"], sorted(c.classify(Event(ip="192.0.2.1"))))
+        self.assertEqual(["X"], sorted(c.classify(Event(ip="192.0.2.0/30"))))
+        self.assertEqual(["Z"], sorted(c.classify(Event(ip="2001:db8::1"))))
+        self.assertEqual([], sorted(c.classify(Event(ip="198.51.100.1"))))
+        self.assertEqual([], sorted(c.classify(Event(ip="not an ip"))))
+        self.assertEqual([], sorted(c.classify(Event(other="192.0.2.1"))))
+
+        c.dec(rules.Match("ip", atoms.IP("192.0.2.0/24")), "X")
+        self.assertEqual(["Y"], sorted(c.classify(Event(ip="192.0.2.1"))))
+
+    def test_domainname_rules(self):
+        c = classifier.Classifier()
+        c.inc(rules.Match("domain", atoms.DomainName("*.example")), "X")
+        c.inc(rules.Match("domain", atoms.DomainName("domain.example")), "Y")
+        c.inc(rules.Match("domain", atoms.DomainName("*.*.test")), "Z")
+
+        self.assertEqual(["X", "Y"], sorted(c.classify(Event(domain="domain.example"))))
+        self.assertEqual(["X", "Y"], sorted(c.classify(Event(domain="sub.domain.example"))))
+        self.assertEqual(["X"], sorted(c.classify(Event(domain="other.example"))))
+        self.assertEqual([], sorted(c.classify(Event(domain="other.test"))))
+        self.assertEqual(["Z"], sorted(c.classify(Event(domain="sub.other.test"))))
+        self.assertEqual([], sorted(c.classify(Event(domain="not a domain"))))
+
+        c.dec(rules.Match("domain", atoms.DomainName("*.example")), "X")
+        self.assertEqual(["Y"], sorted(c.classify(Event(domain="domain.example"))))
+
+    def test_mixed_rules(self):
+        c = classifier.Classifier()
+        c.inc(rules.And(rules.Match("a", "b"), rules.Match("c", re.compile("d"))), "X")
+        c.inc(rules.Or(rules.Match("a", "b"), rules.Match("ip", atoms.IP("192.0.2.0/24"))), "Y")
+        c.inc(rules.No(rules.Match("a", "b")), "Z")
+        c.inc(rules.Match("c", re.compile("^x")), "W")
+
+        self.assertEqual(["X", "Y"], sorted(c.classify(Event(a="b", c="ddd"))))
+        self.assertEqual(["Y"], sorted(c.classify(Event(a="b", c="e"))))
+        self.assertEqual(["Y", "Z"], sorted(c.classify(Event(ip="192.0.2.1"))))
+        self.assertEqual(["W", "Z"], sorted(c.classify(Event(c="xyz"))))
+
+        c.dec(rules.No(rules.Match("a", "b")), "Z")
+        c.dec(rules.Match("c", re.compile("^x")), "W")
+        self.assertEqual([], sorted(c.classify(Event(c="xyz"))))
@@ -7,6 +7,8 @@ from ..atoms import String, RegExp, IP, DomainName
 from ..rules import And, Or, No, Match, NonMatch, Fuzzy, Anything
 from ..rulelang import format, parse, rule
 
+from ...events import Event
+
 
 class TestRule(unittest.TestCase):
     def test_basic(self):
@@ -46,6 +48,19 @@ class TestParse(unittest.TestCase):
 
         self.assertEqual(Or(a, b, And(c, Or(a, b))), parse("a=a or b=b or c=c and a=a or b=b"))
 
+    def test_ip_disjunction(self):
+        rule = parse("ip in 192.0.2.0/24 or ip in 198.51.100.0/24 or ip in 2001:db8::/32")
+        self.assertEqual(
+            rule,
+            Or(
+                Match("ip", IP("192.0.2.0/24")),
+                Match("ip", IP("198.51.100.0/24")),
+                Match("ip", IP("2001:db8::/32"))
+            )
+        )
+        self.assertTrue(rule.match(Event({"ip": "198.51.100.1"})))
+        self.assertFalse(rule.match(Event({"ip": "203.0.113.1"})))
+
     def test_match(self):
         string = Match('a', 'b')
         self.assertEqual(string, parse('a=b'))
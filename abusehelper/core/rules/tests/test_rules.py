@@ -4,6 +4,7 @@ import re
 import pickle
 import unittest
 
+from .. import iprange
 from ..atoms import String, RegExp, IP, DomainName
 from ..rules import And, Or, No, Match, NonMatch, Fuzzy
 
@@ -23,6 +24,15 @@ class TestRules(unittest.TestCase):
         cache = {rule: True}
         self.assertTrue(rule.match(Event(), cache))
 
+    def test_parsed_values_should_get_cached(self):
+        cache = {}
+        Match("a", IP("192.0.2.0/24")).match(Event({"a": "192.0.2.1"}), cache)
+        self.assertTrue((iprange.parse_range, "192.0.2.1") in cache)
+
+        cache[iprange.parse_range, "192.0.2.1"] = iprange.IPRange.from_ip("198.51.100.1")
+        self.assertFalse(Match("a", IP("192.0.2.1")).match(Event({"a": "192.0.2.1"}), cache))
+        self.assertTrue(Match("a", IP("198.51.100.0/24")).match(Event({"a": "192.0.2.1"}), cache))
+
 
 class TestAnd(unittest.TestCase):
     def test_can_not_be_initialized_with_zero_arguments(self):
@@ -63,8 +73,38 @@ class TestOr(unittest.TestCase):
         a = Match("a", "a")
         self.assertEqual(Or(a, a), Or(a))
 
+    def test_ip_disjunction(self):
+        rule = Or(
+            Match("ip", IP("192.0.2.0/24")),
+            Match("ip", IP("198.51.100.1-198.51.100.2")),
+            Match("ip", IP("2001:db8::/32")),
+            Match("other", IP("203.0.113.0/24")),
+            Match("a", "b")
+        )
+        self.assertTrue(rule.match(Event({"ip": "192.0.2.1"})))
+        self.assertTrue(rule.match(Event({"ip": "198.51.100.1-198.51.100.2"})))
+        self.assertTrue(rule.match(Event({"ip": "2001:db8::1"})))
+        self.assertTrue(rule.match(Event({"ip": "x", "other": "203.0.113.1"})))
+        self.assertTrue(rule.match(Event({"ip": "x", "a": "b"})))
+        self.assertFalse(rule.match(Event({"ip": "198.51.100.1-198.51.100.3"})))
+        self.assertFalse(rule.match(Event({"ip": "203.0.113.1"})))
+        self.assertFalse(rule.match(Event({"ip": "not an ip"})))
+
+    def test_domainname_disjunction(self):
+        rule = Or(
+            Match("domain", DomainName("*.example")),
+            Match("domain", DomainName("domain.test")),
+            Match("a", "b")
+        )
+        self.assertTrue(rule.match(Event({"domain": "sub.example"})))
+        self.assertTrue(rule.match(Event({"domain": "sub.domain.test"})))
+        self.assertTrue(rule.match(Event({"domain": "x", "a": "b"})))
+        self.assertFalse(rule.match(Event({"domain": "example"})))
+        self.assertFalse(rule.match(Event({"domain": "other.test"})))
+
     _options = [
-        Or(Match("a"), Match("b"))
+        Or(Match("a"), Match("b")),
+        Or(Match("a", IP("192.0.2.0/24")), Match("a", IP("198.51.100.0/24")))
     ]
 
     def test_pickling_and_unpickling(self):
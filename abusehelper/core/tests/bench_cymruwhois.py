@@ -0,0 +1,130 @@
+"""
+Measure the throughput of CymruWhois.augment with different concurrency
+limits against a local stub DNS server that answers the Team Cymru TXT
+queries with a fixed artificial latency.
+
+Run with: python -m abusehelper.core.tests.bench_cymruwhois
+"""
+
+import time
+import socket
+import struct
+import threading
+
+import idiokit
+from idiokit import dns
+
+from .. import cymruwhois
+from ..events import Event
+
+
+def _parse_question(data):
+    offset = 12
+    labels = []
+    while True:
+        length = ord(data[offset])
+        offset += 1
+        if length == 0:
+            break
+        labels.append(data[offset:offset + length])
+        offset += length
+    return ".".join(labels), offset + 4
+
+
+def _txt_answer(query, question_end, text):
+    header = query[:2] + struct.pack("!HHHHH", 0x8180, 1, 1, 0, 0)
+    rdata = chr(len(text)) + text
+    answer = struct.pack("!HHHIH", 0xc00c, 16, 1, 60, len(rdata)) + rdata
+    return header + query[12:question_end] + answer
+
+
+def _answer_text(name):
+    if name.lower().endswith(".asn.cymru.com") and name.upper().startswith("AS"):
+        return "64496 | FI | ripencc | 2016-01-01 | EXAMPLE-AS, FI"
+    return "64496 | 192.0.2.0/24 | FI | ripencc | 2016-01-01"
+
+
+class StubDNSServer(object):
+    def __init__(self, latency):
+        self.latency = latency
+        self.queries = 0
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind(("127.0.0.1", 0))
+        self.address = self._socket.getsockname()
+
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                query, address = self._socket.recvfrom(512)
+            except socket.error:
+                return
+            self.queries += 1
+
+            name, question_end = _parse_question(query)
+            response = _txt_answer(query, question_end, _answer_text(name))
+            timer = threading.Timer(self.latency, self._socket.sendto, (response, address))
+            timer.daemon = True
+            timer.start()
+
+    def close(self):
+        self._socket.close()
+
+
+def sample_events(count, distinct_ips):
+    for index in xrange(count):
+        ip = index % distinct_ips
+        yield Event({
+            "feed": "example feed",
+            "ip": "192.0.{0}.{1}".format(ip // 256 % 256, ip % 256)
+        })
+
+
+@idiokit.stream
+def _send(events):
+    for event in events:
+        yield idiokit.send(event)
+
+
+@idiokit.stream
+def _count():
+    count = 0
+    while True:
+        try:
+            yield idiokit.next()
+        except StopIteration:
+            break
+        count += 1
+    idiokit.stop(count)
+
+
+def main(event_count=2000, distinct_ips=1000, latency=0.02):
+    server = StubDNSServer(latency)
+    try:
+        events = list(sample_events(event_count, distinct_ips))
+
+        print "{0} events with {1} distinct IPs, {2:.0f} ms DNS latency".format(
+            event_count, distinct_ips, latency * 1000)
+        for concurrency in [1, 4, 16, 64]:
+            resolver = dns.Resolver(servers=[server.address])
+            whois = cymruwhois.CymruWhois(resolver, concurrency=concurrency)
+
+            queries = server.queries
+            start = time.time()
+            idiokit.main_loop(_send(events) | whois.augment("ip") | _count())
+            elapsed = time.time() - start
+
+            print "concurrency {0:>3}: {1:>8.0f} events/s, {2} DNS queries".format(
+                concurrency,
+                event_count / elapsed,
+                server.queries - queries)
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+Measure the PollingBot deduplication backends: the time taken by two
+consecutive polls of the same events and the size and pickling time of
+the resulting filter, as saved to the bot's state file.
+
+Run with: python -m abusehelper.core.tests.bench_dedup
+"""
+
+import time
+import cPickle as pickle
+
+from .. import dedup
+from .bench_eventcodec import sample_events
+
+
+def run_poll(previous, backend, events):
+    poll = dedup.start_poll(previous, backend, 0.001)
+    for event in events:
+        poll.is_new(event)
+    return poll.finish()
+
+
+def main(event_count=200000):
+    events = list(sample_events(event_count))
+
+    print "{0} events per poll".format(event_count)
+    for backend in dedup.BACKENDS:
+        start = time.time()
+        result = run_poll(None, backend, events)
+        result = run_poll(result, backend, events)
+        polled = time.time() - start
+
+        start = time.time()
+        data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        pickle.loads(data)
+        pickled = time.time() - start
+
+        print "{0:>6}: {1:>9.0f} events/s polled, state {2:>6.1f} MB pickled and unpickled in {3:.2f} s".format(
+            backend,
+            2 * event_count / polled,
+            len(data) / 1024.0 / 1024.0,
+            pickled
+        )
+
+
+if __name__ == "__main__":
+    main()
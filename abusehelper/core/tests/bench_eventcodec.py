@@ -0,0 +1,84 @@
+"""
+Compare the compact binary event codec against pickling for the event
+frames sent between RoomGraphBot and its worker processes.
+
+Run with: python -m abusehelper.core.tests.bench_eventcodec
+"""
+
+import time
+import cPickle
+
+from ..events import Event, EventEncoder, EventDecoder
+
+
+def sample_events(count):
+    for index in xrange(count):
+        yield Event({
+            "feed": "example feed",
+            "type": "malware",
+            "ip": "192.0.2.{0}".format(index % 256),
+            "asn": unicode(64496 + index % 16),
+            "cc": "FI",
+            "domain name": "host{0}.example".format(index),
+            "url": "http://host{0}.example/path/file.exe".format(index),
+            "source time": "2016-02-10 12:{0:02d}:00Z".format(index % 60)
+        })
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def bench_pickle(frames):
+    def encode():
+        return [cPickle.dumps(("events", frame), cPickle.HIGHEST_PROTOCOL) for frame in frames]
+
+    def decode(data):
+        return [cPickle.loads(x) for x in data]
+
+    encode_time, data = timed(encode)
+    decode_time, _ = timed(decode, data)
+    return encode_time, decode_time, sum(len(x) for x in data)
+
+
+def bench_codec(frames):
+    def encode():
+        encoder = EventEncoder()
+        return [
+            cPickle.dumps(("events", [(src, encoder.encode(x)) for (src, x) in frame]), cPickle.HIGHEST_PROTOCOL)
+            for frame in frames
+        ]
+
+    def decode(data):
+        decoder = EventDecoder()
+        result = []
+        for item in data:
+            _, frame = cPickle.loads(item)
+            result.append([(src, decoder.decode(x)) for (src, x) in frame])
+        return result
+
+    encode_time, data = timed(encode)
+    decode_time, _ = timed(decode, data)
+    return encode_time, decode_time, sum(len(x) for x in data)
+
+
+def main(event_count=50000, batch_size=100):
+    src = u"room@conference.example"
+    events = [(src, event) for event in sample_events(event_count)]
+    frames = [events[i:i + batch_size] for i in xrange(0, event_count, batch_size)]
+
+    print "{0} events, {1} events per frame".format(event_count, batch_size)
+    for name, bench in [("pickle", bench_pickle), ("codec", bench_codec)]:
+        encode_time, decode_time, size = bench(frames)
+        print "{0:>8}: encode {1:>9.0f} events/s, decode {2:>9.0f} events/s, {3:>6.1f} bytes/event".format(
+            name,
+            event_count / encode_time,
+            event_count / decode_time,
+            float(size) / event_count
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Measure the throughput of the common event operations: parsing events
+from XML elements, copying, union and serializing events to XML elements.
+
+Run with: python -m abusehelper.core.tests.bench_events
+"""
+
+import time
+
+from idiokit.xmlcore import Element
+
+from ..events import Event
+from .bench_eventcodec import sample_events
+
+
+def bench_parse(events):
+    elements = []
+    for event in events:
+        element = Element("message")
+        element.add(event.to_elements())
+        elements.append(element)
+
+    def run():
+        for element in elements:
+            for _ in Event.from_elements(element):
+                pass
+    return run
+
+
+def bench_copy(events):
+    def run():
+        for event in events:
+            Event(event)
+    return run
+
+
+def bench_union(events):
+    extra = {"feed": "other feed", "description": "example description"}
+
+    def run():
+        for event in events:
+            event.union(extra)
+    return run
+
+
+def bench_serialize(events):
+    def run():
+        for event in events:
+            event.to_elements()
+    return run
+
+
+BENCHMARKS = [
+    ("parse", bench_parse),
+    ("copy", bench_copy),
+    ("union", bench_union),
+    ("serialize", bench_serialize)
+]
+
+
+def main(event_count=50000, rounds=3):
+    events = list(sample_events(event_count))
+
+    print "{0} events, best of {1} rounds".format(event_count, rounds)
+    for name, bench in BENCHMARKS:
+        run = bench(events)
+
+        best = None
+        for _ in xrange(rounds):
+            start = time.time()
+            run()
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+
+        print "{0:>10}: {1:>9.0f} events/s".format(name, event_count / best)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Measure loading a prefix to ASN dump of realistic size into the offline
+cymruwhois backend and the speed of the longest prefix match lookups.
+
+Run with: python -m abusehelper.core.tests.bench_pfx2as
+"""
+
+import time
+import random
+
+from .. import pfx2as
+
+
+def sample_lines(count, seed=0):
+    rand = random.Random(seed)
+    for _ in xrange(count):
+        length = rand.randint(8, 24)
+        network = rand.getrandbits(32) & ~((1 << (32 - length)) - 1)
+        address = ".".join(str((network >> shift) & 0xff) for shift in (24, 16, 8, 0))
+        yield "{0}\t{1}\t{2}".format(address, length, rand.randint(1, 400000))
+
+
+def sample_ips(count, seed=1):
+    rand = random.Random(seed)
+    for _ in xrange(count):
+        yield ".".join(str(rand.randint(0, 255)) for _ in xrange(4))
+
+
+def main(prefix_count=800000, lookup_count=200000):
+    lines = list(sample_lines(prefix_count))
+    ips = list(sample_ips(lookup_count))
+
+    start = time.time()
+    tables = pfx2as.Pfx2asTables(lines)
+    loaded = time.time() - start
+
+    start = time.time()
+    for ip in ips:
+        tables.get(ip)
+    looked_up = time.time() - start
+
+    print "{0} prefixes loaded in {1:.2f} s".format(len(tables), loaded)
+    print "{0} lookups: {1:.1f} us per lookup".format(
+        lookup_count,
+        looked_up / lookup_count * 1e6)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Compare the size and serialization cost of the event wire formats: the
+legacy <event> format and the compact <e> format, with and without the
+human-readable message body.
+
+Run with: python -m abusehelper.core.tests.bench_wireformat
+"""
+
+import time
+
+from idiokit.xmlcore import Element
+
+from ..events import Event
+from .bench_eventcodec import sample_events
+
+
+MODES = [
+    ("legacy", True, False),
+    ("legacy, no body", False, False),
+    ("compact", True, True),
+    ("compact, no body", False, True)
+]
+
+
+def bench(events, include_body, compact):
+    start = time.time()
+    messages = []
+    for event in events:
+        message = Element("message")
+        message.add(event.to_elements(include_body, compact))
+        messages.append(message)
+    serialize_time = time.time() - start
+
+    size = sum(len(x.serialize()) for x in messages)
+
+    start = time.time()
+    for message in messages:
+        for _ in Event.from_elements(message):
+            pass
+    parse_time = time.time() - start
+
+    return serialize_time, parse_time, size
+
+
+def main(event_count=20000):
+    events = list(sample_events(event_count))
+
+    print "{0} events, one event per message".format(event_count)
+    for name, include_body, compact in MODES:
+        serialize_time, parse_time, size = bench(events, include_body, compact)
+        print "{0:>17}: {1:>6.1f} bytes/event, to_elements {2:>5.1f} us/event, from_elements {3:>5.1f} us/event".format(
+            name,
+            float(size) / event_count,
+            1e6 * serialize_time / event_count,
+            1e6 * parse_time / event_count
+        )
+
+
+if __name__ == "__main__":
+    main()
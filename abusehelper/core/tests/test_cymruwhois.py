@@ -0,0 +1,227 @@
+import socket
+import threading
+import unittest
+import SocketServer
+
+import idiokit
+
+from .. import cymruwhois, events
+
+
+def _answer(ip):
+    if ip.startswith("192.0.2."):
+        return "64496   | {0:<16} | 192.0.2.0/24        | FI | ripencc  | 2016-01-01 | EXAMPLE-AS, FI\n".format(ip)
+    return "NA      | {0:<16} | NA                  |    |          |            | NA\n".format(ip)
+
+
+class _BulkHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        self.server.connections += 1
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            line = line.strip()
+            if line == "begin":
+                self.wfile.write("Bulk mode; whois.cymru.com [2016-02-10 12:00:00 +0000]\n")
+            elif line == "end":
+                if self.server.close_after_batch:
+                    return
+            elif line != "verbose":
+                self.wfile.write(_answer(line))
+
+
+class BulkWhoisServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    A local stand-in for the Team Cymru bulk whois service.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, close_after_batch=False):
+        SocketServer.TCPServer.__init__(self, ("127.0.0.1", 0), _BulkHandler)
+
+        self.close_after_batch = close_after_batch
+        self.connections = 0
+
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def address(self):
+        return self.server_address
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class TestBulkConnection(unittest.TestCase):
+    def _server(self, close_after_batch=False):
+        server = BulkWhoisServer(close_after_batch)
+        self.addCleanup(server.close)
+        return server
+
+    def _connection(self, server):
+        connection = cymruwhois._BulkConnection(server.address, timeout=5.0)
+        self.addCleanup(connection.close)
+        return connection
+
+    def test_batch_is_answered(self):
+        connection = self._connection(self._server())
+
+        results = connection.query(["192.0.2.1", "198.51.100.1"])
+        self.assertEqual(set(["192.0.2.1", "198.51.100.1"]), set(results))
+        self.assertEqual((), results["198.51.100.1"])
+
+        items = dict(results["192.0.2.1"])
+        self.assertEqual(u"64496", items["asn"])
+        self.assertEqual(u"192.0.2.0/24", items["bgp prefix"])
+        self.assertEqual(u"EXAMPLE-AS, FI", items["as name"])
+
+    def test_connection_is_kept_open(self):
+        server = self._server()
+        connection = self._connection(server)
+
+        connection.query(["192.0.2.1"])
+        connection.query(["192.0.2.2"])
+        self.assertEqual(1, server.connections)
+
+    def test_closed_connection_is_reopened(self):
+        server = self._server(close_after_batch=True)
+        connection = self._connection(server)
+
+        connection.query(["192.0.2.1"])
+        results = connection.query(["192.0.2.2"])
+        self.assertEqual(["192.0.2.2"], list(results))
+        self.assertEqual(2, server.connections)
+
+    def test_unavailable_server_raises_socket_error(self):
+        server = self._server()
+        connection = self._connection(server)
+        server.close()
+
+        self.assertRaises(socket.error, connection.query, ["192.0.2.1"])
+
+
+@idiokit.stream
+def _send(items):
+    for item in items:
+        yield idiokit.send(item)
+
+
+@idiokit.stream
+def _collect():
+    items = []
+    while True:
+        try:
+            item = yield idiokit.next()
+        except StopIteration:
+            break
+        items.append(item)
+    idiokit.stop(items)
+
+
+class _DelayedWhois(cymruwhois.CymruWhois):
+    """
+    A CymruWhois whose lookups finish after the given per-IP delays,
+    i.e. out of order, keeping track of the lookups running at once.
+    """
+
+    def __init__(self, delays, concurrency):
+        cymruwhois.CymruWhois.__init__(self, concurrency=concurrency)
+
+        self.delays = delays
+        self.running = 0
+        self.max_running = 0
+
+    @idiokit.stream
+    def lookup(self, ip):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            yield idiokit.sleep(self.delays.get(ip, 0.0))
+        finally:
+            self.running -= 1
+        idiokit.stop(((u"asn", u"64496"), (u"bgp prefix", ip + u"/32")))
+
+
+class TestAugment(unittest.TestCase):
+    def setUp(self):
+        self.ips = [u"192.0.2.{0}".format(index) for index in range(1, 9)]
+
+        # The first lookups are the slowest ones.
+        delays = dict((ip, 0.01 * (len(self.ips) - index)) for (index, ip) in enumerate(self.ips))
+        self.whois = _DelayedWhois(delays, concurrency=3)
+
+    def augment(self, event_list):
+        return idiokit.main_loop(_send(event_list) | self.whois.augment("ip") | _collect())
+
+    def test_events_are_sent_in_the_original_order(self):
+        event_list = [events.Event(ip=ip, n=unicode(index)) for (index, ip) in enumerate(self.ips)]
+        event_list.insert(3, events.Event(n=u"no ip"))
+
+        result = self.augment(event_list)
+        self.assertEqual([event.value("n") for event in event_list], [event.value("n") for event in result])
+        for event in result:
+            if event.contains("ip"):
+                self.assertEqual(event.value("ip") + u"/32", event.value("bgp prefix"))
+
+    def test_lookups_are_limited_by_concurrency(self):
+        self.augment([events.Event(ip=ip) for ip in self.ips])
+        self.assertEqual(3, self.whois.max_running)
+        self.assertEqual(0, self.whois.running)
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.queries = []
+
+    @idiokit.stream
+    def _query(self, key, delay):
+        self.queries.append(key)
+        yield idiokit.sleep(delay)
+        idiokit.stop(key.upper())
+
+    @idiokit.stream
+    def _run_all(self, flight, calls):
+        streams = [flight.run(key, self._query, key, delay) for (key, delay) in calls]
+
+        results = []
+        for stream in streams:
+            result = yield stream
+            results.append(result)
+        idiokit.stop(results)
+
+    def test_pending_keys_are_queried_once(self):
+        flight = cymruwhois._SingleFlight()
+        results = idiokit.main_loop(self._run_all(flight, [("a", 0.02), ("b", 0.01), ("a", 0.0)]))
+
+        self.assertEqual(["A", "B", "A"], results)
+        self.assertEqual(["a", "b"], self.queries)
+
+    def test_finished_keys_are_queried_again(self):
+        flight = cymruwhois._SingleFlight()
+        idiokit.main_loop(self._run_all(flight, [("a", 0.0)]))
+        idiokit.main_loop(self._run_all(flight, [("a", 0.0)]))
+
+        self.assertEqual(["a", "a"], self.queries)
+
+    def test_lookups_of_the_same_ip_share_a_query(self):
+        origin = cymruwhois.OriginLookup()
+        origin._query = lambda cache_key, query: self._query(cache_key, 0.01)
+
+        @idiokit.stream
+        def lookup_twice():
+            first = origin.lookup("192.0.2.1")
+            second = origin.lookup("192.0.2.1")
+            first_result = yield first
+            second_result = yield second
+            idiokit.stop([first_result, second_result])
+
+        self.assertEqual(["192.0.2.1", "192.0.2.1"], idiokit.main_loop(lookup_twice()))
+        self.assertEqual(["192.0.2.1"], self.queries)
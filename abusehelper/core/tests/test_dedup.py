@@ -0,0 +1,131 @@
+import pickle
+import hashlib
+import unittest
+
+from .. import dedup, events
+
+
+def _poll(previous, backend, event_list):
+    poll = dedup.start_poll(previous, backend, 0.001)
+    new = [event for event in event_list if poll.is_new(event)]
+    return new, poll.finish()
+
+
+class TestPolls(unittest.TestCase):
+    def _test_backend(self, backend):
+        a = events.Event(a="1")
+        b = events.Event(b="2")
+        c = events.Event(c="3")
+
+        new, first = _poll(None, backend, [a, b, a])
+        self.assertEqual([a, b], new)
+
+        new, second = _poll(first, backend, [b, c, c])
+        self.assertEqual([c], new)
+
+        # Only the events of the latest poll are remembered.
+        new, _ = _poll(second, backend, [a, b, c])
+        self.assertEqual([a], new)
+
+    def test_set_backend(self):
+        self._test_backend("set")
+
+    def test_array_backend(self):
+        self._test_backend("array")
+
+    def test_bloom_backend(self):
+        self._test_backend("bloom")
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, dedup.start_poll, None, "unknown")
+
+    def test_many_events_span_several_runs(self):
+        event_list = [events.Event(a=unicode(index)) for index in range(10000)]
+
+        new, first = _poll(None, "array", event_list + event_list[::-1])
+        self.assertEqual(event_list, new)
+        self.assertEqual(len(event_list), len(first))
+
+        new, _ = _poll(first, "array", event_list[::7] + [events.Event(b="1")])
+        self.assertEqual([events.Event(b="1")], new)
+
+
+class TestAbortedPolls(unittest.TestCase):
+    def _test_backend(self, backend):
+        a = events.Event(a="1")
+        b = events.Event(b="2")
+        c = events.Event(c="3")
+
+        _, first = _poll(None, backend, [a])
+
+        poll = dedup.start_poll(first, backend, 0.001)
+        self.assertTrue(poll.is_new(b))
+        aborted = poll.abort()
+
+        # Both the previous events and the ones sent before the failure
+        # are remembered.
+        new, _ = _poll(dedup.restore(aborted, backend, 0.001), backend, [a, b, c])
+        self.assertEqual([c], new)
+
+    def test_set_backend(self):
+        self._test_backend("set")
+
+    def test_array_backend(self):
+        self._test_backend("array")
+
+    def test_bloom_backend(self):
+        self._test_backend("bloom")
+
+    def test_empty_aborted_poll_keeps_the_previous_filter(self):
+        _, first = _poll(None, "bloom", [events.Event(a="1")])
+        self.assertIs(first, dedup.start_poll(first, "bloom", 0.001).abort())
+
+    def test_unions_survive_pickling(self):
+        _, first = _poll(None, "bloom", [events.Event(a="1")])
+        poll = dedup.start_poll(first, "bloom", 0.001)
+        poll.is_new(events.Event(b="2"))
+
+        unpickled = pickle.loads(pickle.dumps(poll.abort(), pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(2, len(unpickled))
+        self.assertIn(dedup.event_digest(events.Event(b="2")), unpickled)
+
+
+class TestRestore(unittest.TestCase):
+    def setUp(self):
+        self.event = events.Event(a="1")
+        _, self.legacy = _poll(None, "set", [self.event])
+
+    def test_legacy_filters_can_be_converted(self):
+        for backend in ["array", "bloom"]:
+            previous = dedup.restore(self.legacy, backend, 0.001)
+            new, _ = _poll(previous, backend, [self.event])
+            self.assertEqual([], new)
+
+    def test_array_filters_can_be_converted_to_bloom_filters(self):
+        _, previous = _poll(None, "array", [self.event])
+        previous = dedup.restore(previous, "bloom", 0.001)
+        self.assertIsInstance(previous, dedup.DigestBloom)
+        self.assertIn(dedup.event_digest(self.event), previous)
+
+    def test_compact_filters_can_not_be_converted_back(self):
+        _, previous = _poll(None, "bloom", [self.event])
+        self.assertIsNone(dedup.restore(previous, "array"))
+        self.assertIsNone(dedup.restore(previous, "set"))
+
+
+class TestPickling(unittest.TestCase):
+    def test_filters_survive_pickling(self):
+        event_list = [events.Event(a=unicode(index)) for index in xrange(100)]
+
+        for backend in ["array", "bloom"]:
+            _, original = _poll(None, backend, event_list)
+            unpickled = pickle.loads(pickle.dumps(original, pickle.HIGHEST_PROTOCOL))
+
+            self.assertEqual(len(original), len(unpickled))
+            for event in event_list:
+                self.assertIn(dedup.event_digest(event), unpickled)
+
+    def test_array_filters_pickle_compactly(self):
+        digests = [int(hashlib.md5(str(index)).hexdigest()[:16], 16) for index in xrange(1000)]
+        data = pickle.dumps(dedup.DigestArray(digests), pickle.HIGHEST_PROTOCOL)
+        self.assertLess(len(data), 1000 * 8 + 200)
@@ -1,6 +1,8 @@
 import pickle
 import unittest
 
+from idiokit.xmlcore import Element
+
 from .. import events
 
 
@@ -8,3 +10,94 @@ class TestEvent(unittest.TestCase):
     def test_pickling(self):
         e = events.Event({"a": "b"})
         self.assertEqual(e, pickle.loads(pickle.dumps(e)))
+
+
+class TestFrozenEvent(unittest.TestCase):
+    def test_pickling(self):
+        e = events.FrozenEvent({"a": "b"})
+        unpickled = pickle.loads(pickle.dumps(e))
+        self.assertEqual(e, unpickled)
+        self.assertTrue(isinstance(unpickled, events.FrozenEvent))
+
+    def test_immutability(self):
+        e = events.Event(a="b").freeze()
+        self.assertRaises(TypeError, e.add, "a", "c")
+        self.assertRaises(TypeError, e.update, "a", ["c"])
+        self.assertRaises(TypeError, e.discard, "a", "b")
+        self.assertRaises(TypeError, e.clear, "a")
+        self.assertRaises(TypeError, e.pop, "a")
+        self.assertEqual(e, events.Event(a="b"))
+
+    def test_thawing(self):
+        frozen = events.FrozenEvent(a="b")
+        thawed = events.Event(frozen)
+        thawed.add("a", "c")
+        self.assertEqual(frozen, events.Event(a="b"))
+        self.assertEqual(thawed, events.Event(a=["b", "c"]))
+
+    def test_digest_matches_mutable_event(self):
+        e = events.Event({u"\xe4": [u"x", u"y"], "b": "z"})
+        self.assertEqual(events.hexdigest(e), events.hexdigest(e.freeze()))
+
+    def test_keys_are_interned(self):
+        a = events.FrozenEvent({u"".join([u"k", u"ey"]): "a"})
+        b = events.FrozenEvent({u"".join([u"ke", u"y"]): "b"})
+        self.assertTrue(a.keys()[0] is b.keys()[0])
+
+    def test_no_instance_dict(self):
+        # The __slots__ of FrozenEvent only save memory when every base
+        # class defines __slots__ too.
+        e = events.FrozenEvent(a="b")
+        self.assertFalse(hasattr(e, "__dict__"))
+        self.assertRaises(AttributeError, setattr, e, "extra", 1)
+
+
+class TestJoinElements(unittest.TestCase):
+    def _message(self, elements):
+        message = Element("message")
+        message.add(elements)
+        return message
+
+    def test_events_should_roundtrip(self):
+        original = [events.Event(a="1"), events.Event(a="2", b="3"), events.Event()]
+        elements = [event.to_elements(include_body=False) for event in original]
+        message = self._message(events.join_elements(elements))
+        self.assertEqual(list(events.Event.from_elements(message)), original)
+
+    def test_body(self):
+        original = [events.Event(a="1"), events.Event(b="2")]
+        elements = [event.to_elements(include_body=False) for event in original]
+
+        message = self._message(events.join_elements(elements))
+        self.assertEqual(list(message.children("body")), [])
+
+        message = self._message(events.join_elements(elements, [unicode(x) for x in original]))
+        bodies = list(message.children("body"))
+        self.assertEqual(len(bodies), 1)
+        self.assertEqual(bodies[0].text, u"a=1\nb=2")
+
+
+class TestEventCodec(unittest.TestCase):
+    def test_roundtrip(self):
+        encoder = events.EventEncoder()
+        decoder = events.EventDecoder()
+
+        originals = [
+            events.Event(),
+            events.Event({"a": "b"}),
+            events.Event({"a": ["b", "c"], "d": "e"}),
+            events.Event({u"\xe4": [u"\u20ac", u""], "a": u"x" * 1000})
+        ]
+        for original in originals:
+            self.assertEqual(original, decoder.decode(encoder.encode(original)))
+
+    def test_key_dictionary_limit(self):
+        encoder = events.EventEncoder(max_keys=2)
+        decoder = events.EventDecoder(max_keys=2)
+
+        for index in xrange(10):
+            original = events.Event({
+                "key " + str(index): "value",
+                "key " + str(index % 3): "value"
+            })
+            self.assertEqual(original, decoder.decode(encoder.encode(original)))
@@ -0,0 +1,98 @@
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+
+from .. import pfx2as
+
+
+class TestPfx2asTables(unittest.TestCase):
+    def setUp(self):
+        self.tables = pfx2as.Pfx2asTables([
+            "# comment",
+            "",
+            "10.0.0.0 8 64496",
+            "10.1.0.0 16 64497",
+            "10.1.2.0 24 64498",
+            "10.200.0.0 16 64499",
+            "2001:db8::/32 64500 fi",
+            "2001:db8:1::/48 64501,64502"
+        ])
+
+    def asn(self, ip):
+        return dict(self.tables.get(ip)).get("asn", None)
+
+    def test_longest_prefix_matches(self):
+        self.assertEqual(u"64496", self.asn("10.0.0.1"))
+        self.assertEqual(u"64497", self.asn("10.1.0.1"))
+        self.assertEqual(u"64498", self.asn("10.1.2.255"))
+        self.assertEqual(u"64497", self.asn("10.1.3.0"))
+        self.assertEqual(u"64496", self.asn("10.2.0.0"))
+        self.assertEqual(u"64499", self.asn("10.200.255.255"))
+        self.assertEqual(u"64496", self.asn("10.255.255.255"))
+        self.assertEqual(None, self.asn("11.0.0.0"))
+        self.assertEqual(None, self.asn("9.255.255.255"))
+
+    def test_ipv6(self):
+        self.assertEqual(
+            ((u"asn", u"64500"), (u"bgp prefix", u"2001:db8::/32"), (u"cc", u"FI")),
+            self.tables.get("2001:db8::1"))
+        self.assertEqual(u"64501", self.asn("2001:db8:1::1"))
+        self.assertEqual((), self.tables.get("2001:db9::1"))
+
+    def test_non_ip_values(self):
+        self.assertEqual((), self.tables.get("not an ip"))
+
+    def test_invalid_lines(self):
+        for line in ["10.0.0.0 33 64496", "10.0.0.0 8", "10.0.0.0/8 AS64496", "x/8 64496"]:
+            self.assertRaises(ValueError, pfx2as.Pfx2asTables, [line])
+
+    def test_unaligned_networks_are_masked(self):
+        tables = pfx2as.Pfx2asTables(["10.0.0.1/8 64496"])
+        self.assertEqual(u"10.0.0.0/8", dict(tables.get("10.2.3.4"))["bgp prefix"])
+
+
+class TestPfx2asLookup(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "pfx2as.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, data, path=None):
+        # Replace the file atomically, as recommended for real dumps.
+        path = self.path if path is None else path
+        temp = path + ".tmp"
+        with open(temp, "wb") as fileobj:
+            fileobj.write(data)
+        os.rename(temp, path)
+
+    def test_gzipped_files(self):
+        path = self.path + ".gz"
+        fileobj = gzip.open(path, "wb")
+        try:
+            fileobj.write("192.0.2.0 24 64496\n")
+        finally:
+            fileobj.close()
+
+        lookup = pfx2as.Pfx2asLookup(path)
+        self.assertEqual(u"64496", dict(lookup.get("192.0.2.1"))["asn"])
+
+    def test_changed_files_are_reloaded(self):
+        self._write("192.0.2.0 24 64496\n")
+        lookup = pfx2as.Pfx2asLookup(self.path)
+        self.assertFalse(lookup.reload())
+
+        self._write("192.0.2.0 24 64497\n")
+        self.assertTrue(lookup.reload())
+        self.assertEqual(u"64497", dict(lookup.get("192.0.2.1"))["asn"])
+
+    def test_failed_reload_keeps_the_old_prefixes(self):
+        self._write("192.0.2.0 24 64496\n")
+        lookup = pfx2as.Pfx2asLookup(self.path)
+
+        self._write("192.0.2.0 24 64497\nbroken\n")
+        self.assertRaises(ValueError, lookup.reload)
+        self.assertEqual(u"64496", dict(lookup.get("192.0.2.1"))["asn"])
@@ -1,7 +1,12 @@
 import pickle
+import urllib2
 import unittest
+import threading
+import BaseHTTPServer
 
-from .. import utils
+import idiokit
+
+from .. import events, utils
 
 
 class TestCompressedCollection(unittest.TestCase):
@@ -31,3 +36,296 @@ class TestCompressedCollection(unittest.TestCase):
 
         original.append("cd")
         self.assertEqual(["ab", "cd"], list(original))
+
+
+@idiokit.stream
+def _send(items):
+    for item in items:
+        yield idiokit.send(item)
+
+
+@idiokit.stream
+def _collect():
+    items = []
+    while True:
+        try:
+            item = yield idiokit.next()
+        except StopIteration:
+            break
+        items.append(item)
+    idiokit.stop(items)
+
+
+class TestCSVToEvents(unittest.TestCase):
+    DATA = "a,b,c\n1,\"x\ny\",3\n4,,\"\"\"q\"\"\"\n7,8"
+
+    def parse_lines(self, **keys):
+        lines = self.DATA.splitlines(True)
+        return idiokit.main_loop(utils.csv_to_events(lines, **keys) | _collect())
+
+    def parse_chunks(self, chunks, **keys):
+        return idiokit.main_loop(_send(chunks) | utils.csv_to_events(**keys) | _collect())
+
+    def test_header_row_gives_the_keys(self):
+        self.assertEqual([
+            events.Event(a="1", b="x\ny", c="3"),
+            events.Event(a="4", c="\"q\""),
+            events.Event(a="7", b="8")
+        ], self.parse_lines())
+
+    def test_fixed_columns(self):
+        self.assertEqual([
+            events.Event(x="a", z="c"),
+            events.Event(x="1", z="3"),
+            events.Event(x="4", z="\"q\""),
+            events.Event(x="7")
+        ], self.parse_lines(columns=["x", None, "z"]))
+
+    def test_repeated_columns_are_merged(self):
+        self.assertEqual(
+            [events.Event(x=["1", "2"])],
+            idiokit.main_loop(utils.csv_to_events(["1,2"], columns=["x", "x"]) | _collect()))
+
+    def test_chunks_give_the_same_events_as_lines(self):
+        expected = self.parse_lines()
+        for split in range(len(self.DATA) + 1):
+            chunks = [self.DATA[:split], self.DATA[split:]]
+            self.assertEqual(expected, self.parse_chunks(chunks))
+
+    def test_single_byte_chunks(self):
+        self.assertEqual(self.parse_lines(), self.parse_chunks(list(self.DATA)))
+
+    def test_quotes_inside_unquoted_fields_are_literal(self):
+        data = "a,b\n1,x\"y\n2,3\n"
+        expected = [events.Event(a="1", b="x\"y"), events.Event(a="2", b="3")]
+        self.assertEqual(expected, self.parse_chunks([data]))
+
+        # The rows are emitted as soon as they are complete.
+        lines = utils._RowLines()
+        self.assertEqual(["a,b\n", "1,x\"y\n"], lines.feed(data[:12]))
+
+    def test_quotes_are_handled_like_the_csv_module_does(self):
+        for data in ["a,b\n\"1\"x\"\ny\",2\n", "a,b\n\"1\"\"\n\",\"\"\n3,\"\n"]:
+            expected = idiokit.main_loop(utils.csv_to_events(data.splitlines(True)) | _collect())
+            for split in range(len(data) + 1):
+                self.assertEqual(expected, self.parse_chunks([data[:split], data[split:]]))
+
+    def test_named_charsets_are_decoded_strictly(self):
+        self.assertEqual(
+            [events.Event(a=u"\xe4")],
+            idiokit.main_loop(utils.csv_to_events(["a\n", "\xe4\n"], charset="latin-1") | _collect()))
+        self.assertRaises(
+            UnicodeDecodeError,
+            idiokit.main_loop, utils.csv_to_events(["a\n", "\xe4\n"], charset="utf-8") | _collect())
+
+        # Without a charset invalid UTF-8 falls back to latin-1.
+        self.assertEqual(
+            [events.Event(a=u"\xe4")],
+            idiokit.main_loop(utils.csv_to_events(["a\n", "\xe4\n"]) | _collect()))
+
+    def test_other_delimiters(self):
+        self.assertEqual(
+            [events.Event(a="1\"", b="x\ny")],
+            self.parse_chunks(["a;b\n1\";\"x\ny\"\n"], delimiter=";"))
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_least_recently_used_items_are_evicted(self):
+        cache = utils.LRUCache(60.0, max_size=3)
+        for key in "abc":
+            cache.set(key, key)
+        cache.get("a", None)
+        cache.set("d", "d")
+
+        self.assertEqual(3, len(cache))
+        self.assertEqual(None, cache.get("b", None))
+        self.assertEqual(["a", "c", "d"], [cache.get(key, None) for key in "acd"])
+        self.assertEqual(1, cache.pop_stats()["evictions"])
+
+    def test_setting_a_hot_key_does_not_grow_the_cache(self):
+        cache = utils.LRUCache(60.0)
+        for value in xrange(1000):
+            cache.set("key", value)
+        self.assertEqual(1, len(cache))
+        self.assertEqual(999, cache.get("key", None))
+
+    def test_expired_items_are_misses(self):
+        cache = utils.LRUCache(0.0)
+        cache.set("a", 1)
+        self.assertEqual(None, cache.get("a", None))
+        self.assertEqual(0, len(cache))
+
+    def test_negative_items_expire_separately(self):
+        cache = utils.LRUCache(60.0, negative_cache_time=0.0)
+        cache.set("a", 1)
+        cache.set("b", (), negative=True)
+        self.assertEqual(1, cache.get("a", None))
+        self.assertEqual(None, cache.get("b", None))
+
+    def test_expired_items_are_swept_on_set(self):
+        cache = utils.LRUCache(60.0, negative_cache_time=0.0)
+        for key in xrange(10):
+            cache.set(key, (), negative=True)
+        cache.set("a", 1)
+        self.assertEqual(1, len(cache))
+
+    def test_named_cache_stats(self):
+        cache = utils.LRUCache(60.0, negative_cache_time=60.0, name="test cache")
+        cache.set("a", 1)
+        cache.set("b", (), negative=True)
+        cache.get("a", None)
+        cache.get("b", None)
+        cache.get("c", None)
+
+        stats = dict(utils.pop_cache_stats())["test cache"]
+        self.assertEqual(2, stats["hits"])
+        self.assertEqual(1, stats["negative hits"])
+        self.assertEqual(1, stats["misses"])
+        self.assertEqual(0, stats["evictions"])
+        self.assertEqual(2, stats["size"])
+
+        # The counters are reset after popping.
+        self.assertEqual(0, dict(utils.pop_cache_stats())["test cache"]["hits"])
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append((self.client_address, dict(self.headers)))
+
+        if self.headers.get("if-none-match", None) == "\"v1\"":
+            self.send_response(304)
+            self.send_header("ETag", "\"v1\"")
+            self.end_headers()
+            return
+
+        body = "body"
+        self.send_response(200)
+        self.send_header("ETag", "\"v1\"")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        if self.server.drop_connections:
+            # Close the connection without telling the client, as
+            # servers do with connections that have been idle too long.
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class _HTTPTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.requests = []
+        self.server.drop_connections = False
+        self.url = "http://127.0.0.1:{0}/feed".format(self.server.server_port)
+
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def connections(self):
+        return len(set(address for (address, _) in self.server.requests))
+
+
+class TestKeepAliveHandler(_HTTPTestCase):
+    def test_connections_are_reused(self):
+        pool = utils.KeepAliveHandler()
+        opener = urllib2.build_opener(pool)
+        try:
+            for _ in range(3):
+                fileobj = opener.open(self.url, timeout=5.0)
+                self.assertEqual("body", fileobj.read())
+                fileobj.close()
+        finally:
+            pool.close()
+
+        self.assertEqual(3, len(self.server.requests))
+        self.assertEqual(1, self.connections())
+
+    def test_partially_read_connections_are_not_reused(self):
+        pool = utils.KeepAliveHandler()
+        opener = urllib2.build_opener(pool)
+        try:
+            for _ in range(2):
+                fileobj = opener.open(self.url, timeout=5.0)
+                fileobj.read(1)
+                fileobj.close()
+        finally:
+            pool.close()
+
+        self.assertEqual(2, self.connections())
+
+    def test_requests_are_retried_when_idle_connections_have_been_closed(self):
+        self.server.drop_connections = True
+
+        pool = utils.KeepAliveHandler()
+        opener = urllib2.build_opener(pool)
+        try:
+            for _ in range(2):
+                self.assertEqual("body", opener.open(self.url, timeout=5.0).read())
+        finally:
+            pool.close()
+
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_expired_connections_are_not_reused(self):
+        pool = utils.KeepAliveHandler(max_idle_time=0.0)
+        opener = urllib2.build_opener(pool)
+        try:
+            for _ in range(2):
+                opener.open(self.url, timeout=5.0).read()
+        finally:
+            pool.close()
+
+        self.assertEqual(2, self.connections())
+
+
+class TestFetchUrl(_HTTPTestCase):
+    def fetch(self, **keys):
+        info, fileobj = idiokit.main_loop(utils.fetch_url(self.url, **keys))
+        return fileobj.read()
+
+    def test_validators_are_sent(self):
+        info, fileobj = idiokit.main_loop(utils.fetch_url(self.url))
+        validators = utils.response_validators(info)
+        self.assertEqual(("\"v1\"", None), validators)
+
+        self.assertRaises(utils.FetchUrlNotModified, self.fetch, validators=validators)
+        _, headers = self.server.requests[-1]
+        self.assertEqual("\"v1\"", headers["if-none-match"])
+
+    def test_open_url_streams_the_body_in_chunks(self):
+        info, fileobj = idiokit.main_loop(utils.open_url(self.url))
+        try:
+            chunks = idiokit.main_loop(utils.read_chunks(fileobj, chunk_size=1) | _collect())
+        finally:
+            fileobj.close()
+
+        self.assertEqual(["b", "o", "d", "y"], chunks)
+        self.assertEqual("\"v1\"", info["etag"])
+
+    def test_not_modified_is_not_a_failure(self):
+        self.assertFalse(issubclass(utils.FetchUrlNotModified, utils.FetchUrlFailed))
+
+    def test_connections_are_reused_after_not_modified(self):
+        pool = utils.KeepAliveHandler()
+        opener = urllib2.build_opener(pool)
+        validators = ("\"v1\"", None)
+        try:
+            self.fetch(opener=opener)
+            self.assertRaises(utils.FetchUrlNotModified, self.fetch, opener=opener, validators=validators)
+            self.assertRaises(utils.FetchUrlNotModified, self.fetch, opener=opener, validators=validators)
+        finally:
+            pool.close()
+
+        self.assertEqual(3, len(self.server.requests))
+        self.assertEqual(1, self.connections())
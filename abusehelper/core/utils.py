@@ -1,14 +1,18 @@
 from __future__ import absolute_import
 
+import re
 import csv
 import ssl
+import codecs
 import gzip
 import time
 import socket
 import httplib
 import urllib2
+import itertools
+import threading
 import traceback
-import collections
+import contextlib
 import email.parser
 import cPickle as pickle
 
@@ -17,7 +21,7 @@ import idiokit
 from idiokit import heap
 from cStringIO import StringIO
 
-from . import events
+from . import events, cache
 
 
 def format_exception(exc):
@@ -46,6 +50,17 @@ class HTTPError(FetchUrlFailed):
         return "HTTP Error {0}: {1}".format(self.code, self.msg)
 
 
+class FetchUrlNotModified(Exception):
+    """
+    Raised by fetch_url when the server reports that the resource has not
+    been modified since it was last fetched with the same validators.
+
+    Deliberately not a FetchUrlFailed subclass, so that code handling
+    download failures doesn't mistake an unmodified resource for an
+    empty one.
+    """
+
+
 def _is_timeout(reason):
     r"""
     Return True if the parameter looks like a socket timeout error.
@@ -82,30 +97,181 @@ def _is_timeout(reason):
     )
 
 
-@idiokit.stream
-def fetch_url(url, opener=None, timeout=60.0, chunk_size=16384):
-    if opener is None:
-        opener = urllib2.build_opener()
+class _PooledResponse(object):
+    # A socket-like adapter for a HTTP response that hands the connection
+    # back to the pool when the response is closed after being read in
+    # full, and closes the connection otherwise.
 
-    try:
-        output = StringIO()
+    def __init__(self, pool, key, connection, response):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+
+    def recv(self, amt):
+        return self._response.read(amt)
+
+    def close(self):
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+
+        response = self._response
+        complete = response.isclosed() or response.length == 0
+        response.close()
+
+        if complete and not response.will_close:
+            self._pool._checkin(self._key, connection)
+        else:
+            connection.close()
 
-        fileobj = yield idiokit.thread(opener.open, url, timeout=timeout)
+
+class KeepAliveHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+    """
+    A urllib2 handler for HTTP and HTTPS URLs that keeps the connections
+    to each host open and reuses them for later requests, instead of
+    closing them after each request. At most max_idle connections per
+    host are kept open, each for at most max_idle_time seconds.
+
+    A connection is reused only after its previous response has been
+    read in full and closed. Connections through HTTPS proxies are not
+    pooled.
+    """
+
+    def __init__(self, max_idle=4, max_idle_time=60.0, debuglevel=0):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+
+        self._max_idle = max_idle
+        self._max_idle_time = max_idle_time
+
+        self._lock = threading.Lock()
+        self._idle = dict()
+
+    def http_open(self, req):
+        return self._pooled_open(httplib.HTTPConnection, req)
+
+    def https_open(self, req):
+        return self._pooled_open(httplib.HTTPSConnection, req)
+
+    def _checkout(self, key):
+        expired = []
         try:
-            while True:
-                data = yield idiokit.thread(fileobj.read, chunk_size)
-                if not data:
-                    break
-                output.write(data)
+            with self._lock:
+                idle = self._idle.get(key, [])
+                while idle:
+                    idle_since, connection = idle.pop()
+                    if time.time() - idle_since <= self._max_idle_time:
+                        return connection
+                    expired.append(connection)
+                self._idle.pop(key, None)
+            return None
         finally:
-            fileobj.close()
+            for connection in expired:
+                connection.close()
+
+    def _checkin(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self._max_idle:
+                idle.append((time.time(), connection))
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, dict()
+
+        for connections in idle.values():
+            for _, connection in connections:
+                connection.close()
+
+    def _request(self, connection, req, headers):
+        connection.request(req.get_method(), req.get_selector(), req.data, headers)
+        try:
+            return connection.getresponse(buffering=True)
+        except TypeError:
+            return connection.getresponse()
+
+    def _pooled_open(self, http_class, req):
+        if req._tunnel_host:
+            return self.do_open(http_class, req)
+
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError("no host given")
+        key = http_class, host
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for (k, v) in req.headers.items() if k not in headers)
+        headers = dict((name.title(), value) for (name, value) in headers.items())
+
+        # Requests that are not safe to retry get fresh connections, as
+        # an idle connection may have been closed by the server.
+        if req.get_method() in ("GET", "HEAD"):
+            connection = self._checkout(key)
+            if connection is not None:
+                connection.timeout = req.timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(req.timeout)
+
+                try:
+                    response = self._request(connection, req, headers)
+                except (socket.error, httplib.HTTPException):
+                    connection.close()
+                else:
+                    return self._wrap(key, connection, response, req)
+
+        connection = http_class(host, timeout=req.timeout)
+        connection.set_debuglevel(self._debuglevel)
+        try:
+            response = self._request(connection, req, headers)
+        except socket.error as error:
+            connection.close()
+            raise urllib2.URLError(error)
+        except httplib.HTTPException:
+            connection.close()
+            raise
+        return self._wrap(key, connection, response, req)
+
+    def _wrap(self, key, connection, response, req):
+        fp = socket._fileobject(_PooledResponse(self, key, connection, response), close=True)
+
+        resp = urllib2.addinfourl(fp, response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+
+def _add_validators(request, validators):
+    if validators is None:
+        return
+
+    etag, last_modified = validators
+    if etag is not None:
+        request.add_header("If-None-Match", etag)
+    if last_modified is not None:
+        request.add_header("If-Modified-Since", last_modified)
+
+
+def response_validators(info):
+    """
+    Return the validators of a response, i.e. an (ETag, Last-Modified)
+    pair from the headers returned by open_url or fetch_url, or None
+    when the response has neither.
+    """
+
+    etag = info.get("etag", None)
+    last_modified = info.get("last-modified", None)
 
-        info = fileobj.info()
-        info = email.parser.Parser().parsestr(str(info), headersonly=True)
+    if etag is None and last_modified is None:
+        return None
+    return etag, last_modified
 
-        output.seek(0)
 
-        idiokit.stop(info, output)
+@contextlib.contextmanager
+def _fetch_errors():
+    try:
+        yield
     except urllib2.HTTPError as he:
         raise HTTPError(he.code, he.msg, he.hdrs, he.fp)
     except urllib2.URLError as error:
@@ -120,6 +286,85 @@ def fetch_url(url, opener=None, timeout=60.0, chunk_size=16384):
         raise FetchUrlFailed(str(error))
 
 
+@idiokit.stream
+def open_url(url, opener=None, timeout=60.0, validators=None):
+    """
+    Open the given URL (a string or an urllib2.Request) and return the
+    response headers and the response as a file object, which is read
+    as the body downloads instead of being buffered in memory first.
+    Reading the file object blocks, so read it with read_chunks, and
+    close it afterwards.
+
+    When validators from a previous response are given (see
+    response_validators), the request is sent as a conditional GET,
+    and FetchUrlNotModified is raised when the server responds that the
+    resource has not been modified. The caller decides when to store
+    the validators of the new response, e.g. only after the body has
+    been successfully processed.
+    """
+
+    if opener is None:
+        opener = urllib2.build_opener()
+
+    if validators is not None:
+        if not isinstance(url, urllib2.Request):
+            url = urllib2.Request(url)
+        _add_validators(url, validators)
+
+    with _fetch_errors():
+        try:
+            fileobj = yield idiokit.thread(opener.open, url, timeout=timeout)
+        except urllib2.HTTPError as he:
+            if he.code != httplib.NOT_MODIFIED or validators is None:
+                raise
+            if he.fp is not None:
+                he.fp.close()
+            raise FetchUrlNotModified("{0!r} has not been modified".format(url.get_full_url()))
+
+    info = fileobj.info()
+    info = email.parser.Parser().parsestr(str(info), headersonly=True)
+    idiokit.stop(info, fileobj)
+
+
+@idiokit.stream
+def read_chunks(fileobj, chunk_size=16384):
+    """
+    Read the file object (e.g. one returned by open_url) in a separate
+    thread and send the data onwards in chunks as it arrives.
+    """
+
+    with _fetch_errors():
+        while True:
+            data = yield idiokit.thread(fileobj.read, chunk_size)
+            if not data:
+                break
+            yield idiokit.send(data)
+
+
+@idiokit.stream
+def fetch_url(url, opener=None, timeout=60.0, chunk_size=16384, validators=None):
+    """
+    Like open_url, but download the whole response body into memory
+    and return it as a file object.
+    """
+
+    info, fileobj = yield open_url(url, opener, timeout, validators)
+    try:
+        output = StringIO()
+
+        with _fetch_errors():
+            while True:
+                data = yield idiokit.thread(fileobj.read, chunk_size)
+                if not data:
+                    break
+                output.write(data)
+    finally:
+        fileobj.close()
+
+    output.seek(0)
+    idiokit.stop(info, output)
+
+
 def force_decode(string, encodings=["ascii", "utf-8"]):
     if isinstance(string, unicode):
         return string
@@ -132,6 +377,50 @@ def force_decode(string, encodings=["ascii", "utf-8"]):
     return string.decode("latin-1", "replace")
 
 
+def _to_utf8(line):
+    r"""
+    Return the line encoded in UTF-8, decoding str lines like
+    force_decode does. Lines that already are valid UTF-8 (including
+    plain ASCII) are returned as they are without re-encoding.
+
+    >>> _to_utf8("a\xc3\xa4")
+    'a\xc3\xa4'
+    >>> _to_utf8("a\xe4")
+    'a\xc3\xa4'
+    >>> _to_utf8(u"a\xe4")
+    'a\xc3\xa4'
+    """
+
+    if isinstance(line, unicode):
+        return line.encode("utf-8")
+
+    try:
+        line.decode("utf-8")
+    except UnicodeDecodeError:
+        return line.decode("latin-1", "replace").encode("utf-8")
+    return line
+
+
+def _strict_utf8(line):
+    r"""
+    Return the line encoded in UTF-8 like _to_utf8, but raise
+    UnicodeDecodeError for str lines that are not valid UTF-8.
+
+    >>> _strict_utf8("a\xc3\xa4")
+    'a\xc3\xa4'
+    >>> _strict_utf8("a\xe4")
+    Traceback (most recent call last):
+    ...
+    UnicodeDecodeError: 'utf8' codec can't decode byte 0xe4 in position 1: unexpected end of data
+    """
+
+    if isinstance(line, unicode):
+        return line.encode("utf-8")
+
+    line.decode("utf-8")
+    return line
+
+
 class _CSVReader(object):
     r"""
     >>> list(_CSVReader(["\"x\",\"y\""]))
@@ -142,7 +431,13 @@ class _CSVReader(object):
         self._lines = lines
         self._last_lines = []
         self._keys = keys
-        self._decode = force_decode if charset is None else lambda x: x.decode(charset)
+
+        if charset is None:
+            self._to_utf8 = _to_utf8
+        elif codecs.lookup(charset).name == "utf-8":
+            self._to_utf8 = _strict_utf8
+        else:
+            self._to_utf8 = lambda x: x.decode(charset).encode("utf-8")
 
     def _iterlines(self):
         r"""
@@ -152,9 +447,13 @@ class _CSVReader(object):
         [[u'x\x00', u'x\x00']]
         """
 
+        to_utf8 = self._to_utf8
         for line in self._lines:
-            self._last_lines.append(self._decode(line).encode("utf-8").replace("\x00", "\xc0"))
-            yield self._last_lines[-1]
+            line = to_utf8(line)
+            if "\x00" in line:
+                line = line.replace("\x00", "\xc0")
+            self._last_lines.append(line)
+            yield line
 
     def _normalize(self, value):
         return value.replace("\xc0", "\x00").decode("utf-8").strip()
@@ -209,53 +508,173 @@ class _CSVReader(object):
                 yield row
 
 
-@idiokit.stream
-def csv_to_events(fileobj, delimiter=",", columns=None, charset=None):
-    for row in _CSVReader(fileobj, charset=charset, delimiter=delimiter):
-        if columns is None:
-            columns = row
-            continue
-
-        event = events.Event()
-        for key, value in zip(columns, row):
+# The states of the csv module's (non-strict) parser that matter for
+# telling where rows end.
+_START_FIELD, _IN_FIELD, _IN_QUOTED_FIELD, _QUOTE_IN_QUOTED_FIELD = range(4)
+
+
+class _RowLines(object):
+    r"""
+    Split chunks of CSV data into lines and group the lines so that a
+    quoted value spanning several lines is never split.
+
+    >>> lines = _RowLines()
+    >>> lines.feed('a,b\nc,"d\ne')
+    ['a,b\n']
+    >>> lines.feed('",f\ng')
+    ['c,"d\n', 'e",f\n']
+    >>> lines.finish()
+    ['g']
+
+    Like in the csv module, a quote starts a quoted value only at the
+    start of a field. Elsewhere it is a part of the value.
+
+    >>> lines = _RowLines()
+    >>> lines.feed('a,b"c\nd,"e""\nf"\n')
+    ['a,b"c\n', 'd,"e""\n', 'f"\n']
+    """
+
+    def __init__(self, delimiter=",", quotechar='"'):
+        self._quotechar = quotechar
+        self._specials = re.compile("[" + re.escape(delimiter + quotechar) + "]")
+        self._partial = []
+        self._row = []
+        self._state = _START_FIELD
+
+    def _scan(self, line, state):
+        # Follow the csv module's parser over the special characters of
+        # the line, given the state at its start, and return the state
+        # at its end.
+        quotechar = self._quotechar
+        position = 0
+
+        for match in self._specials.finditer(line):
+            if match.start() > position and state in (_START_FIELD, _QUOTE_IN_QUOTED_FIELD):
+                state = _IN_FIELD
+            position = match.end()
+
+            if match.group() == quotechar:
+                if state == _IN_QUOTED_FIELD:
+                    state = _QUOTE_IN_QUOTED_FIELD
+                elif state != _IN_FIELD:
+                    # Opens a quoted field, or is the second quote of
+                    # a doubled quote.
+                    state = _IN_QUOTED_FIELD
+            elif state != _IN_QUOTED_FIELD:
+                state = _START_FIELD
+        return state
+
+    def feed(self, data):
+        pieces = data.split("\n")
+
+        complete = []
+        for piece in pieces[:-1]:
+            self._partial.append(piece)
+            line = "".join(self._partial) + "\n"
+            self._partial = []
+
+            # A line ends a row unless it ends inside a quoted field.
+            self._row.append(line)
+            if self._quotechar in line:
+                self._state = self._scan(line, self._state)
+            if self._state != _IN_QUOTED_FIELD:
+                complete.extend(self._row)
+                self._row = []
+                self._state = _START_FIELD
+
+        if pieces[-1]:
+            self._partial.append(pieces[-1])
+        return complete
+
+    def finish(self):
+        rest = self._row
+        if self._partial:
+            rest.append("".join(self._partial))
+
+        self._partial = []
+        self._row = []
+        self._state = _START_FIELD
+        return rest
+
+
+class _RowConverter(object):
+    def __init__(self, columns=None):
+        self._keys = None
+        if columns is not None:
+            self._keys = self._normalize_keys(columns)
+
+    def _normalize_keys(self, columns):
+        return [None if key is None else unicode(key) for key in columns]
+
+    def convert(self, row):
+        """
+        Return an event built from the row, or None when the row was
+        consumed as the header row.
+        """
+
+        # The keys are normalized only once, so the attributes can be
+        # collected directly instead of going through Event.add.
+        keys = self._keys
+        if keys is None:
+            self._keys = self._normalize_keys(row)
+            return None
+
+        attrs = dict()
+        for key, value in itertools.izip(keys, row):
             if key is None or not value:
                 continue
-            event.add(key, value)
 
-        yield idiokit.send(event)
+            values = attrs.get(key, None)
+            if values is None:
+                attrs[key] = set([value])
+            else:
+                values.add(value)
+        return events.Event._from_trusted(attrs)
+
 
+@idiokit.stream
+def csv_to_events(fileobj=None, delimiter=",", columns=None, charset=None):
+    """
+    Parse CSV rows from the given iterable of lines into events, using
+    the given columns or the first row as the event keys.
 
-class TimedCache(object):
-    def __init__(self, cache_time):
-        self.cache = dict()
-        self.queue = collections.deque()
-        self.cache_time = cache_time
+    When fileobj is None the CSV data is taken from the stream's input
+    as chunks of arbitrary size, e.g. from read_chunks, and parsed as
+    it arrives.
+    """
 
-    def _expire(self):
-        current_time = time.time()
+    converter = _RowConverter(columns)
 
-        while self.queue:
-            expire_time, key = self.queue[0]
-            if expire_time > current_time:
-                break
-            self.queue.popleft()
-
-            other_time, _ = self.cache[key]
-            if other_time == expire_time:
-                del self.cache[key]
-
-    def get(self, key, default):
-        self._expire()
-        if key not in self.cache:
-            return default
-        _, value = self.cache[key]
-        return value
-
-    def set(self, key, value):
-        self._expire()
-        expire_time = time.time() + self.cache_time
-        self.queue.append((expire_time, key))
-        self.cache[key] = expire_time, value
+    if fileobj is not None:
+        for row in _CSVReader(fileobj, charset=charset, delimiter=delimiter):
+            event = converter.convert(row)
+            if event is not None:
+                yield idiokit.send(event)
+        return
+
+    lines = _RowLines(delimiter)
+    while True:
+        try:
+            data = yield idiokit.next()
+        except StopIteration:
+            break
+
+        for row in _CSVReader(lines.feed(data), charset=charset, delimiter=delimiter):
+            event = converter.convert(row)
+            if event is not None:
+                yield idiokit.send(event)
+
+    for row in _CSVReader(lines.finish(), charset=charset, delimiter=delimiter):
+        event = converter.convert(row)
+        if event is not None:
+            yield idiokit.send(event)
+
+
+# The caches live in their own module so that modules which must not
+# depend on idiokit can use them too.
+LRUCache = cache.LRUCache
+TimedCache = cache.TimedCache
+pop_cache_stats = cache.pop_cache_stats
 
 
 class WaitQueue(object):
@@ -0,0 +1,251 @@
+"""
+Query events from ArchiveBot archive files.
+
+The events are read from the given archive files (plain JSON lines or
+gzip compressed) and the ones matching the given rule are printed out as
+JSON lines. When an archive file has a sidecar index (see ArchiveBot's
+index_keys parameter) only the blocks whose write time overlaps the
+queried time range and whose Bloom filters may contain the queried
+key-value pairs are read, along with any data the indexed blocks don't
+cover (e.g. a block written without its index line).
+
+Example:
+
+    python -m abusehelper.tools.archivequery \\
+        --start="2016-02-09 10:00:00Z" --end="2016-02-09 11:00:00Z" \\
+        'ip=192.0.2.1' archive/room@conference.example.com/2016/02/09.json.gz
+"""
+
+import os
+import sys
+import gzip
+import json
+import zlib
+import contextlib
+from cStringIO import StringIO
+
+from abusehelper.core import bot, bloom, events, rules
+from abusehelper.core.archivebot import isoparse
+from abusehelper.bots.archivebot.archivebot import index_path, index_item, canonical_ip
+
+
+def index_values(rule):
+    r"""
+    Return a set of (key, value) pairs at least one of which an event has
+    to contain to match the rule, or None if no such set can be
+    determined.
+
+    >>> sorted(index_values(rules.rule('ip=192.0.2.1 or asn="64496"')))
+    [(u'asn', u'64496'), (u'ip', u'192.0.2.1')]
+    >>> index_values(rules.rule('ip in 192.0.2.0/24')) is None
+    True
+    """
+
+    if isinstance(rule, rules.Match):
+        if not isinstance(rule.key, rules.String):
+            return None
+
+        value = rule.value
+        if isinstance(value, rules.String):
+            return set([(rule.key.value, value.value)])
+        if isinstance(value, rules.IP):
+            # Matches values written in any form of the address, so
+            # look for the canonical form ArchiveBot indexes as well.
+            address = canonical_ip(unicode(value.range))
+            if address is not None:
+                return set([(rule.key.value, address)])
+        return None
+
+    if isinstance(rule, rules.Or):
+        result = set()
+        for subrule in rule.subrules:
+            values = index_values(subrule)
+            if values is None:
+                return None
+            result.update(values)
+        return result
+
+    if isinstance(rule, rules.And):
+        result = None
+        for subrule in rule.subrules:
+            values = index_values(subrule)
+            if values is not None and (result is None or len(values) < len(result)):
+                result = values
+        return result
+
+    return None
+
+
+def _read_index(path):
+    blocks = []
+    with open(path, "rb") as index:
+        for line in index:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                blocks.append(json.loads(line))
+            except ValueError:
+                # A partially written last line after a crash.
+                break
+    return blocks
+
+
+def _is_selected(block, start, end, items):
+    if start is not None and block["end"] < start:
+        return False
+    if end is not None and block["start"] > end:
+        return False
+
+    if items is not None:
+        bloom_filter = bloom.BloomFilter.from_string(str(block["bloom"]))
+        if not any(item in bloom_filter for item in items):
+            return False
+    return True
+
+
+# The errors of reading a damaged or partially written gzip member.
+READ_ERRORS = (IOError, EOFError, zlib.error)
+
+
+def _read_lines(fileobj, path, errors):
+    try:
+        for line in fileobj:
+            yield line
+    except READ_ERRORS as error:
+        errors.append("{0}: {1}".format(path, error))
+
+
+def _range_lines(fileobj, offset, size, path, errors):
+    fileobj.seek(offset)
+    data = fileobj.read(size)
+    if data[:2] == "\x1f\x8b":
+        try:
+            data = gzip.GzipFile(fileobj=StringIO(data)).read()
+        except READ_ERRORS as error:
+            errors.append("{0}: data at offset {1}: {2}".format(path, offset, error))
+            return []
+    return data.splitlines(True)
+
+
+def _tail_lines(fileobj, offset, path, errors):
+    fileobj.seek(offset)
+    magic = fileobj.read(2)
+    if not magic:
+        return []
+
+    fileobj.seek(offset)
+    if magic == "\x1f\x8b":
+        fileobj = gzip.GzipFile(fileobj=fileobj, mode="rb")
+    return _read_lines(fileobj, path, errors)
+
+
+@contextlib.contextmanager
+def _open_archive(path):
+    if path.endswith(".gz"):
+        with contextlib.closing(gzip.GzipFile(path, "rb")) as archive:
+            yield archive
+    else:
+        with open(path, "rb") as archive:
+            yield archive
+
+
+def query_blocks(path, start=None, end=None, values=None, errors=None):
+    """
+    Like query_lines, but yield (block, lines) pairs, where block is the
+    index block (a dict) the lines were read from, or None for the lines
+    of unindexed data.
+    """
+
+    if errors is None:
+        errors = []
+
+    if not os.path.isfile(index_path(path)):
+        with _open_archive(path) as archive:
+            yield None, _read_lines(archive, path, errors)
+        return
+
+    items = None
+    if values is not None:
+        items = [index_item(key, value) for (key, value) in values]
+
+    blocks = sorted(_read_index(index_path(path)), key=lambda block: block["offset"])
+    with open(path, "rb") as archive:
+        position = 0
+        for block in blocks:
+            if block["offset"] > position:
+                yield None, _range_lines(archive, position, block["offset"] - position, path, errors)
+            if _is_selected(block, start, end, items):
+                yield block, _range_lines(archive, block["offset"], block["size"], path, errors)
+            position = max(position, block["offset"] + block["size"])
+
+        yield None, _tail_lines(archive, position, path, errors)
+
+
+def query_lines(path, start=None, end=None, values=None, errors=None):
+    """
+    Yield the JSON lines from the archive file that may match the time
+    range and key-value pairs, using the file's sidecar index if there is
+    one. Without an index all lines are yielded.
+
+    The data not covered by the indexed blocks is always read, as blocks
+    can get written without their index lines (e.g. on a crash between
+    the two writes or when writing the index fails).
+
+    Damaged or partially written gzip data is skipped: the rest of an
+    unindexed file, or the damaged indexed block. Messages describing
+    these are appended to the errors list when one is given.
+    """
+
+    for _, lines in query_blocks(path, start, end, values, errors):
+        for line in lines:
+            yield line
+
+
+class _TimeParam(bot.Param):
+    def parse(self, value):
+        timestamp = isoparse(value)
+        if timestamp is None:
+            raise bot.ParamError("not a valid timestamp (e.g. \"2016-02-09 10:00:00Z\"): " + repr(value))
+        return timestamp
+
+
+class ArchiveQuery(bot.Bot):
+    bot_name = "archivequery"
+    rule = bot.Param("""
+        rulelang expression the printed events have to match
+        """)
+    paths = bot.ListParam("""
+        comma separated list of archive files to query
+        """)
+    start = _TimeParam("""
+        skip index blocks written before this UTC time
+        (e.g. "2016-02-09 10:00:00Z", default: no limit)
+        """, default=None)
+    end = _TimeParam("""
+        skip index blocks written after this UTC time
+        (e.g. "2016-02-09 11:00:00Z", default: no limit)
+        """, default=None)
+
+    def run(self):
+        rule = rules.rule(self.rule)
+        values = index_values(rule)
+
+        errors = []
+        for path in self.paths:
+            for line in query_lines(path, self.start, self.end, values, errors):
+                line = line.strip()
+                if not line:
+                    continue
+
+                event = events.Event(json.loads(line))
+                if rule.match(event):
+                    sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+
+        for error in errors:
+            self.log.warning("Could not read all of the archive {0}".format(error))
+
+
+if __name__ == "__main__":
+    ArchiveQuery.from_command_line().execute()
@@ -0,0 +1,217 @@
+"""
+Replay events from ArchiveBot archive files (see
+abusehelper.tools.archivescan for the supported formats) to an XMPP
+room, e.g. for backfilling a new expert or for load testing a pipeline
+with real data.
+
+The events are replayed as fast as possible by default. With
+--pace=<N>x the original pace recorded in the archives is followed N
+times faster, and with --pace=<N>/s the events are replayed at a fixed
+rate of N events per second. Plain JSON archives written without an
+index record no per-event times, so with --pace=<N>x their events are
+timed by the start of the day in their <YYYY>/<MM>/<DD> path, i.e. a
+day's events are sent in a burst. The events are packed into multi-event
+stanzas, and the achieved throughput and the lag behind the intended
+schedule are logged periodically.
+
+Example:
+
+    python -m abusehelper.tools.archivereplay user@xmpp.example.com \\
+        replay.room archive/room@conference.example.com/2016/02/09.json.gz \\
+        --pace=10x
+"""
+
+import time
+
+import idiokit
+from abusehelper.core import bot, events
+from abusehelper.tools.archivescan import read_events, day_start
+
+
+class _PaceParam(bot.Param):
+    def parse(self, value):
+        value = value.strip().lower()
+
+        for suffix, mode in [("x", "speed"), ("/s", "rate")]:
+            if not value.endswith(suffix):
+                continue
+
+            try:
+                number = float(value[:-len(suffix)])
+            except ValueError:
+                break
+            if number <= 0.0:
+                break
+            return mode, number
+
+        raise bot.ParamError("expected \"<N>x\" or \"<N>/s\" with a positive N, got " + repr(value))
+
+
+class _Progress(object):
+    def __init__(self):
+        self.start = time.time()
+        self.count = 0
+        self.lag = 0.0
+
+        self._last_time = self.start
+        self._last_count = 0
+        self._max_lag = 0.0
+
+    def sent(self, lag):
+        self.count += 1
+        self.lag = lag
+        self._max_lag = max(self._max_lag, lag)
+
+    def pop_interval(self):
+        now = time.time()
+        rate = (self.count - self._last_count) / max(now - self._last_time, 1e-6)
+        max_lag = self._max_lag
+
+        self._last_time = now
+        self._last_count = self.count
+        self._max_lag = 0.0
+        return rate, max_lag
+
+    def total_rate(self):
+        return self.count / max(time.time() - self.start, 1e-6)
+
+
+class ArchiveReplay(bot.XMPPBot):
+    bot_name = "archivereplay"
+    room = bot.Param("""
+        the room to replay the events to
+        """)
+    paths = bot.ListParam("""
+        comma separated list of archive files to replay, in order
+        """)
+    pace = _PaceParam("""
+        follow the pace recorded in the archives N times faster
+        ("<N>x", e.g. "1x" for realtime) or replay at a fixed rate
+        of N events per second ("<N>/s")
+        (default: as fast as possible)
+        """, default=None)
+    xmpp_batch_size = bot.IntParam("""
+        how many events to pack into a single XMPP stanza at most
+        (default: %default)
+        """, default=100)
+    xmpp_batch_latency = bot.FloatParam("""
+        how many seconds to wait for a partial batch of events
+        before sending it (default: %default)
+        """, default=0.1)
+    xmpp_omit_body = bot.BoolParam("""
+        leave the human-readable text body out of the sent stanzas
+        """)
+    xmpp_compact_events = bot.BoolParam("""
+        send events in the compact base64 encoded format instead
+        of the legacy format
+        """)
+    report_interval = bot.FloatParam("""
+        how often to log the throughput and lag, in seconds
+        (default: %default)
+        """, default=10.0)
+
+    @idiokit.stream
+    def main(self):
+        xmpp = yield self.xmpp_connect()
+        room = yield xmpp.muc.join(self.room)
+
+        progress = _Progress()
+        replay = self._replay(progress)
+        idiokit.pipe(self._report(progress), replay)
+
+        yield idiokit.pipe(
+            replay,
+            events.events_to_elements(
+                self.xmpp_batch_size,
+                self.xmpp_batch_latency,
+                not self.xmpp_omit_body,
+                self.xmpp_compact_events),
+            room,
+            idiokit.consume()
+        )
+
+    def _schedule(self):
+        # Yield (due time, event) pairs. The due time is None when the
+        # event should be sent as soon as possible.
+        mode, number = self.pace or (None, None)
+
+        start = time.time()
+        first_timestamp = None
+        timestamp = None
+
+        index = 0
+        for path in self.paths:
+            self.log.info("Replaying archive {0!r}".format(path))
+
+            errors = []
+            untimed = False
+            for event_timestamp, event in read_events(path, errors):
+                if mode == "rate":
+                    yield start + index / number, event
+                elif mode == "speed":
+                    if event_timestamp is None:
+                        # Lines without a recorded time (e.g. of a plain
+                        # JSON archive) are timed by the day they are
+                        # from, without going back in time.
+                        day = day_start(path)
+                        if not untimed:
+                            untimed = True
+                            self.log.warning(self._untimed_warning(path, day))
+                        if day is not None and (timestamp is None or day > timestamp):
+                            event_timestamp = day
+
+                    if event_timestamp is not None:
+                        timestamp = event_timestamp
+                        if first_timestamp is None:
+                            first_timestamp = timestamp
+
+                    if timestamp is None:
+                        yield None, event
+                    else:
+                        yield start + (timestamp - first_timestamp) / number, event
+                else:
+                    yield None, event
+                index += 1
+
+            for error in errors:
+                self.log.warning("Could not read all of the archive {0}".format(error))
+
+    def _untimed_warning(self, path, day):
+        if day is None:
+            return "Archive {0!r} records no event times, sending its events as fast as possible".format(path)
+        return "Archive {0!r} records no event times, replaying its events at the start of their day".format(path)
+
+    @idiokit.stream
+    def _replay(self, progress):
+        for due, event in self._schedule():
+            lag = 0.0
+            if due is not None:
+                delay = due - time.time()
+                if delay > 0.0:
+                    yield idiokit.sleep(delay)
+                else:
+                    lag = -delay
+
+            yield idiokit.send(event)
+            progress.sent(lag)
+
+        self.log.info("Replayed {0} events in {1:.1f} seconds ({2:.1f} events/s)".format(
+            progress.count,
+            time.time() - progress.start,
+            progress.total_rate()))
+
+    @idiokit.stream
+    def _report(self, progress):
+        while True:
+            yield idiokit.sleep(self.report_interval)
+
+            rate, max_lag = progress.pop_interval()
+            self.log.info("Replayed {0} events, currently {1:.1f} events/s, lag {2:.3f} seconds (max {3:.3f})".format(
+                progress.count,
+                rate,
+                progress.lag,
+                max_lag))
+
+
+if __name__ == "__main__":
+    ArchiveReplay.from_command_line().execute()
@@ -0,0 +1,330 @@
+"""
+Scan ArchiveBot archive directories for events matching a rulelang
+expression, using a pool of worker processes.
+
+Both the JSON lines archives written by
+abusehelper.bots.archivebot (<room>/<YYYY>/<MM>/<DD>.json[.gz]) and the
+timestamped line format written by abusehelper.core.archivebot are
+supported. The archive files are distributed to the worker processes,
+which decompress and filter them as streams. The matching events are
+merged in timestamp order and written to the STDOUT as JSON lines.
+
+The matches are merged one day at a time, so the parent process holds
+the matches of one day's archives at once (plus those of any archive
+files not split by day, such as legacy per-room files, which are merged
+with everything).
+
+The timestamp of an event is the write time from the archive line when
+the line has one (the legacy format), the write time of the index block
+the line was read from when the archive has a sidecar index, and
+otherwise the start of the day the archive file covers. Indexed archives
+are read block by block, using the offsets and sizes in the index, and
+the data after the last indexed block is read as unindexed data.
+
+Example:
+
+    python -m abusehelper.tools.archivescan archive 'asn="64496"' \\
+        --start=2016-01-01 --end=2016-03-01 --processes=8
+"""
+
+import os
+import re
+import sys
+import json
+import heapq
+import calendar
+import itertools
+import collections
+import multiprocessing
+
+from abusehelper.core import bot, events, rules
+from abusehelper.core.archivebot import isoparse
+from abusehelper.tools.archivequery import READ_ERRORS, query_blocks
+
+
+_TIME_FORMATS = ("%Y-%m-%d %H:%M:%SZ", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d")
+
+_DAY_PATH = re.compile(r"(?:^|/)(\d{4})/(\d{2})/(\d{2})[^/]*$")
+
+_LEGACY_LINE = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}Z?) (.*)$")
+
+
+def day_start(rel_path):
+    r"""
+    Return the timestamp for the start of the day an archive file covers,
+    based on its <YYYY>/<MM>/<DD> path, or None for other paths.
+
+    >>> day_start("room@example.com/2016/02/09.json.gz")
+    1454976000
+    >>> day_start("room@example.com") is None
+    True
+    """
+
+    match = _DAY_PATH.search(rel_path.replace(os.sep, "/"))
+    if match is None:
+        return None
+    year, month, day = map(int, match.groups())
+    return calendar.timegm((year, month, day, 0, 0, 0))
+
+
+def _parse_line(line):
+    r"""
+    Return a (timestamp, event) pair parsed from an archive line. The
+    timestamp is None for JSON lines.
+
+    >>> _parse_line('{"a": ["b"]}') == (None, events.Event(a="b"))
+    True
+    >>> _parse_line('1970-01-01 00:00:01Z a=b') == (1, events.Event(a="b"))
+    True
+    """
+
+    if line.startswith("{"):
+        return None, events.Event(json.loads(line))
+
+    match = _LEGACY_LINE.match(line)
+    if match is None:
+        raise ValueError("unknown line format")
+    timestamp = isoparse(match.group(1))
+    return timestamp, events.Event.from_unicode(match.group(2).decode("utf-8"))
+
+
+def _read_lines(path, errors):
+    # Yield (line number, timestamp, line, event) tuples. Lines that can
+    # not be parsed are skipped, and so is damaged or partially written
+    # gzip data (e.g. of an archive that is still being written), both
+    # reported by appending a message to the errors list.
+    seq = -1
+    for block, lines in query_blocks(path, errors=errors):
+        timestamp = None if block is None else block["start"]
+
+        for line in lines:
+            seq += 1
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                line_time, event = _parse_line(line)
+            except ValueError as exc:
+                errors.append("{0}: line {1}: {2}".format(path, seq + 1, exc))
+                continue
+
+            if line_time is not None:
+                yield seq, line_time, line, event
+            else:
+                yield seq, timestamp, line, event
+
+
+def read_events(path, errors=None):
+    """
+    Yield (timestamp, event) pairs from an archive file, in the order
+    they appear in the file. The timestamp is the line's or its index
+    block's write time, or None when the archive does not record one.
+
+    Unparseable lines are skipped, and so is damaged or partially
+    written gzip data. Messages describing these are appended to the
+    errors list when one is given.
+    """
+
+    if errors is None:
+        errors = []
+
+    for _, timestamp, _, event in _read_lines(path, errors):
+        yield timestamp, event
+
+
+_rule_cache = {}
+
+
+def _scan(task):
+    path, rel_path, rule_string, start, end = task
+
+    rule = _rule_cache.get(rule_string, None)
+    if rule is None:
+        rule = rules.rule(rule_string)
+        _rule_cache[rule_string] = rule
+
+    # Archives without per-line times have already been limited to the
+    # days overlapping the time range, so their lines get the start of
+    # the day only for ordering.
+    day = day_start(rel_path)
+
+    results = []
+    errors = []
+    try:
+        for seq, timestamp, line, event in _read_lines(path, errors):
+            if timestamp is not None:
+                if start is not None and timestamp < start:
+                    continue
+                if end is not None and timestamp >= end:
+                    continue
+            elif day is not None:
+                timestamp = day
+
+            if rule.match(event):
+                results.append((timestamp or 0, rel_path, seq, line))
+    except READ_ERRORS as exc:
+        errors.append("{0}: {1}".format(path, exc))
+
+    results.sort()
+    return results, errors
+
+
+def find_archives(archive_dir, rooms=None, start=None, end=None):
+    """
+    Yield (path, relative path) pairs for the archive files under
+    archive_dir, limited to the given room directories or files and to
+    the day archives overlapping the time range.
+    """
+
+    archive_dir = os.path.abspath(archive_dir)
+    if rooms is None:
+        rooms = sorted(os.listdir(archive_dir))
+
+    for room in rooms:
+        room_path = os.path.join(archive_dir, room)
+        if os.path.isfile(room_path):
+            yield room_path, room
+            continue
+
+        for root, dirs, filenames in os.walk(room_path):
+            dirs.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(".idx"):
+                    continue
+
+                path = os.path.join(root, filename)
+                rel_path = os.path.relpath(path, archive_dir)
+
+                day = day_start(rel_path)
+                if day is not None:
+                    if start is not None and day + 86400 <= start:
+                        continue
+                    if end is not None and day >= end:
+                        continue
+                yield path, rel_path
+
+
+def _ordered_results(pool, tasks, window):
+    # Like pool.imap, but with at most window results computed ahead, so
+    # that the finished results don't pile up in the parent process.
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(_scan, (task,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+
+def _merge(pool, tasks, window, errors):
+    # The archives not split by day are merged with everything, the day
+    # archives one day at a time.
+    undated = [task for task in tasks if day_start(task[1]) is None]
+    dated = sorted((task for task in tasks if day_start(task[1]) is not None), key=lambda task: day_start(task[1]))
+
+    undated_matches = []
+    for matches, scan_errors in _ordered_results(pool, undated, window):
+        undated_matches.append(matches)
+        errors.extend(scan_errors)
+
+    def days():
+        group = []
+        group_day = None
+
+        results = itertools.izip(dated, _ordered_results(pool, dated, window))
+        for task, (matches, scan_errors) in results:
+            errors.extend(scan_errors)
+
+            day = day_start(task[1])
+            if day != group_day:
+                for match in heapq.merge(*group):
+                    yield match
+                group = []
+                group_day = day
+            group.append(matches)
+
+        for match in heapq.merge(*group):
+            yield match
+
+    return heapq.merge(days(), *undated_matches)
+
+
+def scan(archive_dir, rule_string, rooms=None, start=None, end=None, processes=None):
+    """
+    Scan the archives with a pool of worker processes. Return a pair
+    of an iterator over the matching (timestamp, relative path, line
+    number, line) tuples in timestamp order and a list of errors, which
+    gets filled in as the iterator is consumed.
+    """
+
+    tasks = [
+        (path, rel_path, rule_string, start, end)
+        for (path, rel_path) in find_archives(archive_dir, rooms, start, end)
+    ]
+
+    pool = multiprocessing.Pool(processes)
+    window = 2 * (processes or multiprocessing.cpu_count())
+    errors = []
+
+    def matches():
+        try:
+            for match in _merge(pool, tasks, window, errors):
+                yield match
+        finally:
+            pool.terminate()
+            pool.join()
+
+    return matches(), errors
+
+
+class _TimeParam(bot.Param):
+    def parse(self, value):
+        timestamp = isoparse(value, _TIME_FORMATS)
+        if timestamp is None:
+            raise bot.ParamError("not a valid date or timestamp (e.g. \"2016-02-09\"): " + repr(value))
+        return timestamp
+
+
+class ArchiveScan(bot.Bot):
+    bot_name = "archivescan"
+    archive_dir = bot.Param("""
+        the archive directory to scan
+        """)
+    rule = bot.Param("""
+        rulelang expression the printed events have to match
+        """)
+    rooms = bot.ListParam("""
+        comma separated list of room directories or legacy archive
+        files under archive_dir to scan (default: all)
+        """, default=None)
+    start = _TimeParam("""
+        skip events archived before this UTC date or time
+        (e.g. "2016-02-09", default: no limit)
+        """, default=None)
+    end = _TimeParam("""
+        skip events archived at or after this UTC date or time
+        (e.g. "2016-02-10", default: no limit)
+        """, default=None)
+    processes = bot.IntParam("""
+        the number of worker processes (default: the number of CPUs)
+        """, default=None)
+
+    def run(self):
+        rules.rule(self.rule)
+
+        matches, errors = scan(self.archive_dir, self.rule, self.rooms, self.start, self.end, self.processes)
+        for _, _, _, line in matches:
+            if not line.startswith("{"):
+                _, event = _parse_line(line)
+                line = json.dumps(dict((key, event.values(key)) for key in event.keys()))
+            sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+
+        for error in errors:
+            self.log.warning("Could not read all of the archive {0}".format(error))
+
+
+if __name__ == "__main__":
+    ArchiveScan.from_command_line().execute()